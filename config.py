@@ -11,9 +11,40 @@ RANDOM_SEED = 1234
 
 # Parser
 NUM_MAX_PAD = 100
+# pad the annotations of a batch to its largest object count, rounded up to one of these sizes to limit retracing
+# of train_step, None pads every sample to NUM_MAX_PAD
+PADDING_BUCKETS = (8, 16, 32, 64, NUM_MAX_PAD)
 THRESHOLD_POS = 0.5
 THRESHOLD_NEG = 0.4
 THRESHOLD_CROWD = 0.7
+# compute IoU only for the anchors on the grid cells each gt can overlap, same targets as dense matching
+SPARSE_MATCHING = False
+# parser emits padded annotations only, anchors are matched for the whole batch inside train_step
+MATCHING_ON_DEVICE = False
+# sample expand and crop together and cut the crop window from the original image, never build the expanded canvas
+FUSED_EXPAND_CROP = True
+# parser only decodes and resizes, augmentation (and matching) run batched on device in train_step
+DEVICE_AUGMENTATION = False
+# masks are sent to the device at this size, 2x proto size keeps small crops sharp
+DEVICE_AUGMENTATION_MASK_SIZE = 276
+# parser also returns the resized original image ('ori') and pixel boxes of training data, for visualization
+PARSER_DEBUG = False
+
+# Data loader
+# None for tf.data AUTOTUNE
+NUM_PARALLEL_CALLS = None
+# False lets parallel map / interleave yield elements out of order for more throughput, None keeps tf.data default
+DETERMINISTIC = None
+# 0 keeps the default threadpool / intra op parallelism of tf.data
+PRIVATE_THREADPOOL_SIZE = 0
+MAX_INTRA_OP_PARALLELISM = 0
+# RAM in bytes autotune may spend on buffers, 0 for default
+AUTOTUNE_RAM_BUDGET = 0
+# fuse consecutive maps and run batch copies in parallel
+MAP_FUSION = True
+PARALLEL_BATCH = True
+# cache parsed val/test data, None for no cache, "" for memory, or a file path prefix
+VAL_CACHE = None
 
 # Model
 BACKBONE = "resnet50"
@@ -35,6 +66,19 @@ TOP_K = 200
 CONF_THRESHOLD = 0.05
 NMS_THRESHOLD = 0.5
 MAX_NUM_DETECTION = 100
+# "fast_nms" (per class), "cc_fast_nms" (cross class) or "nms" (original greedy nms)
+NMS_TYPE = "fast_nms"
+# decode and suppress the whole batch in one graph, output padded tensors with num_detections
+BATCHED_DETECTION = False
+
+# Evaluation
+# mask IoU on float32 masks at image size ("full", as the original) or on bit packed binary masks ("packed")
+# "full" compares the binarized predictions with the soft, bilinear resized gt masks, "packed" also binarizes the gt
+# masks at 0.5, so mask mAP is an approximation of "full" even at image size, bbox mAP is unchanged
+MASK_IOU_MODE = "full"
+# "packed" compares the masks at this size instead of the image size (None), smaller sizes move mask mAP further from
+# "full". The gt masks are decoded at PROTO_OUTPUT_SIZE, they have no more detail at larger sizes
+MASK_IOU_SIZE = None
 
 # Todo Add custom dataset label dictionary if you need
 YOUR_CUSTOM_CLASSES = ()
@@ -85,27 +129,32 @@ ANCHOR = dict({
     "your_custom_dataset": {}
 })
 
+# Priors are cached as .npy keyed by the anchor setting, set to None to always regenerate
+ANCHOR_CACHE_DIR = os.path.join(ROOT_DIR, "data", "anchor_cache")
+
 # -----------------------------------------------------------------
 
 # Adding any backbone u want as long as the output size are: (69, 69), (35, 35), (18, 18) [if using 550 as img size]
+# built when the model is created, building them at import would start the tensorflow runtime before train.py
+# configures the devices of the distribution strategy
 backbones_objects = dict({
-    "resnet50": tf.keras.applications.ResNet50(input_shape=(IMG_SIZE, IMG_SIZE, 3),
-                                               include_top=False,
-                                               layers=tf.keras.layers,
-                                               weights='imagenet'),
-    "resnet101": tf.keras.applications.ResNet101(input_shape=(IMG_SIZE, IMG_SIZE, 3),
-                                                 include_top=False,
-                                                 layers=tf.keras.layers,
-                                                 weights='imagenet'),
-
-    "mobilenetv2": tf.keras.applications.MobileNetV2(input_shape=(IMG_SIZE, IMG_SIZE, 3),
-                                                     include_top=False,
-                                                     layers=tf.keras.layers,
-                                                     weights='imagenet'),
-
-    "efficientNet-B0": tf.keras.applications.EfficientNetB0(input_shape=(IMG_SIZE, IMG_SIZE, 3),
-                                                            include_top=False,
-                                                            weights='imagenet')
+    "resnet50": lambda: tf.keras.applications.ResNet50(input_shape=(IMG_SIZE, IMG_SIZE, 3),
+                                                       include_top=False,
+                                                       layers=tf.keras.layers,
+                                                       weights='imagenet'),
+    "resnet101": lambda: tf.keras.applications.ResNet101(input_shape=(IMG_SIZE, IMG_SIZE, 3),
+                                                         include_top=False,
+                                                         layers=tf.keras.layers,
+                                                         weights='imagenet'),
+
+    "mobilenetv2": lambda: tf.keras.applications.MobileNetV2(input_shape=(IMG_SIZE, IMG_SIZE, 3),
+                                                             include_top=False,
+                                                             layers=tf.keras.layers,
+                                                             weights='imagenet'),
+
+    "efficientNet-B0": lambda: tf.keras.applications.EfficientNetB0(input_shape=(IMG_SIZE, IMG_SIZE, 3),
+                                                                    include_top=False,
+                                                                    weights='imagenet')
 
 })
 
@@ -173,6 +222,12 @@ PASCAL_CLASSES = ("aeroplane", "bicycle", "bird", "boat", "bottle",
                   "dog", "horse", "motorbike", "person", "pottedplant",
                   "sheep", "sofa", "train", "tvmonitor")
 
+CLASS_NAMES = dict({
+    "coco": COCO_CLASSES,
+    "pascal": PASCAL_CLASSES,
+    "your_custom_dataset": YOUR_CUSTOM_CLASSES
+})
+
 # Only coco need it to map 90 to 80 classes
 LABEL_MAP = dict({
     "coco": COCO_LABEL_MAP,
@@ -186,6 +241,7 @@ def get_params(dataset_name):
         "output_size": IMG_SIZE,
         "proto_out_size": PROTO_OUTPUT_SIZE,
         "num_max_padding": NUM_MAX_PAD,
+        "padding_buckets": PADDING_BUCKETS,
         "augmentation_params": {
             # These are in RGB and for ImageNet
             "mean": (0.407, 0.457, 0.485),
@@ -194,11 +250,27 @@ def get_params(dataset_name):
             "proto_output_size": PROTO_OUTPUT_SIZE,
             "discard_box_width": 4. / float(IMG_SIZE),
             "discard_box_height": 4. / float(IMG_SIZE),
+            "fused_expand_crop": FUSED_EXPAND_CROP,
         },
         "matching_params": {
             "threshold_pos": THRESHOLD_POS,
             "threshold_neg": THRESHOLD_NEG,
-            "threshold_crowd": THRESHOLD_CROWD
+            "threshold_crowd": THRESHOLD_CROWD,
+            "sparse_matching": SPARSE_MATCHING
+        },
+        "matching_on_device": MATCHING_ON_DEVICE,
+        "device_augmentation": DEVICE_AUGMENTATION,
+        "debug": PARSER_DEBUG,
+        "device_mask_size": DEVICE_AUGMENTATION_MASK_SIZE,
+        "loader_params": {
+            "num_parallel_calls": NUM_PARALLEL_CALLS,
+            "deterministic": DETERMINISTIC,
+            "private_threadpool_size": PRIVATE_THREADPOOL_SIZE,
+            "max_intra_op_parallelism": MAX_INTRA_OP_PARALLELISM,
+            "autotune_ram_budget": AUTOTUNE_RAM_BUDGET,
+            "map_fusion": MAP_FUSION,
+            "parallel_batch": PARALLEL_BATCH,
+            "val_cache": VAL_CACHE
         },
         "label_map": LABEL_MAP[dataset_name]
     }
@@ -209,7 +281,9 @@ def get_params(dataset_name):
         "top_k": TOP_K,
         "conf_threshold": CONF_THRESHOLD,
         "nms_threshold": NMS_THRESHOLD,
-        "max_num_detection": MAX_NUM_DETECTION
+        "max_num_detection": MAX_NUM_DETECTION,
+        "nms_type": NMS_TYPE,
+        "batched": BATCHED_DETECTION
     }
 
     loss_params = {
@@ -222,7 +296,7 @@ def get_params(dataset_name):
     }
 
     lrs_schedule_params = LR_STAGE[dataset_name]
-    anchor_params = ANCHOR[dataset_name]
+    anchor_params = dict(ANCHOR[dataset_name], cache_dir=ANCHOR_CACHE_DIR)
 
     model_params = {
         "backbone": BACKBONE,
@@ -1,20 +1,72 @@
-from itertools import product
-from math import sqrt
+import hashlib
+import json
+import os
 
+import numpy as np
 import tensorflow as tf
 
 
 # Can generate one instance only when creating the model
 class Anchor(object):
 
-    def __init__(self, img_size, feature_map_size, aspect_ratio, scale):
+    def __init__(self, img_size, feature_map_size, aspect_ratio, scale, cache_dir=None):
         """
         :param img_size:
         :param feature_map_size:
         :param aspect_ratio:
         :param scale:
+        :param cache_dir: directory to store the generated priors as .npy, None for no cache
         """
-        self.num_anchors, self.anchors = self._generate_anchors(img_size, feature_map_size, aspect_ratio, scale)
+        self.num_anchors = sum([f_size * f_size for f_size in feature_map_size])
+        self.img_size = img_size
+        self.feature_map_size = feature_map_size
+        self.aspect_ratio = aspect_ratio
+        self.scale = scale
+        priors = self._load_anchors(img_size, feature_map_size, aspect_ratio, scale, cache_dir)
+        self.anchors = tf.convert_to_tensor(priors, dtype=tf.float32)
+
+        # the variance used for encoding the offset and decoding it back
+        self.variances = [0.1, 0.2]
+
+        # constants of anchors used for every matching and decoding, computed only once here
+        self.ymin, self.xmin, self.ymax, self.xmax = tf.unstack(self.anchors, axis=-1)
+        h = self.ymax - self.ymin
+        w = self.xmax - self.xmin
+        self.areas = w * h
+        # center form [cx, cy, w, h]
+        self.center_anchors = tf.stack([self.xmin + (w / 2), self.ymin + (h / 2), w, h], axis=-1)
+        self.cx, self.cy, self.w, self.h = tf.unstack(self.center_anchors, axis=-1)
+        self.reciprocal_w = 1. / w
+        self.reciprocal_h = 1. / h
+        # variance-scaled version for the center offset
+        self.scaled_w = w * self.variances[0]
+        self.scaled_h = h * self.variances[0]
+        self.reciprocal_scaled_w = 1. / self.scaled_w
+        self.reciprocal_scaled_h = 1. / self.scaled_h
+
+    def _load_anchors(self, img_size, feature_map_size, aspect_ratio, scale, cache_dir):
+        """
+        Load the priors from cache if they were generated with the same setting before, otherwise generate them
+        :return: [num_priors, 4] numpy array
+        """
+        if cache_dir is None:
+            return self._generate_anchors(img_size, feature_map_size, aspect_ratio, scale)
+
+        # the cache is keyed by the setting of the anchors
+        key = json.dumps([img_size, list(feature_map_size), list(aspect_ratio), list(scale)])
+        key = hashlib.sha1(key.encode('utf8')).hexdigest()
+        cache_file = os.path.join(cache_dir, f"anchors_{key}.npy")
+        if os.path.exists(cache_file):
+            return np.load(cache_file, mmap_mode='r')
+
+        priors = self._generate_anchors(img_size, feature_map_size, aspect_ratio, scale)
+        # write to a temp file then rename, so concurrent workers never read a partial file
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+        with open(tmp_file, 'wb') as f:
+            np.save(f, priors)
+        os.replace(tmp_file, cache_file)
+        return priors
 
     def _generate_anchors(self, img_size, feature_map_size, aspect_ratio, scale):
         """
@@ -22,35 +74,29 @@ class Anchor(object):
         :param feature_map_size:
         :param aspect_ratio:
         :param scale:
-        :return:
+        :return: [num_priors, 4] numpy array in order of (row, col, aspect ratio) for each feature map
         """
         prior_boxes = []
-        num_anchors = 0
+        a = np.sqrt(np.asarray(aspect_ratio, dtype=np.float64))
         for idx, f_size in enumerate(feature_map_size):
-            # print("Create priors for f_size:%s", f_size)
-            count_anchor = 0
-            for j, i in product(range(f_size), range(f_size)):
-                x = (i + 0.5) / f_size
-                y = (j + 0.5) / f_size
-                for ars in aspect_ratio:
-                    a = sqrt(ars)
-                    w = scale[idx] * a / img_size
-                    h = scale[idx] / a / img_size
-
-                    # original author make all priors squre
-                    h = w
-
-                    # directly use point form here => [ymin, xmin, ymax, xmax]
-                    ymin = y - (h / 2.)
-                    xmin = x - (w / 2.)
-                    ymax = y + (h / 2.)
-                    xmax = x + (w / 2.)
-                    prior_boxes += [ymin * img_size, xmin * img_size, ymax * img_size, xmax * img_size]
-                count_anchor += 1
-            num_anchors += count_anchor
-            # print(f_size, count_anchor)
-        output = tf.reshape(tf.convert_to_tensor(prior_boxes), [-1, 4])
-        return num_anchors, output
+            # center of each cell, [f_size, f_size, 1]
+            j, i = np.meshgrid(np.arange(f_size), np.arange(f_size), indexing='ij')
+            x = ((i + 0.5) / f_size)[..., None]
+            y = ((j + 0.5) / f_size)[..., None]
+
+            # [num_aspect_ratio]
+            w = scale[idx] * a / img_size
+            # original author make all priors squre
+            h = w
+
+            # directly use point form here => [ymin, xmin, ymax, xmax]
+            ymin = y - (h / 2.)
+            xmin = x - (w / 2.)
+            ymax = y + (h / 2.)
+            xmax = x + (w / 2.)
+            boxes = np.stack([ymin * img_size, xmin * img_size, ymax * img_size, xmax * img_size], axis=-1)
+            prior_boxes.append(boxes.reshape([-1, 4]))
+        return np.concatenate(prior_boxes, axis=0).astype(np.float32)
 
     def _pairwise_intersection(self, gt_bbox):
         """
@@ -60,7 +106,7 @@ class Anchor(object):
         """
 
         # unstack the ymin, xmin, ymax, xmax
-        ymin_anchor, xmin_anchor, ymax_anchor, xmax_anchor = tf.unstack(self.anchors, axis=-1)
+        ymin_anchor, xmin_anchor, ymax_anchor, xmax_anchor = self.ymin, self.xmin, self.ymax, self.xmax
         ymin_gt, xmin_gt, ymax_gt, xmax_gt = tf.unstack(gt_bbox, axis=-1)
 
         # calculate intersection
@@ -90,10 +136,9 @@ class Anchor(object):
         pairwise_inter = self._pairwise_intersection(gt_bbox=gt_bbox)
         # tf.print("pairwaise inter", pairwise_inter)
         # calculate areaA, areaB
-        ymin_anchor, xmin_anchor, ymax_anchor, xmax_anchor = tf.unstack(self.anchors, axis=-1)
         ymin_gt, xmin_gt, ymax_gt, xmax_gt = tf.unstack(gt_bbox, axis=-1)
 
-        area_anchor = (xmax_anchor - xmin_anchor) * (ymax_anchor - ymin_anchor)
+        area_anchor = self.areas
         area_gt = (xmax_gt - xmin_gt) * (ymax_gt - ymin_gt)
         # tf.print("area anchor", area_anchor)
         # tf.print("area gt", area_gt)
@@ -111,10 +156,127 @@ class Anchor(object):
         # IOU(Jaccard overlap) = intersection / union, there might be possible to have division by 0
         return pairwise_inter / pairwise_union
 
+    def _sparse_pairwise_iou(self, gt_bbox, is_crowd=False):
+        """
+        IoU only for the (anchor, gt) pairs that can overlap, using the grid layout of anchors:
+        on each feature map, a gt can only overlap the cells whose center is within
+        (largest anchor size + gt size) / 2 from the gt center
+        :param gt_bbox: [num_obj, 4]
+        :return: anchor index [num_pairs], gt index [num_pairs], IoU [num_pairs]
+        """
+        num_levels = len(self.feature_map_size)
+        num_ratio = len(self.aspect_ratio)
+        f_size = tf.constant(self.feature_map_size, tf.int32)
+        # half size of the largest anchor on each feature map
+        half_size = tf.constant([s * max(self.aspect_ratio) ** 0.5 / 2. for s in self.scale], tf.float32)
+        level_offset = tf.constant(np.cumsum([0] + [f * f * num_ratio for f in self.feature_map_size[:-1]]),
+                                   tf.int32)
+
+        # range of candidate cells of every gt on every feature map, [num_obj, num_levels]
+        ymin_gt, xmin_gt, ymax_gt, xmax_gt = [tf.expand_dims(x, axis=-1) for x in tf.unstack(gt_bbox, axis=-1)]
+        cells_per_pixel = tf.cast(f_size, tf.float32) / self.img_size
+
+        def cell_range(low, high):
+            first = tf.cast(tf.math.floor((low - half_size) * cells_per_pixel - 0.5), tf.int32)
+            last = tf.cast(tf.math.ceil((high + half_size) * cells_per_pixel - 0.5), tf.int32)
+            first = tf.clip_by_value(first, 0, f_size - 1)
+            last = tf.clip_by_value(last, 0, f_size - 1)
+            return first, tf.maximum(last - first + 1, 0)
+
+        x_first, num_x = cell_range(xmin_gt, xmax_gt)
+        y_first, num_y = cell_range(ymin_gt, ymax_gt)
+
+        # anchors are in order of (row, col, aspect ratio) for each feature map, so the candidates of one
+        # (gt, feature map) are rows of num_x * num_ratio consecutive anchors
+        first_anchor = level_offset + (y_first * f_size + x_first) * num_ratio
+        row_stride = tf.broadcast_to(f_size * num_ratio, tf.shape(first_anchor))
+        segment_table = tf.reshape(tf.stack([first_anchor, num_x, row_stride], axis=-1), [-1, 3])
+
+        # enumerate the candidate pairs, one segment for each (gt, feature map)
+        counts = tf.reshape(num_x * num_y * num_ratio, [-1])
+        local = tf.ragged.range(counts)
+        segment = tf.cast(local.value_rowids(), tf.int32)
+        local = local.flat_values
+        first_anchor, num_x, row_stride = tf.unstack(tf.gather(segment_table, segment), axis=-1)
+
+        ratio = local % num_ratio
+        cell = local // num_ratio
+        anchor_idx = first_anchor + (cell // num_x) * row_stride + (cell % num_x) * num_ratio + ratio
+        gt_idx = segment // num_levels
+
+        # IoU of the candidate pairs
+        ymin_a, xmin_a, ymax_a, xmax_a = tf.unstack(tf.gather(self.anchors, anchor_idx), axis=-1)
+        ymin_g, xmin_g, ymax_g, xmax_g = tf.unstack(tf.gather(gt_bbox, gt_idx), axis=-1)
+        intersect_heights = tf.math.maximum(0.0, tf.math.minimum(ymax_a, ymax_g) - tf.math.maximum(ymin_a, ymin_g))
+        intersect_widths = tf.math.maximum(0.0, tf.math.minimum(xmax_a, xmax_g) - tf.math.maximum(xmin_a, xmin_g))
+        inter = intersect_heights * intersect_widths
+        area_gt = (xmax_g - xmin_g) * (ymax_g - ymin_g)
+        if is_crowd:
+            union = area_gt
+        else:
+            union = (xmax_a - xmin_a) * (ymax_a - ymin_a) + area_gt - inter
+        return anchor_idx, gt_idx, inter / union
+
+    def _sparse_max_iou(self, iou, idx, other_idx, num_segments):
+        """
+        Same as reduce_max and argmax along one axis of the dense IoU matrix, non-candidate pair has IoU 0
+        :param iou: [num_pairs]
+        :param idx: the index to reduce to, [num_pairs]
+        :param other_idx: the index to find argmax from, [num_pairs]
+        :return: max IoU [num_segments], argmax [num_segments] in tf.int64
+        """
+        max_iou = tf.math.maximum(tf.math.unsorted_segment_max(iou, idx, num_segments), 0.)
+        # argmax take the first one if there is a tie
+        is_max = tf.equal(iou, tf.gather(max_iou, idx))
+        sentinel = tf.int32.max
+        arg_max = tf.math.unsorted_segment_min(tf.where(is_max, other_idx, sentinel), idx, num_segments)
+        # all IoU are 0 (or no candidate), argmax of the dense matrix is the first one
+        arg_max = tf.where(max_iou > 0, arg_max, tf.zeros_like(arg_max))
+        return max_iou, tf.cast(arg_max, tf.int64)
+
     def get_anchors(self):
         return self.anchors
 
-    def matching(self, gt_bbox, gt_labels, num_crowd=0, threshold_pos=0.5, threshold_neg=0.4, threshold_crowd=0.7):
+    def encode(self, matched_bbox):
+        """
+        Encode the matched gt of every anchor to offset
+        :param matched_bbox: [num_anchors, 4] or [batch, num_anchors, 4] in [ymin, xmin, ymax, xmax]
+        :return: offset [..., num_anchors, 4] in [cx, cy, w, h]
+        """
+        h = matched_bbox[..., 2] - matched_bbox[..., 0]
+        w = matched_bbox[..., 3] - matched_bbox[..., 1]
+        cx = matched_bbox[..., 1] + (w / 2)
+        cy = matched_bbox[..., 0] + (h / 2)
+
+        g_hat_cx = (cx - self.cx) * self.reciprocal_scaled_w
+        g_hat_cy = (cy - self.cy) * self.reciprocal_scaled_h
+        tf.debugging.assert_non_negative(w * self.reciprocal_w)
+        tf.debugging.assert_non_negative(h * self.reciprocal_h)
+        g_hat_w = tf.math.log(w * self.reciprocal_w) / self.variances[1]
+        g_hat_h = tf.math.log(h * self.reciprocal_h) / self.variances[1]
+        return tf.stack([g_hat_cx, g_hat_cy, g_hat_w, g_hat_h], axis=-1)
+
+    def decode(self, loc_pred):
+        """
+        Decode the predicted offset back to bounding box
+        :param loc_pred: [num_anchors, 4] or [batch, num_anchors, 4] in [cx, cy, w, h]
+        :return: boxes [..., num_anchors, 4] in [ymin, xmin, ymax, xmax]
+        """
+        pred_cx, pred_cy, pred_w, pred_h = tf.unstack(loc_pred, axis=-1)
+
+        new_cx = pred_cx * self.scaled_w + self.cx
+        new_cy = pred_cy * self.scaled_h + self.cy
+        new_w = tf.math.exp(pred_w * self.variances[1]) * self.w
+        new_h = tf.math.exp(pred_h * self.variances[1]) * self.h
+
+        ymin = new_cy - (new_h / 2)
+        xmin = new_cx - (new_w / 2)
+        ymax = new_cy + (new_h / 2)
+        xmax = new_cx + (new_w / 2)
+        return tf.stack([ymin, xmin, ymax, xmax], axis=-1)
+
+    def matching(self, gt_bbox, gt_labels, num_crowd=0, threshold_pos=0.5, threshold_neg=0.4, threshold_crowd=0.7,
+                 sparse_matching=False):
         """
         :param gt_bbox:
         :param gt_labels:
@@ -128,11 +290,12 @@ class Anchor(object):
             pos_iou_threshold:
             num_crowd:
             neg_iou_threshold:
+            sparse_matching: compute IoU only for the anchors each gt can overlap, same result as dense matching
         """
         if num_crowd > 0:
-            # split the gt_bbox
-            gt_bbox = gt_bbox[:-num_crowd]
+            # split the gt_bbox, crowd annotations are put after non-crowd annotations
             crowd_gt_bbox = gt_bbox[-num_crowd:]
+            gt_bbox = gt_bbox[:-num_crowd]
         else:
             crowd_gt_bbox = tf.zeros_like(gt_bbox)
 
@@ -140,52 +303,60 @@ class Anchor(object):
         # --------------------------------------------------------------------------------------------------------------
         num_gt = tf.shape(gt_bbox)[0]
         # tf.print("num gt", num_gt)
-        # pairwise IoU
-        pairwise_iou = self._pairwise_iou(gt_bbox=gt_bbox, is_crowd=False)
-        # tf.print("pairwise_iou", tf.shape(pairwise_iou))
-        # assign the max overlap gt index for each anchor
-        max_iou_for_anchors = tf.reduce_max(pairwise_iou, axis=-1)
-        max_id_for_anchors = tf.math.argmax(pairwise_iou, axis=-1)
+        if sparse_matching:
+            anchor_idx, gt_idx, pairwise_iou = self._sparse_pairwise_iou(gt_bbox=gt_bbox, is_crowd=False)
+            # assign the max overlap gt index for each anchor
+            max_iou_for_anchors, max_id_for_anchors = self._sparse_max_iou(
+                pairwise_iou, anchor_idx, gt_idx, tf.shape(self.anchors)[0])
+            # the best matched anchor of each gt
+            forced_update_iou, forced_update_indice = self._sparse_max_iou(pairwise_iou, gt_idx, anchor_idx, num_gt)
+        else:
+            # pairwise IoU
+            pairwise_iou = self._pairwise_iou(gt_bbox=gt_bbox, is_crowd=False)
+            # tf.print("pairwise_iou", tf.shape(pairwise_iou))
+            # assign the max overlap gt index for each anchor
+            max_iou_for_anchors = tf.reduce_max(pairwise_iou, axis=-1)
+            max_id_for_anchors = tf.math.argmax(pairwise_iou, axis=-1)
+            # the best matched anchor of each gt
+            forced_update_iou = tf.reduce_max(pairwise_iou, axis=0)
+            forced_update_indice = tf.math.argmax(pairwise_iou, axis=0)
 
         # force the anchors which is the best matched of each gt to predict the correspond gt
         forced_update_id = tf.cast(tf.range(0, num_gt), tf.int64)
 
         # force the iou over threshold for not wasting any training data
-        forced_update_iou = tf.reduce_max(pairwise_iou, axis=0)
         # make sure the it won't be filtered even if under negative threshold
         forced_update_iou += (2-forced_update_iou)
         # tf.print("forced_update_iou", forced_update_iou)
-        forced_update_indice = tf.expand_dims(tf.math.argmax(pairwise_iou, axis=0), axis=-1)
+        forced_update_indice = tf.expand_dims(forced_update_indice, axis=-1)
 
         # assign the pair (the gt for priors to predict)
         max_iou_for_anchors = tf.tensor_scatter_nd_update(max_iou_for_anchors, forced_update_indice, forced_update_iou)
         max_id_for_anchors = tf.tensor_scatter_nd_update(max_id_for_anchors, forced_update_indice, forced_update_id)
 
-        # decide the anchors to be positive or negative based on the IoU and given threshold
-        pos_iou = tf.where(max_iou_for_anchors > threshold_pos)
-        max_iou_for_anchors = tf.tensor_scatter_nd_update(max_iou_for_anchors, pos_iou, tf.ones(tf.size(pos_iou)))
-        neg_iou = tf.where(max_iou_for_anchors < threshold_neg)
-        max_iou_for_anchors = tf.tensor_scatter_nd_update(max_iou_for_anchors, neg_iou, tf.zeros(tf.size(neg_iou)))
-        neu_iou = tf.where(
-            tf.math.logical_and((max_iou_for_anchors <= threshold_pos), max_iou_for_anchors >= threshold_neg))
-        max_iou_for_anchors = tf.tensor_scatter_nd_update(max_iou_for_anchors, neu_iou, -1 * tf.ones(tf.size(neu_iou)))
+        # decide the anchors to be positive (1), negative (0) or neutral (-1) based on the IoU and given threshold
+        max_iou_for_anchors = tf.where(max_iou_for_anchors > threshold_pos, 1.,
+                                       tf.where(max_iou_for_anchors < threshold_neg, 0., -1.))
 
         # deal with crowd annotations, only affect non-positive
         # --------------------------------------------------------------------------------------------------------------
         if num_crowd > 0 and threshold_crowd < 1:
-            # crowd pairwise IoU
-            crowd_pairwise_iou = self._pairwise_iou(gt_bbox=crowd_gt_bbox, is_crowd=True)
+            if sparse_matching:
+                anchor_idx, _, crowd_pairwise_iou = self._sparse_pairwise_iou(gt_bbox=crowd_gt_bbox, is_crowd=True)
+                crowd_max_iou_for_anchors = tf.math.maximum(
+                    tf.math.unsorted_segment_max(crowd_pairwise_iou, anchor_idx, tf.shape(self.anchors)[0]), 0.)
+            else:
+                # crowd pairwise IoU
+                crowd_pairwise_iou = self._pairwise_iou(gt_bbox=crowd_gt_bbox, is_crowd=True)
 
-            # assign the max overlap gt index for each anchor
-            crowd_max_iou_for_anchors = tf.reduce_max(crowd_pairwise_iou, axis=-1)
+                # assign the max overlap gt index for each anchor
+                crowd_max_iou_for_anchors = tf.reduce_max(crowd_pairwise_iou, axis=-1)
 
             # assign neutral for those neg iou that over crowd threshold
-            crowd_neu_iou = tf.where(
-                tf.math.logical_and((max_iou_for_anchors <= 0), crowd_max_iou_for_anchors > threshold_crowd))
+            crowd_neu_iou = tf.math.logical_and((max_iou_for_anchors <= 0), crowd_max_iou_for_anchors > threshold_crowd)
 
             # reassigh from negative to neutral
-            max_iou_for_anchors = tf.tensor_scatter_nd_update(max_iou_for_anchors, crowd_neu_iou,
-                                                              -1 * tf.ones(tf.size(crowd_neu_iou)))
+            max_iou_for_anchors = tf.where(crowd_neu_iou, -1., max_iou_for_anchors)
         match_positiveness = max_iou_for_anchors
 
         # create class target
@@ -206,25 +377,82 @@ class Anchor(object):
         # map_loc = tf.map_fn(lambda x: gt_bbox[x], max_id_for_anchors, dtype=tf.float32)
         map_loc = tf.gather(gt_bbox, max_id_for_anchors)
 
-        # convert to center form [cx, cy, w, h]
-        # center_anchors = tf.map_fn(lambda x: map_to_center_form(x), self.anchors)
-        h = self.anchors[:, 2] - self.anchors[:, 0]
-        w = self.anchors[:, 3] - self.anchors[:, 1]
-        center_anchors = tf.stack([self.anchors[:, 1] + (w / 2), self.anchors[:, 0] + (h / 2), w, h], axis=-1)
-
-        # center_gt = tf.map_fn(lambda x: map_to_center_form(x), map_loc)
-        h = map_loc[:, 2] - map_loc[:, 0]
-        w = map_loc[:, 3] - map_loc[:, 1]
-        center_gt = tf.stack([map_loc[:, 1] + (w / 2), map_loc[:, 0] + (h / 2), w, h], axis=-1)
-        variances = [0.1, 0.2]
-
         # calculate offset
-        # target_loc = tf.map_fn(lambda x: map_to_offset(x), tf.stack([center_gt, center_anchors], axis=-1))
-        g_hat_cx = (center_gt[:, 0] - center_anchors[:, 0]) / center_anchors[:, 2] / variances[0]
-        g_hat_cy = (center_gt[:, 1] - center_anchors[:, 1]) / center_anchors[:, 3] / variances[0]
-        tf.debugging.assert_non_negative(center_anchors[:, 2] / center_gt[:, 2])
-        tf.debugging.assert_non_negative(center_anchors[:, 3] / center_gt[:, 3])
-        g_hat_w = tf.math.log(center_gt[:, 2] / center_anchors[:, 2]) / variances[1]
-        g_hat_h = tf.math.log(center_gt[:, 3] / center_anchors[:, 3]) / variances[1]
-        target_loc = tf.stack([g_hat_cx, g_hat_cy, g_hat_w, g_hat_h], axis=-1)
+        target_loc = self.encode(map_loc)
         return target_cls, target_loc, max_id_for_anchors, match_positiveness
+
+    def batched_matching(self, gt_bbox, gt_labels, num_obj, num_crowd, threshold_pos=0.5, threshold_neg=0.4,
+                         threshold_crowd=0.7):
+        """
+        Matching for a batch of padded annotations with static shapes, so it can run on accelerator inside train_step
+        :param gt_bbox: [batch, num_max_pad, 4], crowd annotations are put after non-crowd annotations
+        :param gt_labels: [batch, num_max_pad]
+        :param num_obj: [batch], number of annotations including crowd
+        :param num_crowd: [batch]
+        :return: same as matching with a batch dimension
+        """
+        num_anchors = tf.shape(self.anchors)[0]
+        num_max_pad = tf.shape(gt_bbox)[1]
+        num_gt = tf.expand_dims(tf.cast(num_obj - num_crowd, tf.int32), axis=-1)
+        gt_range = tf.expand_dims(tf.range(num_max_pad), axis=0)
+
+        # [batch, num_max_pad]
+        valid_gt = gt_range < num_gt
+        crowd_gt = tf.logical_and(gt_range >= num_gt, gt_range < tf.expand_dims(tf.cast(num_obj, tf.int32), axis=-1))
+
+        # pairwise intersection between anchors and gt, [batch, num_anchors, num_max_pad]
+        ymin_gt, xmin_gt, ymax_gt, xmax_gt = [tf.expand_dims(x, axis=1) for x in tf.unstack(gt_bbox, axis=-1)]
+        intersect_heights = tf.math.maximum(
+            0.0, tf.math.minimum(self.ymax[:, None], ymax_gt) - tf.math.maximum(self.ymin[:, None], ymin_gt))
+        intersect_widths = tf.math.maximum(
+            0.0, tf.math.minimum(self.xmax[:, None], xmax_gt) - tf.math.maximum(self.xmin[:, None], xmin_gt))
+        pairwise_inter = intersect_heights * intersect_widths
+        area_gt = (xmax_gt - xmin_gt) * (ymax_gt - ymin_gt)
+
+        # Matching only for non-crowd annotation, padding get -1 so it is never the max
+        # --------------------------------------------------------------------------------------------------------------
+        pairwise_iou = pairwise_inter / (self.areas[:, None] + area_gt - pairwise_inter)
+        pairwise_iou = tf.where(tf.expand_dims(valid_gt, axis=1), pairwise_iou, -1.)
+
+        # assign the max overlap gt index for each anchor, [batch, num_anchors]
+        max_iou_for_anchors = tf.reduce_max(pairwise_iou, axis=-1)
+        max_id_for_anchors = tf.math.argmax(pairwise_iou, axis=-1, output_type=tf.int32)
+
+        # force the anchors which is the best matched of each gt to predict the correspond gt
+        # (the last gt wins if an anchor is the best of several gt), without scatter to keep the shape static
+        forced_update_indice = tf.math.argmax(pairwise_iou, axis=1, output_type=tf.int32)
+        forced = tf.logical_and(
+            tf.equal(tf.range(num_anchors)[None, :, None], tf.expand_dims(forced_update_indice, axis=1)),
+            tf.expand_dims(valid_gt, axis=1))
+        forced_update_id = tf.math.argmax(tf.where(forced, gt_range[:, None, :], -1), axis=-1, output_type=tf.int32)
+        is_forced = tf.reduce_any(forced, axis=-1)
+
+        # make sure the it won't be filtered even if under negative threshold
+        max_iou_for_anchors = tf.where(is_forced, 2., max_iou_for_anchors)
+        max_id_for_anchors = tf.where(is_forced, forced_update_id, max_id_for_anchors)
+
+        # decide the anchors to be positive (1), negative (0) or neutral (-1) based on the IoU and given threshold
+        max_iou_for_anchors = tf.where(max_iou_for_anchors > threshold_pos, 1.,
+                                       tf.where(max_iou_for_anchors < threshold_neg, 0., -1.))
+
+        # deal with crowd annotations, only affect non-positive
+        # --------------------------------------------------------------------------------------------------------------
+        if threshold_crowd < 1:
+            crowd_pairwise_iou = tf.math.divide_no_nan(pairwise_inter, area_gt)
+            crowd_pairwise_iou = tf.where(tf.expand_dims(crowd_gt, axis=1), crowd_pairwise_iou, 0.)
+            crowd_max_iou_for_anchors = tf.reduce_max(crowd_pairwise_iou, axis=-1)
+
+            # reassigh from negative to neutral
+            crowd_neu_iou = tf.math.logical_and((max_iou_for_anchors <= 0), crowd_max_iou_for_anchors > threshold_crowd)
+            max_iou_for_anchors = tf.where(crowd_neu_iou, -1., max_iou_for_anchors)
+        match_positiveness = max_iou_for_anchors
+
+        # create class target
+        match_labels = tf.gather(gt_labels, max_id_for_anchors, batch_dims=1)
+        target_cls = tf.multiply(tf.cast(match_labels, tf.float32), match_positiveness)
+
+        # create loc target, image without gt get zero target (never used by loss)
+        map_loc = tf.gather(gt_bbox, max_id_for_anchors, batch_dims=1)
+        target_loc = self.encode(map_loc)
+        target_loc = tf.where(tf.math.is_finite(target_loc), target_loc, 0.)
+        return target_cls, target_loc, tf.cast(max_id_for_anchors, tf.int64), match_positiveness
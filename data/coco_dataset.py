@@ -8,19 +8,108 @@ ref:https://github.com/tensorflow/models/blob/master/research/object_detection/u
 import os
 
 import tensorflow as tf
+from absl import logging
 
 from data import coco_tfrecord_parser
+from data.coco_tfrecord_utils import read_shard_index
 
 
 class ObjectDetectionDataset:
 
-    def __init__(self, dataset_name, tfrecord_dir, anchor_instance, **parser_params):
+    def __init__(self, dataset_name, tfrecord_dir, anchor_instance, loader_params=None, **parser_params):
         self.dataset_name = dataset_name
         self.tfrecord_dir = tfrecord_dir
         self.anchor_instance = anchor_instance
         self.parser_params = parser_params
 
-    def get_dataloader(self, subset, batch_size):
+        loader_params = loader_params or {}
+        num_parallel_calls = loader_params.get('num_parallel_calls')
+        self.num_parallel_calls = tf.data.experimental.AUTOTUNE if num_parallel_calls is None else num_parallel_calls
+        self.deterministic = loader_params.get('deterministic')
+        self.private_threadpool_size = loader_params.get('private_threadpool_size', 0)
+        self.max_intra_op_parallelism = loader_params.get('max_intra_op_parallelism', 0)
+        self.autotune_ram_budget = loader_params.get('autotune_ram_budget', 0)
+        self.map_fusion = loader_params.get('map_fusion', False)
+        self.parallel_batch = loader_params.get('parallel_batch', False)
+        self.val_cache = loader_params.get('val_cache')
+        padding_buckets = parser_params.get('padding_buckets')
+        self.padding_buckets = sorted(padding_buckets) if padding_buckets is not None else None
+
+    def _get_options(self):
+        options = tf.data.Options()
+        if self.deterministic is not None:
+            options.deterministic = self.deterministic
+        if self.private_threadpool_size:
+            options.threading.private_threadpool_size = self.private_threadpool_size
+        if self.max_intra_op_parallelism:
+            options.threading.max_intra_op_parallelism = self.max_intra_op_parallelism
+        if self.autotune_ram_budget:
+            options.autotune.ram_budget = self.autotune_ram_budget
+        options.experimental_optimization.map_fusion = self.map_fusion
+        options.experimental_optimization.map_and_batch_fusion = True
+        options.experimental_optimization.parallel_batch = self.parallel_batch
+        return options
+
+    def get_device_augmentation(self):
+        """Batched augmentation to call in train_step on the training batches when device_augmentation is set"""
+        parser = coco_tfrecord_parser.Parser(anchor_instance=self.anchor_instance,
+                                             mode='train',
+                                             **self.parser_params)
+        return parser.device_augment
+
+    def num_examples(self, subset):
+        """Number of examples of a subset, read from the sidecar index written with the TFRecords"""
+        index = read_shard_index(self.tfrecord_dir, subset)
+        if index is not None and index.get('complete', True):
+            return index['num_examples']
+
+        # TFRecords created without the index, count the serialized records without decoding them
+        logging.warning(f"No index for {subset} in {self.tfrecord_dir}, counting the records...")
+        files = tf.io.matching_files(os.path.join(self.tfrecord_dir, f"{subset}.*"))
+        count = tf.data.TFRecordDataset(files).reduce(tf.constant(0, tf.int64), lambda x, _: x + 1)
+        return int(count)
+
+    @staticmethod
+    def _pad_objects_to_bucket(image, labels, buckets):
+        # round the object dimension up to the next bucket, so train_step is only traced once per bucket
+        keys = [k for k in coco_tfrecord_parser.OBJECT_KEYS if k in labels]
+        num_objects = tf.shape(labels[keys[0]])[1]
+        buckets = tf.constant(buckets, tf.int32)
+        bucket_idx = tf.searchsorted(buckets, [num_objects], side='left')[0]
+        size = tf.concat([buckets, [num_objects]], axis=0)[bucket_idx]
+
+        def _pad(x):
+            return tf.pad(x, [[0, 0], [0, size - num_objects]] + [[0, 0]] * (len(x.shape) - 2))
+
+        labels = dict(labels, **{k: _pad(labels[k]) for k in keys})
+        return image, labels
+
+    @staticmethod
+    def _pad_batch(image, labels, batch_size):
+        # pad the last partial batch to the full batch size, 'valid' marks the real examples
+        num_valid = tf.shape(image)[0]
+
+        def _pad(x):
+            x = tf.pad(x, [[0, batch_size - num_valid]] + [[0, 0]] * (len(x.shape) - 1))
+            x.set_shape([batch_size] + x.shape[1:])
+            return x
+
+        labels = {k: _pad(v) for k, v in labels.items()}
+        labels['valid'] = tf.range(batch_size) < num_valid
+        return _pad(image), labels
+
+    def get_eval_dataloader(self, subset, batch_size):
+        """val / test loader with fixed batch shape, the last batch is padded and labels['valid'] marks the
+        real examples"""
+        if subset == 'train':
+            raise ValueError('Eval dataloader is for val or test subset.')
+        return self.get_dataloader(subset, batch_size, pad_last_batch=True)
+
+    def get_dataloader(self, subset, batch_size, pad_last_batch=False, input_context=None):
+        """
+        :param input_context: tf.distribute.InputContext when called from distribute_datasets_from_function, every
+            input pipeline reads its own part of the tfrecord files, there should be at least one file per worker
+        """
         # function for per-element transformation
         parser = coco_tfrecord_parser.Parser(anchor_instance=self.anchor_instance,
                                              mode=subset,
@@ -29,6 +118,9 @@ class ObjectDetectionDataset:
         files = tf.io.matching_files(os.path.join(self.tfrecord_dir, f"{subset}.*"))
         num_shards = tf.cast(tf.size(files), tf.int64)
         shards = tf.data.Dataset.from_tensor_slices(files)
+        if input_context is not None and input_context.num_input_pipelines > 1:
+            shards = shards.shard(input_context.num_input_pipelines, input_context.input_pipeline_id)
+            num_shards = tf.data.experimental.cardinality(shards)
 
         # apply suffle and repeat only on traininig data
         if subset == 'train':
@@ -36,16 +128,36 @@ class ObjectDetectionDataset:
             shards = shards.repeat()
             dataset = shards.interleave(tf.data.TFRecordDataset,
                                         cycle_length=num_shards,
-                                        num_parallel_calls=tf.data.experimental.AUTOTUNE)
+                                        num_parallel_calls=self.num_parallel_calls,
+                                        deterministic=self.deterministic)
             dataset = dataset.shuffle(buffer_size=2048)
-        elif subset == 'val' or 'test':
-            dataset = tf.data.TFRecordDataset(shards)
+        elif subset in ('val', 'test'):
+            # the shards are read round-robin, the deterministic interleave makes every evaluation see the same sequence
+            dataset = shards.interleave(tf.data.TFRecordDataset,
+                                        cycle_length=num_shards,
+                                        num_parallel_calls=self.num_parallel_calls,
+                                        deterministic=True)
         else:
             raise ValueError('Illegal subset name.')
 
         # apply per-element transformation
-        dataset = dataset.map(map_func=parser)
-        dataset = dataset.batch(batch_size)
+        dataset = dataset.map(map_func=parser,
+                              num_parallel_calls=self.num_parallel_calls,
+                              deterministic=self.deterministic if subset == 'train' else True)
+
+        # val / test parsing has no randomness, parse only once
+        if subset != 'train' and self.val_cache is not None:
+            dataset = dataset.cache(self.val_cache)
+
+        if self.padding_buckets is not None:
+            # samples keep their own number of objects, pad to the largest one of the batch
+            dataset = dataset.padded_batch(batch_size)
+            dataset = dataset.map(lambda image, labels: self._pad_objects_to_bucket(image, labels,
+                                                                                    self.padding_buckets))
+        else:
+            dataset = dataset.batch(batch_size)
+        if pad_last_batch:
+            dataset = dataset.map(lambda image, labels: self._pad_batch(image, labels, batch_size))
         dataset = dataset.prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
 
-        return dataset
+        return dataset.with_options(self._get_options())
@@ -10,12 +10,20 @@ Example usage:
       --train_annotations_file="${TRAIN_ANNOTATIONS_FILE}" \
       --val_annotations_file="${VAL_ANNOTATIONS_FILE}" \
       --testdev_annotations_file="${TESTDEV_ANNOTATIONS_FILE}" \
-      --output_dir="${OUTPUT_DIR}"
+      --output_dir="${OUTPUT_DIR}" \
+      --num_workers=16
+
+With --num_workers > 1 every shard is converted by a worker process. Finished shards are recorded in
+{subset}_index.json, so an interrupted conversion resumes from them.
+With --mask_format=rle masks of the val records are stored as COCO RLE counts instead of one PNG per instance,
+which makes the records smaller and much cheaper to decode at proto size. The train records always store PNG masks,
+the training augmentation needs the masks at full size, where RLE decodes about 3x slower than PNG.
 Adapted from: https://github.com/tensorflow/models/blob/master/research/object_detection/dataset_tools/create_coco_tf_record.py
 """
 import hashlib
 import io
 import json
+import multiprocessing
 import os
 
 import PIL.Image
@@ -33,6 +41,9 @@ FLAGS = flags.FLAGS
 
 flags.DEFINE_boolean('include_masks', True,
                      'Whether to include instance segmentations masks (PNG encoded) in the result. default: False.')
+flags.DEFINE_enum('mask_format', 'png', ['png', 'rle'],
+                  'Encoding of instance masks of the val records, one PNG per instance or uncompressed COCO RLE '
+                  'counts. Train records are always PNG.')
 flags.DEFINE_string('train_image_dir', 'train2017',
                     'Training image directory.')
 flags.DEFINE_string('val_image_dir', 'val2017',
@@ -46,11 +57,15 @@ flags.DEFINE_string('val_annotations_file', './annotations/instances_val2017.jso
 flags.DEFINE_string('testdev_annotations_file', '',
                     'Test-dev annotations JSON file.')
 flags.DEFINE_string('output_dir', './coco', 'Output data directory.')
+flags.DEFINE_integer('num_workers', 1,
+                     'Number of processes converting shards in parallel.')
+flags.DEFINE_boolean('resume', True,
+                     'Whether to keep the shards finished by an interrupted conversion with the same settings.')
 
 logging.set_verbosity(logging.INFO)
 
 
-def create_tf_example(image, annotations_list, image_dir, category_index, include_masks=True):
+def create_tf_example(image, annotations_list, image_dir, category_index, include_masks=True, mask_format='png'):
     """Converts image and annotations to a tf.Example proto.
 
     Args:
@@ -73,6 +88,8 @@ def create_tf_example(image, annotations_list, image_dir, category_index, includ
         label_map_util.create_category_index function.
       include_masks: Whether to include instance segmentations masks
         (PNG encoded) in the result. default: False.
+      mask_format: 'png' stores one PNG per instance, 'rle' stores the uncompressed
+        column major COCO RLE counts of all instances in one int64 list.
     Returns:
       example: The converted tf.Example
       num_annotations_skipped: Number of (invalid) annotations that were ignored.
@@ -101,6 +118,8 @@ def create_tf_example(image, annotations_list, image_dir, category_index, includ
     category_ids = []
     area = []
     encoded_mask_png = []
+    mask_rle = []
+    mask_rle_length = []
     num_annotations_skipped = 0
 
     for object_annotations in annotations_list:
@@ -139,10 +158,15 @@ def create_tf_example(image, annotations_list, image_dir, category_index, includ
             if not object_annotations['iscrowd']:
                 if binary_mask.ndim == 3:  # for COCO dataset
                     binary_mask = np.amax(binary_mask, axis=2)
-            pil_image = PIL.Image.fromarray(binary_mask)
-            output_io = io.BytesIO()
-            pil_image.save(output_io, format='PNG')
-            encoded_mask_png.append(output_io.getvalue())
+            if mask_format == 'rle':
+                counts = binary_mask_to_rle_counts(binary_mask)
+                mask_rle.extend(counts)
+                mask_rle_length.append(len(counts))
+            else:
+                pil_image = PIL.Image.fromarray(binary_mask)
+                output_io = io.BytesIO()
+                pil_image.save(output_io, format='PNG')
+                encoded_mask_png.append(output_io.getvalue())
 
     feature_dict = {
         'image/height':
@@ -176,14 +200,56 @@ def create_tf_example(image, annotations_list, image_dir, category_index, includ
         'image/object/area':
             float_list_feature(area),
     }
-    if include_masks:
+    if include_masks and mask_format == 'rle':
+        feature_dict['image/object/mask/rle'] = int64_list_feature(mask_rle)
+        feature_dict['image/object/mask/rle_length'] = int64_list_feature(mask_rle_length)
+    elif include_masks:
         feature_dict['image/object/mask'] = (bytes_list_feature(encoded_mask_png))
 
     example = tf.train.Example(features=tf.train.Features(feature=feature_dict))
     return key, example, num_annotations_skipped
 
 
-def _create_tf_record_from_coco_annotations(annotations_file, image_dir, output_path, include_masks, num_shards):
+def _create_tf_record_shard(shard_path, shard_images, image_dir, category_index, include_masks, mask_format):
+    """Converts the images of one shard and writes them to a TFRecord file.
+
+    Args:
+      shard_path: Path to the output shard.
+      shard_images: list of (image, annotations_list) tuples of this shard.
+      image_dir: Directory containing the image files.
+      category_index: a dict containing COCO category information keyed
+        by the 'id' field of each category.
+      include_masks: Whether to include instance segmentations masks
+        (PNG encoded) in the result.
+      mask_format: 'png' or 'rle', see create_tf_example.
+    Returns:
+      shard_name: file name of the shard.
+      num_examples: number of examples written in the shard.
+      num_annotations_skipped: Number of (invalid) annotations that were ignored.
+    """
+    shard_dir, shard_name = os.path.split(shard_path)
+    # write to a name not matching the "{subset}.*" pattern, rename when the shard is finished
+    tmp_path = os.path.join(shard_dir, '.tmp-' + shard_name)
+    num_examples = 0
+    num_annotations_skipped = 0
+    with tf.io.TFRecordWriter(tmp_path) as writer:
+        for image, annotations_list in shard_images:
+            _, tf_example, num_skipped = create_tf_example(
+                image, annotations_list, image_dir, category_index, include_masks, mask_format)
+            num_annotations_skipped += num_skipped
+            if tf_example:
+                writer.write(tf_example.SerializeToString())
+                num_examples += 1
+    tf.io.gfile.rename(tmp_path, shard_path, overwrite=True)
+    return shard_name, num_examples, num_annotations_skipped
+
+
+def _create_tf_record_shard_from_args(args):
+    return _create_tf_record_shard(*args)
+
+
+def _create_tf_record_from_coco_annotations(annotations_file, image_dir, output_path, include_masks, num_shards,
+                                            num_workers=1, resume=True, mask_format='png'):
     """Loads COCO annotation json files and converts to tf.Record format.
 
     Args:
@@ -193,48 +259,78 @@ def _create_tf_record_from_coco_annotations(annotations_file, image_dir, output_
       include_masks: Whether to include instance segmentations masks
         (PNG encoded) in the result. default: False.
       num_shards: number of output file shards.
+      num_workers: number of processes converting shards in parallel, 1 converts in this process.
+      resume: Whether to keep the shards finished by a previous run with the same settings.
+      mask_format: 'png' or 'rle', see create_tf_example.
     """
-    with contextlib2.ExitStack() as tf_record_close_stack, \
-            tf.io.gfile.GFile(annotations_file, 'r') as fid:
-        output_tfrecords = open_sharded_output_tfrecords(tf_record_close_stack, output_path, num_shards)
+    with tf.io.gfile.GFile(annotations_file, 'r') as fid:
         groundtruth_data = json.load(fid)
-        images = groundtruth_data['images']
-        category_index = create_category_index(groundtruth_data['categories'])
-
-        annotations_index = {}
-        if 'annotations' in groundtruth_data:
-            logging.info(
-                'Found groundtruth annotations. Building annotations index.')
-            for annotation in groundtruth_data['annotations']:
-                image_id = annotation['image_id']
-                if image_id not in annotations_index:
-                    annotations_index[image_id] = []
-                annotations_index[image_id].append(annotation)
-        missing_annotation_count = 0
-        for image in images:
-            image_id = image['id']
+    images = groundtruth_data['images']
+    category_index = create_category_index(groundtruth_data['categories'])
+
+    annotations_index = {}
+    if 'annotations' in groundtruth_data:
+        logging.info(
+            'Found groundtruth annotations. Building annotations index.')
+        for annotation in groundtruth_data['annotations']:
+            image_id = annotation['image_id']
             if image_id not in annotations_index:
-                missing_annotation_count += 1
                 annotations_index[image_id] = []
-        logging.info('%d images are missing annotations.',
-                     missing_annotation_count)
+            annotations_index[image_id].append(annotation)
+    missing_annotation_count = 0
+    for image in images:
+        image_id = image['id']
+        if image_id not in annotations_index:
+            missing_annotation_count += 1
+            annotations_index[image_id] = []
+    logging.info('%d images are missing annotations.',
+                 missing_annotation_count)
+
+    # images are distributed round robin over the shards
+    shard_images = [[] for _ in range(num_shards)]
+    for idx, image in enumerate(images):
+        annotations_list = annotations_index[image['id']]
+        if len(annotations_list) > 0:
+            shard_images[idx % num_shards].append((image, annotations_list))
+        else:
+            logging.info('Ignore Image with no annotations')
+
+    output_dir, output_name = os.path.split(output_path)
+    subset = output_name.split('.')[0]
+    shard_names = ['{}-{:05d}-of-{:05d}'.format(output_name, idx, num_shards) for idx in range(num_shards)]
+
+    # the index of the subset is the manifest of finished shards, resume only if the settings are the same
+    manifest = {'annotations_file': os.path.abspath(annotations_file), 'include_masks': include_masks,
+                'mask_format': mask_format}
+    finished_shards = {}
+    index = read_shard_index(output_dir, subset)
+    if resume and index is not None and index.get('num_shards') == num_shards and \
+            all(index.get(k) == v for k, v in manifest.items()):
+        finished_shards = {name: count for name, count in index['shards'].items()
+                           if tf.io.gfile.exists(os.path.join(output_dir, name))}
+        logging.info('Resuming %s, %d of %d shards are finished.', subset, len(finished_shards), num_shards)
+
+    tasks = [(os.path.join(output_dir, shard_name), shard_images[idx], image_dir, category_index, include_masks,
+              mask_format) for idx, shard_name in enumerate(shard_names) if shard_name not in finished_shards]
+
+    with contextlib2.ExitStack() as pool_close_stack:
+        if num_workers > 1:
+            # spawn instead of fork, tensorflow runtime is not fork safe
+            pool = pool_close_stack.enter_context(multiprocessing.get_context('spawn').Pool(num_workers))
+            results = pool.imap_unordered(_create_tf_record_shard_from_args, tasks)
+        else:
+            results = map(_create_tf_record_shard_from_args, tasks)
 
         total_num_annotations_skipped = 0
-        for idx, image in enumerate(images):
-            if idx % 100 == 0:
-                logging.info('On image %d of %d', idx, len(images))
-            annotations_list = annotations_index[image['id']]
-            if len(annotations_list) > 0:
-                _, tf_example, num_annotations_skipped = create_tf_example(
-                    image, annotations_list, image_dir, category_index, include_masks)
-                total_num_annotations_skipped += num_annotations_skipped
-                shard_idx = idx % num_shards
-                if tf_example:
-                    output_tfrecords[shard_idx].write(tf_example.SerializeToString())
-            else:
-                logging.info('Ignore Image with no annotations')
-        logging.info('Finished writing, skipped %d annotations.',
-                     total_num_annotations_skipped)
+        for shard_name, num_examples, num_annotations_skipped in results:
+            total_num_annotations_skipped += num_annotations_skipped
+            finished_shards[shard_name] = num_examples
+            # record the finished shard right away, so an interrupted conversion can resume from it
+            write_shard_index(output_dir, subset, finished_shards, num_shards, **manifest)
+            logging.info('Finished shard %s, %d of %d shards done.', shard_name, len(finished_shards), num_shards)
+
+    logging.info('Finished writing, skipped %d annotations.',
+                 total_num_annotations_skipped)
 
 
 def main(_):
@@ -256,14 +352,21 @@ def main(_):
         FLAGS.train_image_dir,
         train_output_path,
         FLAGS.include_masks,
-        num_shards=100)
+        num_shards=100,
+        num_workers=FLAGS.num_workers,
+        resume=FLAGS.resume,
+        # masks are augmented at full size, where decoding RLE is slower than PNG
+        mask_format='png')
 
     _create_tf_record_from_coco_annotations(
         FLAGS.val_annotations_file,
         FLAGS.val_image_dir,
         val_output_path,
         FLAGS.include_masks,
-        num_shards=50)
+        num_shards=50,
+        num_workers=FLAGS.num_workers,
+        resume=FLAGS.resume,
+        mask_format=FLAGS.mask_format)
     """
     _create_tf_record_from_coco_annotations(
         FLAGS.testdev_annotations_file,
@@ -5,12 +5,18 @@ import tensorflow as tf
 
 
 class TfExampleDecoder(object):
-    def __init__(self):
+    def __init__(self, mask_size=None):
+        """
+        :param mask_size: if set, RLE masks are sampled directly at [mask_size, mask_size] instead of decoded at
+            image size, only valid when no geometric augmentation is applied before resizing the masks
+        """
+        self._mask_size = mask_size
         self._keys_to_features = {
             # I only take the key we need for this model
             'image/height': tf.io.FixedLenFeature([], dtype=tf.int64),
             'image/width': tf.io.FixedLenFeature([], dtype=tf.int64),
             'image/encoded': tf.io.FixedLenFeature([], dtype=tf.string),
+            'image/source_id': tf.io.FixedLenFeature([], dtype=tf.string, default_value=''),
             'image/object/bbox/xmin': tf.io.VarLenFeature(dtype=tf.float32),
             'image/object/bbox/xmax': tf.io.VarLenFeature(dtype=tf.float32),
             'image/object/bbox/ymin': tf.io.VarLenFeature(dtype=tf.float32),
@@ -18,6 +24,9 @@ class TfExampleDecoder(object):
             'image/object/class/label_id': tf.io.VarLenFeature(dtype=tf.int64),
             'image/object/is_crowd': tf.io.VarLenFeature(dtype=tf.int64),
             'image/object/mask': tf.io.VarLenFeature(dtype=tf.string),
+            # uncompressed COCO RLE counts of all instances and the number of counts of each instance
+            'image/object/mask/rle': tf.io.VarLenFeature(dtype=tf.int64),
+            'image/object/mask/rle_length': tf.io.VarLenFeature(dtype=tf.int64),
         }
 
     def _decode_image(self, parsed_tensors):
@@ -38,11 +47,43 @@ class TfExampleDecoder(object):
         xmax = parsed_tensors['image/object/bbox/xmax']
         return tf.stack([ymin, xmin, ymax, xmax], axis=-1)
 
+    def _decode_rle_masks(self, parsed_tensors):
+        height = tf.cast(parsed_tensors['image/height'], tf.int32)
+        width = tf.cast(parsed_tensors['image/width'], tf.int32)
+        counts = tf.cast(parsed_tensors['image/object/mask/rle'], tf.int32)
+        lengths = tf.cast(parsed_tensors['image/object/mask/rle_length'], tf.int32)
+        num_masks = tf.size(lengths)
+
+        if self._mask_size is None:
+            # runs alternate 0 / 1 starting from 0, so the value flips at the end of every run.
+            # every instance sums to height * width, the end of a run within its instance is the running sum
+            # minus the pixels of the previous instances
+            num_pixels = height * width
+            mask_ids = tf.ragged.range(lengths).value_rowids()
+            run_ends = tf.cumsum(counts) - tf.cast(mask_ids, tf.int32) * num_pixels
+            flips = tf.scatter_nd(tf.stack([tf.cast(mask_ids, tf.int32), run_ends], axis=-1),
+                                  tf.ones_like(run_ends, dtype=tf.uint8), [num_masks, num_pixels + 1])
+            # parity of the uint8 running sum survives the overflow
+            masks = tf.math.cumsum(flips[:, :-1], axis=1) % 2
+            masks = tf.transpose(tf.reshape(masks, [num_masks, width, height]), perm=[0, 2, 1])
+        else:
+            # sample the pixel centers of the output grid, the run containing a pixel tells its value
+            # zero padded counts keep the end of the last run, height * width, so they are never searched
+            run_ends = tf.cumsum(tf.RaggedTensor.from_row_lengths(counts, lengths).to_tensor(), axis=1)
+            ys = tf.cast((tf.range(self._mask_size, dtype=tf.float32) + 0.5) *
+                         tf.cast(height, tf.float32) / self._mask_size, tf.int32)
+            xs = tf.cast((tf.range(self._mask_size, dtype=tf.float32) + 0.5) *
+                         tf.cast(width, tf.float32) / self._mask_size, tf.int32)
+            pixel_idx = tf.reshape(tf.expand_dims(ys, -1) + tf.expand_dims(xs, 0) * height, [1, -1])
+            run_idx = tf.searchsorted(run_ends, tf.tile(pixel_idx, [num_masks, 1]), side='right')
+            masks = tf.reshape(tf.cast(run_idx % 2, tf.uint8), [num_masks, self._mask_size, self._mask_size])
+        return masks
+
     def _decode_masks(self, parsed_tensors):
+        # masks stay uint8 through the augmentation, they are only converted to float when resized to proto size
         def _decode_png_mask(png_bytes):
             mask = tf.squeeze(
                 tf.io.decode_png(png_bytes, channels=1, dtype=tf.uint8), axis=-1)
-            mask = tf.cast(mask, dtype=tf.float32)
             mask.set_shape([None, None])
             return mask
 
@@ -51,8 +92,8 @@ class TfExampleDecoder(object):
         masks = parsed_tensors['image/object/mask']
         return tf.cond(
             pred=tf.greater(tf.size(input=masks), 0),
-            true_fn=lambda: tf.map_fn(_decode_png_mask, masks, dtype=tf.float32),
-            false_fn=lambda: tf.zeros([0, height, width], dtype=tf.float32))
+            true_fn=lambda: tf.map_fn(_decode_png_mask, masks, dtype=tf.uint8),
+            false_fn=lambda: tf.zeros([0, height, width], dtype=tf.uint8))
 
     def decode(self, serialized_example):
         parsed_tensors = tf.io.parse_single_example(
@@ -71,7 +112,10 @@ class TfExampleDecoder(object):
 
         image = self._decode_image(parsed_tensors)
         boxes = self._decode_boxes(parsed_tensors)
-        masks = self._decode_masks(parsed_tensors)
+        masks = tf.cond(
+            tf.greater(tf.size(parsed_tensors['image/object/mask/rle_length']), 0),
+            lambda: self._decode_rle_masks(parsed_tensors),
+            lambda: self._decode_masks(parsed_tensors))
         is_crowds = tf.cond(
             tf.greater(tf.shape(parsed_tensors['image/object/is_crowd']), 0),
             lambda: tf.cast(parsed_tensors['image/object/is_crowd'], dtype=tf.bool),
@@ -79,6 +123,7 @@ class TfExampleDecoder(object):
 
         decoded_tensors = {
             'image': image,
+            'source_id': parsed_tensors['image/source_id'],
             'height': parsed_tensors['image/height'],
             'width': parsed_tensors['image/width'],
             'gt_classes': parsed_tensors['image/object/class/label_id'],
@@ -1,7 +1,11 @@
 import tensorflow as tf
 
 from data.coco_tfrecord_decoder import TfExampleDecoder
-from utils.augmentation import SSDAugmentation
+from utils.augmentation import BatchedAugmentation, SSDAugmentation
+
+# labels with a leading object dimension, padded together when batching
+OBJECT_KEYS = ('bbox', 'bbox_for_norm', 'classes', 'mask_target', 'match_bbox', 'match_classes',
+               'raw_bbox', 'raw_classes', 'raw_is_crowd', 'raw_masks')
 
 
 class Parser(object):
@@ -9,13 +13,30 @@ class Parser(object):
 
         self._mode = mode
         self._is_training = (mode == "train")
-        self._example_decoder = TfExampleDecoder()
         self._anchor_instance = anchor_instance
         self.output_size = parser_params['output_size']
         self.proto_out_size = parser_params['proto_out_size']
         self.num_max_padding = parser_params['num_max_padding']
+        # leave the object dimension unpadded, the loader pads each batch to its largest object count
+        self.dynamic_padding = parser_params.get('padding_buckets') is not None
         self.matching_params = parser_params['matching_params']
         self.augmentation_params = parser_params['augmentation_params']
+        # add the resized original image and the pixel boxes of training data, for visualization only
+        self.debug = parser_params.get('debug', False)
+        # emit padded annotations only and let train_step do the matching for the whole batch
+        self.matching_on_device = parser_params.get('matching_on_device', False)
+        # only decode and resize training data, augmentation and matching are done for the batch in train_step
+        self.device_augmentation = parser_params.get('device_augmentation', False) and self._is_training
+        self.device_mask_size = parser_params.get('device_mask_size', self.proto_out_size)
+
+        # without geometric augmentation, RLE masks can be decoded directly at the needed size
+        if self.device_augmentation:
+            mask_size = self.device_mask_size
+        elif self._is_training:
+            mask_size = None
+        else:
+            mask_size = self.proto_out_size
+        self._example_decoder = TfExampleDecoder(mask_size=mask_size)
 
         if parser_params['label_map'] is not None:
             keys = list(parser_params['label_map'].keys())
@@ -27,7 +48,10 @@ class Parser(object):
         else:
             self.dict_tensor = None
 
-        if mode == "train":
+        if mode == "train" and self.device_augmentation:
+            self._device_augmentor = BatchedAugmentation(**self.augmentation_params)
+            self._parse_fn = self._parse_device_train_data
+        elif mode == "train":
             self._parse_fn = self._parse_train_data
         elif mode == "val":
             self._parse_fn = self._parse_eval_data
@@ -58,8 +82,9 @@ class Parser(object):
             classes = tf.cast(classes, tf.int64)
 
         # return original image for testing augmentation purpose
-        original_img = tf.image.convert_image_dtype(tf.identity(image), tf.float32)
-        original_img = tf.image.resize(original_img, [self.output_size, self.output_size])
+        if self.debug:
+            original_img = tf.image.convert_image_dtype(tf.identity(image), tf.float32)
+            original_img = tf.image.resize(original_img, [self.output_size, self.output_size])
 
         # put crowd annotation after non_crowd annotation
         crowd_idx = tf.where(is_crowds == True)[:, 0]
@@ -74,6 +99,7 @@ class Parser(object):
         # Data Augmentation, Normalization, and Resize
         augmentor = SSDAugmentation(mode=mode, **self.augmentation_params)
         image, masks, norm_boxes, classes, is_crowds = augmentor(image, masks, boxes, classes, is_crowds)
+        masks.set_shape([None, self.proto_out_size, self.proto_out_size])
 
         # Calculate num of crowd annotation here
         num_crowd = tf.reduce_sum(tf.cast(is_crowds, tf.int32))
@@ -84,9 +110,23 @@ class Parser(object):
         # resized boxes for proto output size (for mask loss)
         boxes_norm = norm_boxes * self.proto_out_size
 
-        # matching anchors
-        cls_targets, box_targets, max_id_for_anchors, match_positiveness = self._anchor_instance.matching(
-            boxes, classes, num_crowd, **self.matching_params)
+        if self.matching_on_device:
+            # annotations for matching, crowd included
+            match_targets = {
+                'match_bbox': self._pad_objects(boxes),
+                'match_classes': self._pad_objects(classes),
+                'match_num_obj': tf.shape(classes)[0]
+            }
+        else:
+            # matching anchors
+            cls_targets, box_targets, max_id_for_anchors, match_positiveness = self._anchor_instance.matching(
+                boxes, classes, num_crowd, **self.matching_params)
+            match_targets = {
+                'cls_targets': cls_targets,
+                'box_targets': box_targets,
+                'positiveness': match_positiveness,
+                'max_id_for_anchors': max_id_for_anchors
+            }
 
         if mode == 'train' and num_crowd > 0:
             # if num_crowd > 0:
@@ -106,31 +146,102 @@ class Parser(object):
         """
 
         # Padding classes and mask to fix length [batch_size, num_max_fix_padding, ...]
-        num_padding = self.num_max_padding - tf.shape(classes)[0]
-        pad_classes = tf.zeros([num_padding], dtype=tf.int64)
-        pad_boxes = tf.zeros([num_padding, 4])
-        pad_masks = tf.zeros([num_padding, self.proto_out_size, self.proto_out_size])
-
-        masks = tf.concat([masks, pad_masks], axis=0)
-        classes = tf.concat([classes, pad_classes], axis=0)
-        boxes = tf.concat([boxes, pad_boxes], axis=0)
-        boxes_norm = tf.concat([boxes_norm, pad_boxes], axis=0)
+        masks = self._pad_objects(masks)
+        classes = self._pad_objects(classes)
+        boxes = self._pad_objects(boxes)
+        boxes_norm = self._pad_objects(boxes_norm)
 
         labels = {
-            'cls_targets': cls_targets,
-            'box_targets': box_targets,
             'bbox': boxes,
             'bbox_for_norm': boxes_norm,
-            'positiveness': match_positiveness,
             'classes': classes,
             'num_obj': num_obj,
             'num_crowd': num_crowd,
-            'mask_target': masks,
-            'max_id_for_anchors': max_id_for_anchors,
-            'ori': original_img
+            'mask_target': masks
+        }
+        labels.update(match_targets)
+        if mode != 'train':
+            # id and size of the original image, to write the detections in COCO results format
+            labels['image_id'] = data['source_id']
+            labels['height'] = data['height']
+            labels['width'] = data['width']
+        if self.debug:
+            labels['ori'] = original_img
+        elif mode == 'train':
+            # only used by evaluation and visualization, loss works on bbox_for_norm
+            labels.pop('bbox')
+        return image, labels
+
+    def _parse_device_train_data(self, data):
+        # decode and resize only, see device_augment
+        image = data['image']
+        classes = data['gt_classes']
+        boxes = data['gt_bboxes']
+        masks = data['gt_masks']
+        is_crowds = data['gt_is_crowd']
+
+        if self.dict_tensor is not None:
+            classes = tf.cast(self.dict_tensor.lookup(tf.cast(classes, tf.int32)), tf.int64)
+
+        # put crowd annotation after non_crowd annotation
+        idxs = tf.concat([tf.where(tf.logical_not(is_crowds))[:, 0], tf.where(is_crowds)[:, 0]], axis=0)
+        classes = tf.gather(classes, idxs)
+        boxes = tf.gather(boxes, idxs)
+        masks = tf.gather(masks, idxs)
+        is_crowds = tf.gather(is_crowds, idxs)
+
+        # keep uint8 to transfer less to the device
+        aspect_ratio = tf.cast(tf.shape(image)[0] / tf.shape(image)[1], tf.float32)
+        image = tf.image.resize(image, [self.output_size, self.output_size])
+        image = tf.cast(tf.clip_by_value(image + 0.5, 0., 255.), tf.uint8)
+        masks = tf.image.resize(tf.expand_dims(masks, -1), [self.device_mask_size, self.device_mask_size])
+        masks = tf.cast(tf.squeeze(masks + 0.5, -1), tf.uint8)
+
+        labels = {
+            'raw_bbox': self._pad_objects(boxes),
+            'raw_classes': self._pad_objects(classes),
+            'raw_is_crowd': self._pad_objects(is_crowds),
+            'raw_masks': self._pad_objects(masks),
+            'raw_num_obj': tf.shape(classes)[0],
+            'raw_aspect_ratio': aspect_ratio
+        }
+        return image, labels
+
+    def device_augment(self, image, labels):
+        """
+        Augment a batch from the parser with device_augmentation, meant to be called inside train_step.
+        Labels have the same keys as the parser output with matching_on_device.
+        """
+        image, masks, norm_boxes, classes, is_crowds, num_obj = self._device_augmentor(
+            image, labels['raw_masks'], labels['raw_bbox'], labels['raw_classes'], labels['raw_is_crowd'],
+            labels['raw_num_obj'], labels['raw_aspect_ratio'])
+        num_crowd = tf.reduce_sum(tf.cast(is_crowds, tf.int32), axis=-1)
+
+        # crowd annotation is only used for matching, drop it like the parser does
+        non_crowd = tf.range(tf.shape(classes)[1])[None, :] < (num_obj - num_crowd)[:, None]
+        non_crowd_float = tf.cast(non_crowd, tf.float32)
+        labels = {
+            'match_bbox': norm_boxes * self.output_size,
+            'match_classes': classes,
+            'match_num_obj': num_obj,
+            'bbox': norm_boxes * self.output_size * non_crowd_float[..., None],
+            'bbox_for_norm': norm_boxes * self.proto_out_size * non_crowd_float[..., None],
+            'classes': classes * tf.cast(non_crowd, classes.dtype),
+            'num_obj': num_obj - num_crowd,
+            'num_crowd': num_crowd,
+            'mask_target': masks * non_crowd_float[..., None, None]
         }
+        if not self.debug:
+            labels.pop('bbox')
         return image, labels
 
+    def _pad_objects(self, x):
+        # zero pad the object dimension to num_max_padding, unless the loader pads per batch
+        if self.dynamic_padding:
+            return x
+        paddings = [[0, self.num_max_padding - tf.shape(x)[0]]] + [[0, 0]] * (len(x.shape) - 1)
+        return tf.pad(x, paddings)
+
     def _parse_train_data(self, data):
         return self._parse_common(data, 'train')
 
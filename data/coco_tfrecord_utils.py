@@ -1,3 +1,7 @@
+import json
+import os
+
+import numpy as np
 import tensorflow as tf
 
 
@@ -35,6 +39,18 @@ def int64_list_feature(value):
     return tf.train.Feature(int64_list=tf.train.Int64List(value=value))
 
 
+def binary_mask_to_rle_counts(binary_mask):
+    """Returns the uncompressed COCO RLE counts of a [height, width] binary mask.
+  Runs are counted in column major order and start with a run of zeros, same as pycocotools.
+  """
+    pixels = (binary_mask.flatten(order='F') > 0).astype(np.int8)
+    run_starts = np.flatnonzero(pixels[1:] != pixels[:-1]) + 1
+    counts = np.diff(np.concatenate([[0], run_starts, [pixels.size]]))
+    if pixels.size > 0 and pixels[0] == 1:
+        counts = np.concatenate([[0], counts])
+    return counts.tolist()
+
+
 def open_sharded_output_tfrecords(exit_stack, base_path, num_shards):
     """Opens all TFRecord shards for writing and adds them to an exit stack.
   Args:
@@ -58,6 +74,44 @@ def open_sharded_output_tfrecords(exit_stack, base_path, num_shards):
     return tfrecords
 
 
+def shard_index_path(tfrecord_dir, subset):
+    """Path of the sidecar index of a subset, named so it does not match the "{subset}.*" shard pattern"""
+    return os.path.join(tfrecord_dir, f"{subset}_index.json")
+
+
+def write_shard_index(tfrecord_dir, subset, shards, num_shards, **manifest):
+    """Writes the number of examples of every finished shard next to the TFRecords.
+  The index is also the manifest of an interrupted conversion, it is complete when every shard is listed.
+  Args:
+    tfrecord_dir: directory of the TFRecord shards
+    subset: name of the subset, e.g. train, val
+    shards: dict of finished shard file name to the number of examples written in it
+    num_shards: total number of shards of the subset
+    **manifest: extra settings of the conversion, used to decide if it can be resumed
+  """
+    index = {
+        'num_examples': int(sum(shards.values())),
+        'num_shards': num_shards,
+        'complete': len(shards) == num_shards,
+        'shards': {name: int(shards[name]) for name in sorted(shards)}
+    }
+    index.update(manifest)
+    # write then rename, an interrupted write never leaves a broken manifest
+    index_path = shard_index_path(tfrecord_dir, subset)
+    with tf.io.gfile.GFile(index_path + '.tmp', 'w') as fid:
+        json.dump(index, fid, indent=2)
+    tf.io.gfile.rename(index_path + '.tmp', index_path, overwrite=True)
+
+
+def read_shard_index(tfrecord_dir, subset):
+    """Returns the sidecar index of a subset, None if it was not created"""
+    index_path = shard_index_path(tfrecord_dir, subset)
+    if not tf.io.gfile.exists(index_path):
+        return None
+    with tf.io.gfile.GFile(index_path, 'r') as fid:
+        return json.load(fid)
+
+
 def create_category_index(categories):
     """Creates dictionary of COCO compatible categories keyed by category id.
     Args:
@@ -1,16 +1,33 @@
 """
 Mostly adapted from: https://github.com/dbolya/yolact/blob/master/eval.py
+Evaluate saved weights or a checkpoint on a tfrecord subset:
+    python -m eval -name coco -tfrecord_dir ./data -weights ./checkpoints
+or measure the latency of every inference stage:
+    python -m eval -name coco -tfrecord_dir ./data -weights ./checkpoints -benchmark -benchmark_json latency.json
 """
+import json
+import os
+import time
 from collections import OrderedDict
 
+import numpy as np
 import tensorflow as tf
 from absl import app
+from absl import flags
+from absl import logging
 from tensorflow.keras.utils import Progbar
 
+from config import CLASS_NAMES, LABEL_MAP, MASK_IOU_MODE, MASK_IOU_SIZE, get_params
+from data.coco_dataset import ObjectDetectionDataset
 from utils.APObject import APObject, Detections
-from utils.utils import jaccard, mask_iou, postprocess
+from utils.utils import jaccard, mask_iou, packed_mask_iou, postprocess
+from yolact import Yolact
+
+FLAGS = flags.FLAGS
 
 iou_thresholds = [x / 100 for x in range(50, 100, 5)]
+# stages timed by prep_benchmarks
+BENCHMARK_STAGES = ('backbone', 'fpn', 'protonet', 'prediction_head', 'detect', 'postprocess')
 
 
 # for calculating IOU between gt and detection box
@@ -21,9 +38,11 @@ def _bbox_iou(bbox1, bbox2, is_crowd=False):
 
 
 # for calculating IOU between gt and detection mask
-def _mask_iou(mask1, mask2, is_crowd=False):
+def _mask_iou(mask1, mask2, is_crowd=False, mode="full"):
+    if mode == "packed":
+        return packed_mask_iou(np.asarray(mask1), np.asarray(mask2), is_crowd)
     ret = mask_iou(mask1, mask2, is_crowd)
-    return ret
+    return ret.numpy()
 
 
 # ref from original arthor
@@ -61,6 +80,30 @@ def calc_map(ap_data, num_cls):
     return all_maps
 
 
+def calc_class_map(ap_data, num_cls, class_names):
+    """Box and mask AP of every class averaged over the iou thresholds, for the classes with gt or detection"""
+    class_maps = OrderedDict()
+    for _class in range(1, num_cls):
+        aps = {}
+        for iou_type in ('box', 'mask'):
+            ap_objs = [ap_data[iou_type][iou_idx][_class] for iou_idx in range(len(iou_thresholds))]
+            if not ap_objs[0].is_empty():
+                aps[iou_type] = sum(ap_obj.get_ap() for ap_obj in ap_objs) / len(ap_objs) * 100
+        if aps:
+            name = class_names[_class - 1] if _class - 1 < len(class_names) else str(_class)
+            class_maps[name] = aps
+
+    make_row = lambda vals: '%20s | %6s | %6s |' % tuple(vals)
+    tf.print()
+    tf.print(make_row(['class', 'box', 'mask']))
+    tf.print('-' * 41)
+    for name, aps in class_maps.items():
+        tf.print(make_row([name] + ['%.2f' % aps[iou_type] if iou_type in aps else '-'
+                                    for iou_type in ('box', 'mask')]))
+    tf.print()
+    return class_maps
+
+
 # ref from original arthor
 def print_maps(all_maps):
     # Warning: hacky
@@ -77,15 +120,26 @@ def print_maps(all_maps):
 
 
 # ref from original arthor
-def prep_metrics(ap_data, dets, img, labels, detections=None, image_id=None):
-    """Mainly update the ap_data for validation table"""
+def prep_metrics(ap_data, dets, img, labels, detections=None, image_id=None, batch_idx=0, mask_iou_mode="full",
+                 mask_iou_size=None):
+    """
+    Mainly update the ap_data for validation table, for the image at batch_idx of the batch
+    :param mask_iou_mode: "full" compares float32 masks at image size, "packed" compares bit packed binary masks
+    :param mask_iou_size: size of the masks compared in "packed" mode, None for the image size
+    """
     # get the shape of image
     w = tf.shape(img)[1]
     h = tf.shape(img)[2]
     # tf.print(f"img size (w, h):{w}, {h}")
+    if mask_iou_mode not in ("full", "packed"):
+        raise ValueError(f"unknown mask_iou_mode {mask_iou_mode}")
+    if mask_iou_mode == "packed" and mask_iou_size is not None:
+        mask_size = [mask_iou_size, mask_iou_size]
+    else:
+        mask_size = [w, h]
 
     # Load prediction
-    classes, scores, boxes, masks = postprocess(dets, w, h, 0, "bilinear")
+    classes, scores, boxes, masks = postprocess(dets, w, h, batch_idx, "bilinear", mask_size=mask_size)
 
     # if no detection or only one detection
     if classes is None:
@@ -94,6 +148,10 @@ def prep_metrics(ap_data, dets, img, labels, detections=None, image_id=None):
         scores = tf.expand_dims(scores, axis=0)
         masks = tf.expand_dims(masks, axis=0)
     boxes = tf.expand_dims(boxes, axis=0)
+
+    # if output json, add things to detections objects
+    if detections is not None:
+        _add_detections(detections, dets, img, labels, batch_idx, image_id, classes, scores, boxes)
     #
     # tf.print("prep classes", tf.shape(classes))
     # tf.print("prep scores", tf.shape(scores))
@@ -108,8 +166,13 @@ def prep_metrics(ap_data, dets, img, labels, detections=None, image_id=None):
     num_obj = labels['num_obj']
 
     # convert to scalar
-    num_crowd = num_crowd.numpy()[0]
-    num_obj = num_obj.numpy()[0]
+    num_crowd = num_crowd.numpy()[batch_idx]
+    num_obj = num_obj.numpy()[batch_idx]
+
+    # keep the batch dimension of this image only
+    gt_bbox = gt_bbox[batch_idx:batch_idx + 1]
+    gt_classes = gt_classes[batch_idx:batch_idx + 1]
+    gt_masks = gt_masks[batch_idx:batch_idx + 1]
 
     if num_crowd > 0:
         split = lambda x: (x[:, num_obj - num_crowd:num_obj], x[:, :num_obj - num_crowd])
@@ -132,123 +195,196 @@ def prep_metrics(ap_data, dets, img, labels, detections=None, image_id=None):
         gt_bbox = gt_bbox[:, :num_obj]
         gt_masks = gt_masks[:, :num_obj]
 
-    # prepare data
-    classes = list(classes.numpy())
-    scores = list(scores.numpy())
-    box_scores = scores
-    mask_scores = scores
-
-    # if output json, add things to detections objects
-
-    # else
-    num_pred = len(classes)
-    num_gt = num_obj - num_crowd
-
-    # tf.print("num pred", num_pred)
-    # tf.print("num gt", num_gt)
-    #
-    # tf.print('prep gt bbox', tf.shape(gt_bbox))
-    # tf.print('prep gt classes', tf.shape(gt_classes))
-    # tf.print('prep gt masks', tf.shape(gt_masks))
-    # tf.print('prep num crowd', tf.shape(num_crowd))
-    # tf.print("prep num obj", tf.shape(num_obj))
+    # prepare data, detection classes do not count the background, gt classes do
+    classes = np.reshape(classes.numpy(), [-1]).astype(np.int64) + 1
+    scores = np.reshape(scores.numpy(), [-1])
 
     # resize gt mask
     # should be [num_gt, w, h]
-    masks_gt = tf.squeeze(tf.image.resize(tf.expand_dims(gt_masks[0], axis=-1), [h, w],
+    masks_gt = tf.squeeze(tf.image.resize(tf.expand_dims(gt_masks[0], axis=-1), mask_size,
                                           method='bilinear'), axis=-1)
 
     # calculating the IOU first
-    mask_iou_cache = _mask_iou(masks, masks_gt).numpy()
-    bbox_iou_cache = tf.squeeze(_bbox_iou(boxes, gt_bbox).numpy(), axis=0)
-    # tf.print(tf.shape(boxes))
-    # tf.print(tf.shape(gt_bbox))
-    # tf.print(tf.shape(bbox_iou_cache))
-    # tf.print("non crowd mask iou shape:", tf.shape(mask_iou_cache))
-    # tf.print("non crowd bbox iou shape:", tf.shape(bbox_iou_cache))
+    mask_iou_cache = _mask_iou(masks, masks_gt, mode=mask_iou_mode)
+    bbox_iou_cache = tf.squeeze(_bbox_iou(boxes, gt_bbox), axis=0).numpy()
 
     # If crowd label included, split it and calculate iou separately from non-crowd label
     if num_crowd > 0:
         # resize gt mask
         # should be [num_crowd, w, h]
-        gt_crowd_masks = tf.squeeze(tf.image.resize(tf.expand_dims(gt_crowd_masks[0], axis=-1), [h, w],
+        gt_crowd_masks = tf.squeeze(tf.image.resize(tf.expand_dims(gt_crowd_masks[0], axis=-1), mask_size,
                                                     method='bilinear'), axis=-1)
-        # tf.print("crowd masks", tf.shape(gt_crowd_masks))
-        crowd_mask_iou_cache = _mask_iou(masks, gt_crowd_masks, is_crowd=True).numpy()
+        crowd_mask_iou_cache = _mask_iou(masks, gt_crowd_masks, is_crowd=True, mode=mask_iou_mode)
         crowd_bbox_iou_cache = tf.squeeze(
             _bbox_iou(boxes, gt_crowd_boxes, is_crowd=True), axis=0).numpy()
-        # tf.print("gt crowd mask iou shape:", tf.shape(crowd_mask_iou_cache))
-        # tf.print("gt crowd bbox iou shape:", tf.shape(crowd_bbox_iou_cache))
+        gt_crowd_classes = np.array(gt_crowd_classes)
     else:
         crowd_mask_iou_cache = None
         crowd_bbox_iou_cache = None
 
-    # get the sorted index of scores (descending order)
-    box_indices = sorted(range(num_pred), key=lambda idx: -box_scores[idx])
-    mask_indices = sorted(box_indices, key=lambda idx: -mask_scores[idx])
-
-    # define some useful lambda function for next section
-    # avoid writing "bbox_iou_cache[row, col]" too many times, wrap it as a lambda func
-    iou_types = [
-        ('box', lambda row, col: bbox_iou_cache[row, col],
-         lambda row, col: crowd_bbox_iou_cache[row, col],
-         lambda idx: box_scores[idx], box_indices),
-        ('mask', lambda row, col: mask_iou_cache[row, col],
-         lambda row, col: crowd_mask_iou_cache[row, col],
-         lambda idx: mask_scores[idx], mask_indices)]
+    # get the sorted index of scores (descending order), box and mask share the scores
+    indices = np.argsort(-scores, kind='stable')
+    gt_classes = gt_classes[0].numpy()
 
-    gt_classes = list(gt_classes[0].numpy())
+    iou_types = [('box', bbox_iou_cache, crowd_bbox_iou_cache),
+                 ('mask', mask_iou_cache, crowd_mask_iou_cache)]
 
     # starting to update the ap_data from this batch
-    for _class in set(classes + gt_classes):
-        # calculating how many labels belong to this class
-        num_gt_for_class = sum([1 for x in gt_classes if x == _class])
+    for iou_type, iou_cache, crowd_iou_cache in iou_types:
+        is_true, is_counted = _match_detections(iou_cache, classes, gt_classes, indices, crowd_iou_cache,
+                                                gt_crowd_classes if num_crowd > 0 else None)
 
-        for iouIdx in range(len(iou_thresholds)):
-            th = iou_thresholds[iouIdx]
-
-            for iou_type, iou_func, crowd_func, score_func, indices in iou_types:
-                gt_used = [False] * len(gt_classes)
+        for _class in set(classes.tolist()) | set(gt_classes.tolist()):
+            # calculating how many labels belong to this class
+            num_gt_for_class = int(np.sum(gt_classes == _class))
+            # detections of this class in descending score order
+            class_indices = indices[classes[indices] == _class]
 
+            for iouIdx in range(len(iou_thresholds)):
                 # get certain APobject
                 ap_obj = ap_data[iou_type][iouIdx][_class]
                 ap_obj.add_gt_positive(num_gt_for_class)
 
-                for i in indices:
-                    if classes[i] != _class:
-                        continue
-
-                    max_iou_found = th
-                    max_match_idx = -1
-
-                    for j in range(num_gt):
-                        if gt_used[j] or gt_classes[j] != _class:
-                            continue
-                        iou = iou_func(i, j)
-                        if iou > max_iou_found:
-                            max_iou_found = iou
-                            max_match_idx = j
-                    if max_match_idx >= 0:
-                        gt_used[max_match_idx] = True
-                        ap_obj.push(score_func(i), True)
-                    else:
-                        matched_crowd = False
-                        if num_crowd > 0:
-                            for j in range(len(gt_crowd_classes)):
-                                if gt_crowd_classes[j] != _class:
-                                    continue
-                                iou = crowd_func(i, j)
-
-                                if iou > th:
-                                    matched_crowd = True
-                                    break
-                        # for crowd annotation, if no, push as false positive
-                        if not matched_crowd:
-                            ap_obj.push(score_func(i), False)
-
-
-def prep_benchmarks():
-    ...
+                # detections matched to a crowd annotation are neither true nor false positive
+                pushed = class_indices[is_counted[iouIdx, class_indices]]
+                ap_obj.push_many(scores[pushed], is_true[iouIdx, pushed])
+
+
+def _add_detections(detections, dets, img, labels, batch_idx, image_id, classes, scores, boxes):
+    """Write the detections of the image at batch_idx in the size of the original image"""
+    if image_id is None:
+        image_id = labels['image_id'][batch_idx].numpy().decode('utf8')
+        # COCO image ids are integers
+        image_id = int(image_id) if image_id.isdigit() else image_id
+    height = int(labels['height'][batch_idx])
+    width = int(labels['width'][batch_idx])
+
+    # masks are postprocessed again at the original size, boxes are in pixels of the input image
+    _, _, _, masks = postprocess(dets, tf.shape(img)[1], tf.shape(img)[2], batch_idx, "bilinear",
+                                 mask_size=[height, width])
+    masks = np.reshape(masks.numpy(), [-1, height, width]).astype(np.uint8)
+    scale = np.array([height, width, height, width], dtype=np.float32) / np.array(
+        [tf.shape(img)[1], tf.shape(img)[2]] * 2, dtype=np.float32)
+    boxes = np.reshape(boxes.numpy(), [-1, 4]) * scale
+    # detection classes do not count the background
+    classes = np.reshape(classes.numpy(), [-1]) + 1
+    scores = np.reshape(scores.numpy(), [-1])
+
+    for i in range(len(scores)):
+        detections.add_box(image_id, classes[i], boxes[i], scores[i])
+        detections.add_mask(image_id, classes[i], masks[i], scores[i])
+
+
+def _match_detections(iou, classes, gt_classes, indices, crowd_iou=None, crowd_classes=None):
+    """
+    Greedy matching of the detections to the gt of the same class, for all the iou thresholds at once. In score
+    order, every detection takes the unused gt it overlaps most, if the iou is above the threshold.
+    :param iou: [num_pred, num_gt]
+    :param classes: [num_pred]
+    :param gt_classes: [num_gt]
+    :param indices: detection indices in descending score order
+    :param crowd_iou: [num_pred, num_crowd] or None
+    :param crowd_classes: [num_crowd] or None
+    :return: is_true [num_thresholds, num_pred], is_counted [num_thresholds, num_pred], False for the false
+        positives matching a crowd annotation
+    """
+    thresholds = np.array(iou_thresholds)
+    num_pred, num_gt = iou.shape
+    row = np.arange(len(thresholds))
+
+    # nan iou (empty boxes / masks) never matches
+    iou = np.where(np.isnan(iou), -1., iou)
+    other_class = classes[:, None] != gt_classes[None, :]
+
+    gt_used = np.zeros([len(thresholds), num_gt], dtype=bool)
+    is_true = np.zeros([len(thresholds), num_pred], dtype=bool)
+    if num_gt > 0:
+        for i in indices:
+            # [num_thresholds, num_gt]
+            candidates = np.where(gt_used | other_class[i], -1., iou[i])
+            best = np.argmax(candidates, axis=-1)
+            matched = candidates[row, best] > thresholds
+            gt_used[row[matched], best[matched]] = True
+            is_true[:, i] = matched
+
+    if crowd_iou is None:
+        return is_true, np.ones_like(is_true)
+
+    # [num_thresholds, num_pred, num_crowd]
+    crowd_iou = np.where(np.isnan(crowd_iou), -1., crowd_iou)
+    same_class = classes[:, None] == crowd_classes[None, :]
+    matched_crowd = np.any((crowd_iou[None] > thresholds[:, None, None]) & same_class[None], axis=-1)
+    return is_true, is_true | np.logical_not(matched_crowd)
+
+
+def prep_benchmarks(model, images, num_warmup=10, num_iterations=100):
+    """
+    Latency of every stage of the inference on the batches of images, the layers run as tf.function like in a
+    deployment. The semantic segmentation branch is skipped, it is only used by the loss
+    :param images: iterator of image batches, at least num_warmup + num_iterations of them
+    :return: dict of stage, and 'end_to_end' for all of them run again with a single sync at the end, to the
+        p50 / p95 / p99 latency of a batch in ms and the images per second
+    """
+    backbone = tf.function(model.backbone)
+    fpn = tf.function(model.backbone_fpn)
+    protonet = tf.function(model.protonet)
+
+    @tf.function
+    def prediction_head(fpn_out):
+        # all output from FPN use same prediction head
+        preds = [model.predictionHead(f_map) for f_map in fpn_out]
+        return [tf.concat(pred, axis=1) for pred in zip(*preds)]
+
+    def run_stages(image, timer):
+        c3, c4, c5 = backbone(image)
+        timer.lap('backbone', c5)
+        fpn_out = fpn(c3, c4, c5)
+        timer.lap('fpn', fpn_out)
+        proto_out = protonet(fpn_out[0])
+        timer.lap('protonet', proto_out)
+        pred_cls, pred_offset, pred_mask_coef = prediction_head(fpn_out)
+        timer.lap('prediction_head', [pred_cls, pred_offset, pred_mask_coef])
+        dets = model.detect({'pred_cls': pred_cls, 'pred_offset': pred_offset, 'pred_mask_coef': pred_mask_coef,
+                             'proto_out': proto_out})
+        timer.lap('detect', dets)
+        outputs = [postprocess(dets, tf.shape(image)[1], tf.shape(image)[2], batch_idx, "bilinear")
+                   for batch_idx in range(int(tf.shape(image)[0]))]
+        timer.lap('postprocess', outputs)
+        return outputs
+
+    latencies = {stage: [] for stage in BENCHMARK_STAGES + ('end_to_end',)}
+    batch_size = 0
+    for i in range(num_warmup + num_iterations):
+        image = next(images)
+        batch_size = int(tf.shape(image)[0])
+        stage_times = {}
+        run_stages(image, _StageTimer(stage_times))
+        # the same batch again with a single sync at the end, the syncs between the stages stall the device
+        end_to_end_timer = _StageTimer(stage_times)
+        outputs = run_stages(image, _StageTimer(None))
+        end_to_end_timer.lap('end_to_end', outputs)
+        # the first iterations trace the functions and warm up the device
+        if i >= num_warmup:
+            for stage, seconds in stage_times.items():
+                latencies[stage].append(seconds)
+
+    results = OrderedDict()
+    for stage, seconds in latencies.items():
+        p50, p95, p99 = np.percentile(np.array(seconds) * 1000, [50, 95, 99])
+        results[stage] = {'p50_ms': float(p50), 'p95_ms': float(p95), 'p99_ms': float(p99),
+                          'fps': float(batch_size / np.mean(seconds))}
+    return results
+
+
+def print_benchmarks(results, batch_size, input_size):
+    make_row = lambda vals: '%16s | %8s | %8s | %8s | %8s |' % tuple(vals)
+    tf.print()
+    tf.print(f"batch size: {batch_size}, input size: {input_size}")
+    tf.print(make_row(['stage', 'p50 ms', 'p95 ms', 'p99 ms', 'fps']))
+    tf.print('-' * 63)
+    for stage, result in results.items():
+        tf.print(make_row([stage] + ['%.2f' % result[k] for k in ('p50_ms', 'p95_ms', 'p99_ms', 'fps')]))
+    tf.print()
 
 
 def prep_display():
@@ -267,7 +403,14 @@ def eval_video():
     ...
 
 
-def evaluate(model, dataset, num_val, num_cls):
+def evaluate(model, dataset, num_val, num_cls, mask_iou_mode=MASK_IOU_MODE, mask_iou_size=MASK_IOU_SIZE,
+             detections=None, class_names=None, stage_times=None):
+    """
+    :param detections: Detections to also write the detections as COCO results json
+    :param class_names: also print the AP of every class
+    :param stage_times: dict, seconds spent in 'load', 'inference', 'detect' and 'metrics' and the number of 'images'
+        are added to it, the device is synchronized after every stage
+    """
     # if use fastnms
     # if use cross class nms
 
@@ -281,31 +424,151 @@ def evaluate(model, dataset, num_val, num_cls):
         'box': [[APObject() for _ in range(num_cls)] for _ in iou_thresholds],
         'mask': [[APObject() for _ in range(num_cls)] for _ in iou_thresholds]}
 
-    # detection object made from prediction output. for the purpose of creating json
-    detections = Detections()
-
     # iterate the whole dataset to save TP, FP, FN
     i = 0
     progbar = Progbar(num_val)
     tf.print("Evaluating...")
-    for image, labels in dataset:
-        i += 1
-        output = model(image, training=False)
-        dets = model.detect(output)
-        # update ap_data or detection depends if u want to save it to json or just for validation table
-        prep_metrics(ap_data, dets, image, labels, detections)
-        progbar.update(i)
-
-    # if to json
-    # save detection to json
+    timer = _StageTimer(stage_times)
+    try:
+        for image, labels in dataset:
+            timer.lap('load', image)
+            output = model(image, training=False)
+            timer.lap('inference', output)
+            dets = model.detect(output)
+            timer.lap('detect', dets)
+            # padded batch from the eval dataloader, skip the padding examples
+            if 'valid' in labels:
+                num_images = int(tf.reduce_sum(tf.cast(labels['valid'], tf.int32)))
+            else:
+                num_images = int(tf.shape(image)[0])
+            for batch_idx in range(num_images):
+                # update ap_data or detection depends if u want to save it to json or just for validation table
+                prep_metrics(ap_data, dets, image, labels, detections, batch_idx=batch_idx,
+                             mask_iou_mode=mask_iou_mode, mask_iou_size=mask_iou_size)
+            timer.lap('metrics')
+            if stage_times is not None:
+                stage_times['images'] = stage_times.get('images', 0) + num_images
+            i += num_images
+            progbar.update(i)
+    finally:
+        # save detection to json, also the detections so far if the evaluation fails
+        if detections is not None:
+            detections.close()
 
     # Todo if not training, save ap_data, else calc_map
+    if class_names is not None:
+        calc_class_map(ap_data, num_cls, class_names)
     return calc_map(ap_data, num_cls)
 
 
+class _StageTimer(object):
+    """Adds the seconds since the previous lap to stage_times, does nothing if stage_times is None"""
+
+    def __init__(self, stage_times):
+        self.stage_times = stage_times
+        self.last = time.perf_counter()
+
+    def lap(self, stage, outputs=None):
+        if self.stage_times is None:
+            return
+        # ops run asynchronously on GPU, wait for the stage by reading one element of its output
+        for tensor in [t for t in tf.nest.flatten(outputs) if tf.is_tensor(t)][-1:]:
+            tf.reshape(tensor, [-1])[:1].numpy()
+        now = time.perf_counter()
+        self.stage_times[stage] = self.stage_times.get(stage, 0.) + now - self.last
+        self.last = now
+
+
+def print_stage_times(stage_times):
+    num_images = max(stage_times['images'], 1)
+    total = sum(stage_times[stage] for stage in ('load', 'inference', 'detect', 'metrics'))
+    tf.print(f"{stage_times['images']} images in {total:.1f}s, {num_images / total:.2f} images/s")
+    for stage in ('load', 'inference', 'detect', 'metrics'):
+        tf.print(f"{stage:>10}: {stage_times[stage] / num_images * 1000:.1f} ms per image")
+
+
+def load_weights(model, weights, input_size):
+    """Load .h5 weights saved by train.py or the model of a checkpoint (file prefix or directory)"""
+    if weights.endswith('.h5'):
+        # build the variables before loading
+        model(tf.zeros([1, input_size, input_size, 3]), training=False)
+        model.load_weights(weights)
+        return weights
+    checkpoint_path = tf.train.latest_checkpoint(weights) if tf.io.gfile.isdir(weights) else weights
+    if checkpoint_path is None:
+        raise ValueError(f'No checkpoint in {weights}')
+    # the optimizer of the checkpoint is not needed
+    tf.train.Checkpoint(model=model).restore(checkpoint_path).expect_partial()
+    return checkpoint_path
+
+
+def define_flags():
+    # not defined on import, train.py defines the same flags
+    flags.DEFINE_string('name', 'coco',
+                        'name of dataset')
+    flags.DEFINE_string('tfrecord_dir', 'data',
+                        'directory of tfrecord')
+    flags.DEFINE_string('weights', './checkpoints',
+                        '.h5 weights, checkpoint or directory of checkpoints to evaluate, empty for initial weights')
+    flags.DEFINE_string('subset', 'val',
+                        'subset of the tfrecords to evaluate')
+    flags.DEFINE_integer('batch_size', 8,
+                         'batch size of inference')
+    flags.DEFINE_string('results_dir', '',
+                        'also write the detections to bbox_detections.json and mask_detections.json in this directory')
+    flags.DEFINE_boolean('benchmark', False,
+                         'measure the latency of every inference stage on the subset instead of the mAP')
+    flags.DEFINE_list('benchmark_batch_sizes', ['1', '8'],
+                      'batch sizes to benchmark, the input size is IMG_SIZE of config')
+    flags.DEFINE_integer('warmup_iterations', 10,
+                         'iterations before measuring the latency')
+    flags.DEFINE_integer('benchmark_iterations', 100,
+                         'iterations to measure the latency')
+    flags.DEFINE_string('benchmark_json', '',
+                        'also write the latency of every batch size to this json')
+
+
 def main(argv):
-    pass
+    # get params for model
+    _, input_size, num_cls, _, _, parser_params, model_params = get_params(FLAGS.name)
+
+    logging.info("Creating the model instance of YOLACT")
+    model = Yolact(**model_params)
+    if FLAGS.weights:
+        logging.info("Loaded weights from {}".format(load_weights(model, FLAGS.weights, input_size)))
+
+    dateset = ObjectDetectionDataset(dataset_name=FLAGS.name,
+                                     tfrecord_dir=os.path.join(FLAGS.tfrecord_dir, FLAGS.name),
+                                     anchor_instance=model.anchor_instance,
+                                     **parser_params)
+
+    if FLAGS.benchmark:
+        benchmarks = []
+        for batch_size in [int(b) for b in FLAGS.benchmark_batch_sizes]:
+            images = dateset.get_dataloader(subset=FLAGS.subset, batch_size=batch_size, pad_last_batch=True)
+            images = iter(images.map(lambda image, labels: image).repeat())
+            results = prep_benchmarks(model, images, FLAGS.warmup_iterations, FLAGS.benchmark_iterations)
+            print_benchmarks(results, batch_size, input_size)
+            benchmarks.append({'batch_size': batch_size, 'input_size': input_size, 'stages': results})
+        if FLAGS.benchmark_json:
+            with tf.io.gfile.GFile(FLAGS.benchmark_json, 'w') as f:
+                json.dump({'backbone': model_params['backbone'], 'benchmarks': benchmarks}, f, indent=2)
+        return
+
+    dataset = dateset.get_eval_dataloader(subset=FLAGS.subset, batch_size=FLAGS.batch_size)
+
+    detections = None
+    if FLAGS.results_dir:
+        tf.io.gfile.makedirs(FLAGS.results_dir)
+        detections = Detections(os.path.join(FLAGS.results_dir, 'bbox_detections.json'),
+                                os.path.join(FLAGS.results_dir, 'mask_detections.json'), LABEL_MAP[FLAGS.name])
+
+    stage_times = {}
+    evaluate(model, dataset, dateset.num_examples(FLAGS.subset), num_cls, detections=detections,
+             class_names=CLASS_NAMES[FLAGS.name], stage_times=stage_times)
+    print_stage_times(stage_times)
 
 
 if __name__ == '__main__':
+    define_flags()
     app.run(main)
@@ -0,0 +1,112 @@
+"""
+Evaluate the checkpoints written by train.py in a separate process, while the training continues.
+Run train.py with --noinline_eval and point both to the same checkpoint_dir, e.g. on the CPU:
+    CUDA_VISIBLE_DEVICES="" python eval_worker.py --checkpoint_dir ./checkpoints
+"""
+import datetime
+import os
+
+import tensorflow as tf
+from absl import app
+from absl import flags
+from absl import logging
+
+from config import get_params
+from data.coco_dataset import ObjectDetectionDataset
+from eval import evaluate
+from yolact import Yolact
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string('name', 'coco',
+                    'name of dataset')
+flags.DEFINE_string('tfrecord_dir', 'data',
+                    'directory of tfrecord')
+flags.DEFINE_string('weights', 'weights',
+                    'path to store the weights with the best mask mAP')
+flags.DEFINE_string('checkpoint_dir', './checkpoints',
+                    'directory of the checkpoints written by train.py')
+flags.DEFINE_integer('eval_batch_size', 1,
+                     'batch size for validation')
+flags.DEFINE_integer('min_interval_secs', 0,
+                     'minimum number of seconds between two evaluations')
+flags.DEFINE_float('timeout', None,
+                   'stop after waiting this many seconds for a new checkpoint, wait forever if not set')
+
+
+def load_best_masks_map(weights_prefix):
+    """Best mask mAP of the weights already saved as {weights_prefix}_{mask mAP}.h5, 0 if there is none"""
+    best_masks_map = 0.
+    for path in tf.io.gfile.glob(f'{weights_prefix}_*.h5'):
+        try:
+            masks_map = float(os.path.basename(path)[len(os.path.basename(weights_prefix)) + 1:-len('.h5')])
+        except ValueError:
+            continue
+        best_masks_map = max(best_masks_map, masks_map)
+    return best_masks_map
+
+
+def evaluate_checkpoints(model, checkpoint, checkpoint_dir, valid_dataset, num_val, num_cls, summary_writer,
+                         weights_prefix, min_interval_secs=0, timeout=None):
+    """
+    Evaluate the latest checkpoint of checkpoint_dir every time a new one is written, the checkpoints written while
+    evaluating are skipped except the latest one
+    :param checkpoint: tf.train.Checkpoint with the step and the model, restored from the checkpoints of train.py
+    :param weights_prefix: the weights with the best mask mAP are saved to {weights_prefix}_{mask mAP}.h5
+    :return: best mask mAP
+    """
+    # after a restart, only save the weights beating the ones saved before
+    best_masks_map = load_best_masks_map(weights_prefix)
+    if best_masks_map > 0:
+        logging.info("Best mask mAP of the saved weights: {}".format(best_masks_map))
+    for checkpoint_path in tf.train.checkpoints_iterator(checkpoint_dir, min_interval_secs, timeout):
+        # the optimizer in the checkpoint is not needed for evaluation
+        checkpoint.restore(checkpoint_path).expect_partial()
+        iterations = int(checkpoint.step)
+        logging.info("Evaluating {} of step {}".format(checkpoint_path, iterations))
+
+        all_map = evaluate(model, valid_dataset, num_val, num_cls)
+        box_map, mask_map = all_map['box']['all'], all_map['mask']['all']
+        tf.print(f"step:{iterations}, box mAP:{box_map}, mask mAP:{mask_map}")
+
+        with summary_writer.as_default():
+            tf.summary.scalar('Box mAP', box_map, step=iterations)
+            tf.summary.scalar('Mask mAP', mask_map, step=iterations)
+        summary_writer.flush()
+
+        # Saving the weights:
+        if mask_map > best_masks_map:
+            best_masks_map = mask_map
+            model.save_weights(f'{weights_prefix}_{str(best_masks_map)}.h5')
+    return best_masks_map
+
+
+def main(argv):
+    # get params for model
+    _, _, num_cls, _, _, parser_params, model_params = get_params(FLAGS.name)
+
+    logging.info("Creating the model instance of YOLACT")
+    model = Yolact(**model_params)
+    checkpoint = tf.train.Checkpoint(step=tf.Variable(1), model=model)
+
+    logging.info("Creating the dataloader from: %s..." % FLAGS.tfrecord_dir)
+    dateset = ObjectDetectionDataset(dataset_name=FLAGS.name,
+                                     tfrecord_dir=os.path.join(FLAGS.tfrecord_dir, FLAGS.name),
+                                     anchor_instance=model.anchor_instance,
+                                     **parser_params)
+    valid_dataset = dateset.get_eval_dataloader(subset='val', batch_size=FLAGS.eval_batch_size)
+    num_val = dateset.num_examples('val')
+
+    # same layout as the logs of train.py
+    current_time = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+    test_summary_writer = tf.summary.create_file_writer('./logs/gradient_tape/' + current_time + '/test')
+
+    logging.info("Waiting for checkpoints in {}...".format(FLAGS.checkpoint_dir))
+    best_masks_map = evaluate_checkpoints(model, checkpoint, FLAGS.checkpoint_dir, valid_dataset, num_val, num_cls,
+                                          test_summary_writer, f'{FLAGS.weights}/weights_{FLAGS.name}',
+                                          FLAGS.min_interval_secs, FLAGS.timeout)
+    logging.info("No new checkpoint, best mask mAP: {}".format(best_masks_map))
+
+
+if __name__ == '__main__':
+    app.run(main)
@@ -4,16 +4,27 @@ from utils import utils
 
 
 class Detect(object):
-    def __init__(self, anchors, num_cls, label_background, top_k, conf_threshold, nms_threshold, max_num_detection):
+    def __init__(self, anchor_instance, num_cls, label_background, top_k, conf_threshold, nms_threshold,
+                 max_num_detection, nms_type='fast_nms', batched=False):
         self.num_cls = num_cls
         self.label_background = label_background
         self.top_k = top_k
         self.nms_threshold = nms_threshold
         self.conf_threshold = conf_threshold
-        self.anchors = anchors
+        self.anchor_instance = anchor_instance
+        self.anchors = anchor_instance.get_anchors()
         self.max_num_detection = max_num_detection
+        # "fast_nms" per class, "cc_fast_nms" cross class, "nms" original greedy nms
+        if nms_type not in ('fast_nms', 'cc_fast_nms', 'nms'):
+            raise ValueError(f'NMS option of {nms_type} is not supported yet!!!')
+        self.nms_type = nms_type
+        # batched mode decode and suppress the whole batch in one graph, return padded outputs
+        self.batched = batched
 
     def __call__(self, prediction):
+        if self.batched:
+            return self._batched_call(prediction['pred_offset'], prediction['pred_cls'],
+                                      prediction['pred_mask_coef'], prediction['proto_out'])
         loc_pred = prediction['pred_offset']
         # tf.print('loc pred', tf.shape(loc_pred))
         cls_pred = prediction['pred_cls']
@@ -36,7 +47,7 @@ class Detect(object):
         out = []
         for batch_idx in tf.range(num_batch):
             # add offset to anchors
-            decoded_boxes = utils.map_to_bbox(self.anchors, loc_pred[batch_idx])
+            decoded_boxes = self.anchor_instance.decode(loc_pred[batch_idx])
             # do detection, we ignore background label 0 here
             result = self._detection(cls_pred[batch_idx, 1:], decoded_boxes, mask_pred[batch_idx])
             if (result is not None) and (proto_pred is not None):
@@ -45,6 +56,153 @@ class Detect(object):
 
         return out
 
+    @tf.function
+    def _batched_call(self, loc_pred, cls_pred, mask_pred, proto_pred):
+        """
+        Detection for the whole batch at once
+        :return: dict of padded outputs, 'box' [batch, max_num_detection, 4], 'mask' [batch, max_num_detection, k],
+                 'class' [batch, max_num_detection], 'score' [batch, max_num_detection], 'proto' and
+                 'num_detections' [batch] telling how many entries of each image are valid
+        """
+        # add offset to anchors, [batch, num_anchors, 4]
+        decoded_boxes = self.anchor_instance.decode(loc_pred)
+
+        # apply softmax to pred_cls and ignore background label 0, [batch, num_cls - 1, num_anchors]
+        cls_pred = tf.nn.softmax(cls_pred, axis=-1)
+        cls_pred = tf.transpose(cls_pred[:, :, 1:], perm=[0, 2, 1])
+
+        # score under confidence threshold can never be kept, zero it instead of gathering the candidates
+        scores = tf.where(cls_pred > self.conf_threshold, cls_pred, tf.zeros_like(cls_pred))
+
+        top_k = min(self.top_k, self.anchors.shape[0])
+        nms = {'fast_nms': self._batched_fast_nms,
+               'cc_fast_nms': self._batched_cc_fast_nms,
+               'nms': self._batched_nms}[self.nms_type]
+        boxes, masks, classes, scores = nms(decoded_boxes, mask_pred, scores, self.nms_threshold, top_k)
+        num_detections = tf.reduce_sum(tf.cast(scores > 0, tf.int32), axis=-1)
+
+        return {'box': boxes, 'mask': masks, 'class': classes, 'score': scores, 'proto': proto_pred,
+                'num_detections': num_detections}
+
+    def _batched_fast_nms(self, boxes, masks, scores, iou_threshold=0.5, top_k=200):
+        """
+        Fast NMS on padded tensors
+        :param boxes: [batch, num_anchors, 4]
+        :param masks: [batch, num_anchors, k]
+        :param scores: [batch, num_classes, num_anchors], zero for the filtered out score
+        :return: boxes, masks, classes, scores padded to max_num_detection, the padding has score 0
+        """
+        # [batch, num_classes, top_k]
+        scores, idx = tf.math.top_k(scores, k=top_k)
+        num_classes = tf.shape(idx)[1]
+        boxes = tf.gather(boxes, idx, batch_dims=1)
+        masks = tf.gather(masks, idx, batch_dims=1)
+
+        # [batch, num_classes, top_k, top_k]
+        iou = utils.jaccard(boxes, boxes)
+
+        # upper trangular matrix - diagnoal
+        upper_triangular = tf.linalg.band_part(iou, 0, -1)
+        diag = tf.linalg.band_part(iou, 0, 0)
+        iou = upper_triangular - diag
+
+        # fitler out the unwanted ROI and the padding
+        iou_max = tf.reduce_max(iou, axis=-2)
+        idx_det = tf.logical_and(iou_max <= iou_threshold, scores > self.conf_threshold)
+        scores = tf.where(idx_det, scores, tf.zeros_like(scores))
+
+        # flatten the class dimension
+        num_batch = tf.shape(scores)[0]
+        classes = tf.broadcast_to(tf.reshape(tf.range(num_classes), [1, -1, 1]), tf.shape(scores))
+        scores = tf.reshape(scores, [num_batch, -1])
+        classes = tf.reshape(classes, [num_batch, -1])
+        boxes = tf.reshape(boxes, [num_batch, -1, 4])
+        masks = tf.reshape(masks, [num_batch, -1, tf.shape(masks)[-1]])
+
+        return self._batched_top_detections(boxes, masks, classes, scores)
+
+    def _batched_cc_fast_nms(self, boxes, masks, scores, iou_threshold=0.5, top_k=200):
+        """
+        Cross class Fast NMS on padded tensors, each box only keep its highest class
+        so there is one [top_k, top_k] IoU matrix per image instead of one per class
+        """
+        # [batch, num_anchors]
+        classes = tf.argmax(scores, axis=1, output_type=tf.int32)
+        scores = tf.reduce_max(scores, axis=1)
+
+        # [batch, top_k]
+        scores, idx = tf.math.top_k(scores, k=top_k)
+        boxes = tf.gather(boxes, idx, batch_dims=1)
+        masks = tf.gather(masks, idx, batch_dims=1)
+        classes = tf.gather(classes, idx, batch_dims=1)
+
+        # [batch, top_k, top_k]
+        iou = utils.jaccard(boxes, boxes)
+
+        # upper trangular matrix - diagnoal
+        upper_triangular = tf.linalg.band_part(iou, 0, -1)
+        diag = tf.linalg.band_part(iou, 0, 0)
+        iou = upper_triangular - diag
+
+        # fitler out the unwanted ROI and the padding
+        iou_max = tf.reduce_max(iou, axis=-2)
+        idx_det = tf.logical_and(iou_max <= iou_threshold, scores > self.conf_threshold)
+        scores = tf.where(idx_det, scores, tf.zeros_like(scores))
+
+        return self._batched_top_detections(boxes, masks, classes, scores)
+
+    def _batched_nms(self, boxes, masks, scores, iou_threshold=0.5, top_k=200):
+        """
+        Original greedy NMS per class on padded tensors, using tf.image.combined_non_max_suppression
+        """
+        # only the top_k of each class are candidates, [batch, num_classes, top_k]
+        scores, idx = tf.math.top_k(scores, k=top_k)
+        boxes = tf.gather(boxes, idx, batch_dims=1)
+
+        # combined nms expect boxes [batch, top_k, num_classes, 4] and scores [batch, top_k, num_classes]
+        nms_boxes, nms_scores, nms_classes, num_detections = tf.image.combined_non_max_suppression(
+            tf.transpose(boxes, perm=[0, 2, 1, 3]),
+            tf.transpose(scores, perm=[0, 2, 1]),
+            max_output_size_per_class=top_k,
+            max_total_size=self.max_num_detection,
+            iou_threshold=iou_threshold,
+            score_threshold=self.conf_threshold,
+            clip_boxes=False)
+        classes = tf.cast(nms_classes, tf.int32)
+
+        # combined nms does not return indices, find back the candidate of each output to get its mask coef
+        # the output box and score are copies of the candidate, so they are exactly equal
+        class_boxes = tf.gather(boxes, classes, batch_dims=1)
+        class_scores = tf.gather(scores, classes, batch_dims=1)
+        same = tf.logical_and(tf.reduce_all(tf.equal(class_boxes, tf.expand_dims(nms_boxes, axis=2)), axis=-1),
+                              tf.equal(class_scores, tf.expand_dims(nms_scores, axis=-1)))
+        candidate_idx = tf.argmax(tf.cast(same, tf.int32), axis=-1, output_type=tf.int32)
+        anchor_idx = tf.gather(tf.gather(idx, classes, batch_dims=1), candidate_idx, batch_dims=2)
+
+        valid = tf.range(tf.shape(nms_scores)[-1])[None, :] < num_detections[:, None]
+        masks = tf.where(valid[..., None], tf.gather(masks, anchor_idx, batch_dims=1), tf.zeros([], masks.dtype))
+        classes = tf.where(valid, classes, tf.zeros_like(classes))
+        scores = tf.where(valid, nms_scores, tf.zeros_like(nms_scores))
+        boxes = tf.where(valid[..., None], nms_boxes, tf.zeros([], nms_boxes.dtype))
+
+        return boxes, masks, classes, scores
+
+    def _batched_top_detections(self, boxes, masks, classes, scores):
+        """keep the max_num_detection highest score of each image, zero score is the padding"""
+        num_candidates = scores.shape[-1]
+        if num_candidates is None:
+            max_num_detection = tf.minimum(self.max_num_detection, tf.shape(scores)[-1])
+        else:
+            max_num_detection = min(self.max_num_detection, num_candidates)
+
+        scores, idx = tf.math.top_k(scores, k=max_num_detection)
+        valid = scores > 0
+        classes = tf.where(valid, tf.gather(classes, idx, batch_dims=1), tf.zeros_like(idx))
+        boxes = tf.where(valid[..., None], tf.gather(boxes, idx, batch_dims=1), tf.zeros([], boxes.dtype))
+        masks = tf.where(valid[..., None], tf.gather(masks, idx, batch_dims=1), tf.zeros([], masks.dtype))
+
+        return boxes, masks, classes, scores
+
     def _detection(self, cls_pred, decoded_boxes, mask_pred):
         cur_score = cls_pred
         # get scores and correspond class
@@ -54,7 +212,7 @@ class Detect(object):
         # tf.print("conf_score:", tf.shape(conf_score))
 
         # filter out the ROI that have conf score > confidence threshold
-        candidate_ROI_idx = tf.squeeze(tf.where(conf_score > self.conf_threshold))
+        candidate_ROI_idx = tf.where(conf_score > self.conf_threshold)[:, 0]
         # tf.print("candidate_ROI:", tf.size(candidate_ROI_idx))
 
         # there might not have any score that over self.conf_threshold, no detection
@@ -72,7 +230,10 @@ class Detect(object):
         # tf.print("before fastnms score", scores)
         top_k = tf.math.minimum(self.top_k, tf.size(candidate_ROI_idx))
         # tf.print("top k", top_k)
-        boxes, masks, classes, scores = self._fast_nms(boxes, masks_coef, scores, self.nms_threshold, top_k)
+        nms = {'fast_nms': self._fast_nms,
+               'cc_fast_nms': self._cc_fast_nms,
+               'nms': self._nms}[self.nms_type]
+        boxes, masks, classes, scores = nms(boxes, masks_coef, scores, self.nms_threshold, top_k)
 
         return {'box': boxes, 'mask': masks, 'class': classes, 'score': scores}
 
@@ -128,9 +289,9 @@ class Detect(object):
         # tf.print(scores)
         # second threshold
         # tf.print(positive_det)
-        classes = classes[:tf.size(scores)]
-        boxes = boxes[:tf.size(scores)]
-        masks = masks[:tf.size(scores)]
+        classes = tf.gather(classes, idx)
+        boxes = tf.gather(boxes, idx)
+        masks = tf.gather(masks, idx)
 
         # tf.print("final scores", tf.shape(scores))
         # tf.print("final classes", tf.shape(classes))
@@ -139,23 +300,20 @@ class Detect(object):
 
         return boxes, masks, classes, scores
 
-    def _cc_fast_nms(self):
+    def _cc_fast_nms(self, boxes, masks, scores, iou_threshold=0.5, top_k=200):
         """cross class FastNMS"""
-        ...
+        boxes, masks, classes, scores = self._batched_cc_fast_nms(
+            boxes[None], masks[None], scores[None], iou_threshold, top_k)
+        return self._unpad(boxes[0], masks[0], classes[0], scores[0])
 
-    def _nms(self):
+    def _nms(self, boxes, masks, scores, iou_threshold=0.5, top_k=200):
         """original NMS"""
-        """
-               #　Normal NMS
-               selected_indices = tf.image.non_max_suppression(boxes, scores, 100, 0.1)
-               boxes = tf.gather(boxes, selected_indices)
-               scores = tf.gather(scores, selected_indices)
-               masks = tf.gather(masks, selected_indices)
-               classes = tf.gather(classes, selected_indices)
-
-               tf.print("predicted boxes shape", tf.shape(boxes))
-               tf.print("predicted scores shape", tf.shape(scores))
-               tf.print("predicted masks shape", tf.shape(masks))
-               tf.print("predicted classes shape", tf.shape(classes))
-               """
-        ...
+        boxes, masks, classes, scores = self._batched_nms(
+            boxes[None], masks[None], scores[None], iou_threshold, top_k)
+        return self._unpad(boxes[0], masks[0], classes[0], scores[0])
+
+    @staticmethod
+    def _unpad(boxes, masks, classes, scores):
+        # padded outputs are sorted by score, padding at the end
+        num_detections = tf.reduce_sum(tf.cast(scores > 0, tf.int32))
+        return boxes[:num_detections], masks[:num_detections], classes[:num_detections], scores[:num_detections]
@@ -11,13 +11,16 @@ class YOLACTLoss(object):
                  loss_weight_mask=6.125,
                  loss_weight_seg=1,
                  neg_pos_ratio=3,
-                 max_masks_for_train=100):
+                 max_masks_for_train=100,
+                 static_shapes=False):
         self._loss_weight_cls = loss_weight_cls
         self._loss_weight_box = loss_weight_box
         self._loss_weight_mask = loss_weight_mask
         self._loss_weight_seg = loss_weight_seg
         self._neg_pos_ratio = neg_pos_ratio
         self._max_masks_for_train = max_masks_for_train
+        # no data dependent shapes (masked reductions, fixed number of masks), needed to compile with XLA
+        self._static_shapes = static_shapes
 
     def __call__(self, pred, label, num_classes):
         # all prediction component
@@ -41,29 +44,22 @@ class YOLACTLoss(object):
         loc_loss = self._loss_location(pred_offset, box_targets, positiveness) * self._loss_weight_box
         conf_loss = self._loss_class(pred_cls, cls_targets, num_classes, positiveness) * self._loss_weight_cls
         mask_loss = self._loss_mask(proto_out, pred_mask_coef, bbox_norm, masks, positiveness, max_id_for_anchors,
-                                    max_masks_for_train=100) * self._loss_weight_mask
+                                    max_masks_for_train=self._max_masks_for_train) * self._loss_weight_mask
         seg_loss = self._loss_semantic_segmentation(seg, masks, classes, num_obj) * self._loss_weight_seg
         total_loss = loc_loss + conf_loss + mask_loss + seg_loss
         return loc_loss, conf_loss, mask_loss, seg_loss, total_loss
 
     def _loss_location(self, pred_offset, gt_offset, positiveness):
 
-        positiveness = tf.expand_dims(positiveness, axis=-1)
-
-        # get postive indices
-        pos_indices = tf.where(positiveness == 1)
-        pred_offset = tf.gather_nd(pred_offset, pos_indices[:, :-1])
-        gt_offset = tf.gather_nd(gt_offset, pos_indices[:, :-1])
-
-        # calculate the smoothL1(positive_pred, positive_gt) and return
-        num_pos = tf.shape(gt_offset)[0]
+        # mask the postive anchors instead of gathering them
+        positive = tf.cast(tf.expand_dims(positiveness == 1, axis=-1), pred_offset.dtype)
+        num_pos = tf.reduce_sum(positive)
 
         # calculate smoothL1 loss
         diff = tf.abs(gt_offset - pred_offset)
-        less_than_one = tf.cast(tf.less(diff, 1.0), tf.float32)
+        less_than_one = tf.cast(tf.less(diff, 1.0), diff.dtype)
         l1loss = (less_than_one * 0.5 * diff ** 2) + (1.0 - less_than_one) * (diff - 0.5)
-        loss_loc = l1loss / tf.cast(num_pos, l1loss.dtype)
-        loss_loc = tf.reduce_sum(loss_loc)
+        loss_loc = tf.reduce_sum(l1loss * positive) / num_pos
 
         return loss_loc
 
@@ -79,16 +75,33 @@ class YOLACTLoss(object):
         non_neg_mask = tf.cast(tf.logical_not(gt_cls != 0), tf.float32)
         logsumexp_pred_cls = logsumexp_pred_cls * non_neg_mask
 
-        idx = tf.argsort(logsumexp_pred_cls, axis=1, direction="DESCENDING")
-        idx_rank = tf.argsort(idx, axis=1)
-
         num_pos = tf.expand_dims(
             tf.reduce_sum(tf.cast((positiveness == 1), tf.int32), axis=-1), axis=-1)
         num_neg = tf.clip_by_value(num_pos * self._neg_pos_ratio, clip_value_min=0,
                                    clip_value_max=tf.shape(positiveness)[-1] - 1)
 
-        negative_bool = tf.broadcast_to((idx_rank < num_neg), tf.shape(idx_rank))
-        negative_bool = tf.cast(negative_bool, logsumexp_pred_cls.dtype) * non_neg_mask
+        if self._static_shapes:
+            # the num_neg-th largest loss of each image is the threshold of the hardest negatives
+            sorted_loss = tf.sort(logsumexp_pred_cls, axis=1, direction="DESCENDING")
+            threshold = tf.gather(sorted_loss, tf.maximum(num_neg - 1, 0), batch_dims=1)
+            negative_bool = tf.logical_and(logsumexp_pred_cls >= threshold, num_neg > 0)
+            negative_bool = tf.cast(negative_bool, logsumexp_pred_cls.dtype) * non_neg_mask
+
+            # cross entropy of every anchor, only the positives and the mined negatives are kept
+            selected = tf.cast(positiveness == 1, pred_cls.dtype) + negative_bool
+            pred_cls = tf.reshape(pred_cls, [-1, tf.shape(positiveness)[-1], num_cls])
+            gt_cls = tf.one_hot(tf.maximum(tf.cast(gt_cls, tf.int32), 0), depth=num_cls)
+            loss_conf = tf.nn.softmax_cross_entropy_with_logits(gt_cls, pred_cls) * selected
+            return tf.reduce_sum(loss_conf) / tf.cast(tf.reduce_sum(num_pos), loss_conf.dtype)
+
+        # hardest num_neg negatives of each image, top k up to the largest num_neg instead of sorting all anchors
+        num_top = tf.reduce_max(num_neg)
+        _, idx = tf.math.top_k(logsumexp_pred_cls, k=num_top)
+        batch_idx = tf.broadcast_to(tf.range(tf.shape(idx)[0])[:, None], tf.shape(idx))
+        negative_bool = tf.scatter_nd(tf.stack([batch_idx, idx], axis=-1),
+                                      tf.cast(tf.range(num_top)[None, :] < num_neg, logsumexp_pred_cls.dtype),
+                                      tf.shape(logsumexp_pred_cls))
+        negative_bool = negative_bool * non_neg_mask
 
         idx_pos = tf.where(positiveness == 1)
         idx_neg = tf.where(negative_bool == 1)
@@ -110,94 +123,69 @@ class YOLACTLoss(object):
         num_batch = shape_proto[0]
         proto_h = shape_proto[1]
         proto_w = shape_proto[2]
-        loss_mask = 0.
-        total_pos = 0
-
-        for idx in tf.range(num_batch):
-            # extract randomly postive sample in prejd_mask_coef, gt_cls, gt_offset according to positive_indices
-            proto = proto_output[idx]
-            mask_coef = pred_mask_coef[idx]
-            mask_gt = gt_masks[idx]
-            bbox_norm = gt_bbox_norm[idx]  # [100, 4] -> [num_obj, 4]
-            pos = positiveness[idx]
-            max_id = max_id_for_anchors[idx]
-
-            pos_indices = tf.squeeze(tf.where(pos == 1))
-
-            # If exceeds the number of masks for training, select a random subset
-            old_num_pos = tf.size(pos_indices)
-            # print("pos indices", pos_indices.shape)
-            if old_num_pos > max_masks_for_train:
-                perm = tf.random.shuffle(pos_indices)
-                pos_indices = perm[:max_masks_for_train]
-
-            pos_mask_coef = tf.gather(mask_coef, pos_indices)
-            pos_max_id = tf.gather(max_id, pos_indices)
-
-            # if only 1 positive or no positive
-            if tf.size(pos_indices) == 1:
-                pos_mask_coef = tf.expand_dims(pos_mask_coef, axis=0)
-                pos_max_id = tf.expand_dims(pos_max_id, axis=0)
-            elif tf.size(pos_indices) == 0:
-                continue
-            else:
-                ...
-
-            # [num_pos, k]
-            gt = tf.gather(mask_gt, pos_max_id)
-            bbox = tf.gather(bbox_norm, pos_max_id)
-            # print(bbox[:5])
-            num_pos = tf.size(pos_indices)
-            # print('gt_me', gt.shape)
-            total_pos += num_pos
-
-            # [138, 138, num_pos]
-            pred_mask = tf.linalg.matmul(proto, pos_mask_coef, transpose_a=False, transpose_b=True)
-            pred_mask = tf.transpose(pred_mask, perm=(2, 0, 1))
-            s = tf.nn.sigmoid_cross_entropy_with_logits(gt, pred_mask)
-            s = utils.crop(s, bbox)
-
-            # calculating loss for each mask coef correspond to each postitive anchor
-            bbox_center = utils.map_to_center_form(tf.cast(bbox, tf.float32))
-            area = bbox_center[:, -1] * bbox_center[:, -2]
-            mask_loss = tf.reduce_sum(s, axis=[1, 2]) / area
-
-            if old_num_pos > num_pos:
-                mask_loss = mask_loss * tf.cast((old_num_pos / num_pos), mask_loss.dtype)
-            loss_mask += tf.reduce_sum(mask_loss)
-
-        return loss_mask / tf.cast(total_pos, loss_mask.dtype)
+        num_anchors = tf.shape(positiveness)[1]
+
+        # If exceeds the number of masks for training, select a random subset: top k of random scores given to
+        # the positives, padded to the largest number of selected positives in the batch
+        # (always max_masks_for_train with static shapes)
+        pos = positiveness == 1
+        old_num_pos = tf.reduce_sum(tf.cast(pos, tf.int32), axis=-1)
+        num_selected = tf.minimum(max_masks_for_train, num_anchors)
+        if not self._static_shapes:
+            num_selected = tf.minimum(num_selected, tf.reduce_max(old_num_pos))
+        scores = tf.where(pos, tf.random.uniform(tf.shape(positiveness)), -1.)
+        _, selected = tf.math.top_k(scores, k=num_selected)
+        valid = tf.gather(pos, selected, batch_dims=1)
+        valid_float = tf.cast(valid, tf.float32)
+
+        pos_mask_coef = tf.gather(pred_mask_coef, selected, batch_dims=1)
+        pos_max_id = tf.gather(max_id_for_anchors, selected, batch_dims=1)
+        gt = tf.gather(gt_masks, pos_max_id, batch_dims=1)
+        bbox = tf.gather(gt_bbox_norm, pos_max_id, batch_dims=1)
+
+        # [batch, num_selected, 138, 138] for all the images at once
+        proto = tf.reshape(proto_output, [num_batch, proto_h * proto_w, -1])
+        pred_mask = tf.linalg.matmul(pos_mask_coef, proto, transpose_a=False, transpose_b=True)
+        pred_mask = tf.reshape(pred_mask, [num_batch, -1, proto_h, proto_w])
+        s = tf.nn.sigmoid_cross_entropy_with_logits(tf.cast(gt, pred_mask.dtype), pred_mask)
+        s = utils.crop(s, bbox)
+
+        # calculating loss for each mask coef correspond to each postitive anchor, padding has no area
+        bbox_center = utils.map_to_center_form(tf.cast(tf.reshape(bbox, [-1, 4]), tf.float32))
+        area = tf.reshape(bbox_center[:, -1] * bbox_center[:, -2], tf.shape(valid))
+        mask_loss = tf.math.divide_no_nan(tf.reduce_sum(s, axis=[2, 3]), area) * valid_float
+
+        # scale up the images where only a subset of the positives was used
+        num_pos = tf.reduce_sum(valid_float, axis=-1)
+        scale = tf.maximum(tf.math.divide_no_nan(tf.cast(old_num_pos, tf.float32), num_pos), 1.)
+        mask_loss = tf.reduce_sum(mask_loss, axis=-1) * scale
+
+        return tf.math.divide_no_nan(tf.reduce_sum(mask_loss), tf.reduce_sum(num_pos))
 
     def _loss_semantic_segmentation(self, pred_seg, mask_gt, classes, num_obj):
 
         shape_mask = tf.shape(mask_gt)
         num_batch = shape_mask[0]
+        num_max_pad = shape_mask[1]
         seg_shape = tf.shape(pred_seg)[1]
-        loss_seg = 0.
-
-        for idx in tf.range(num_batch):
-            seg = pred_seg[idx]
-            masks = mask_gt[idx]
-            cls = classes[idx]
-            objects = num_obj[idx]
-
-            # seg shape (69, 69, num_cls)
-            # resize masks from (100, 138, 138) to (100, 69, 69)
-            masks = tf.expand_dims(masks, axis=-1)
-            masks = tf.image.resize(masks, [seg_shape, seg_shape], method=tf.image.ResizeMethod.BILINEAR)
-            masks = tf.cast((masks > 0.5), seg.dtype)
-            masks = tf.squeeze(masks)
-
-            # obj_mask shape (objects, 138, 138)
-            obj_mask = masks[:objects]
-            obj_cls = tf.expand_dims(cls[:objects], axis=-1)
-
-            # create empty ground truth (138, 138, num_cls)
-            seg_gt = tf.zeros_like(seg)
-            seg_gt = tf.transpose(seg_gt, perm=(2, 0, 1))
-            seg_gt = tf.tensor_scatter_nd_add(seg_gt, indices=obj_cls, updates=obj_mask)
-            seg_gt = tf.transpose(seg_gt, perm=(1, 2, 0))
-            loss_seg += tf.reduce_sum(tf.nn.sigmoid_cross_entropy_with_logits(seg_gt, seg))
+        num_seg_cls = tf.shape(pred_seg)[-1]
+
+        # seg shape (batch, 69, 69, num_cls - 1)
+        # resize masks from (batch, num_max_pad, 138, 138) to (batch, 69, 69, num_max_pad) in one go,
+        # objects as channels
+        masks = tf.transpose(mask_gt, perm=(0, 2, 3, 1))
+        masks = tf.image.resize(masks, [seg_shape, seg_shape], method=tf.image.ResizeMethod.BILINEAR)
+        masks = tf.cast((masks > 0.5), pred_seg.dtype)
+
+        # one hot class of each object, padding is all zero, (batch, num_max_pad, num_cls - 1)
+        # the seg branch has no background channel, class 1 goes to channel 0
+        valid = tf.range(num_max_pad)[None, :] < tf.cast(num_obj, tf.int32)[:, None]
+        obj_cls = tf.one_hot(tf.cast(classes, tf.int32) - 1, depth=num_seg_cls, dtype=pred_seg.dtype)
+        obj_cls = obj_cls * tf.cast(valid, pred_seg.dtype)[..., None]
+
+        # ground truth (batch, 69, 69, num_cls - 1), union of the masks of the same class
+        seg_gt = tf.minimum(tf.einsum('bhwn,bnc->bhwc', masks, obj_cls), 1.)
+        loss_seg = tf.reduce_sum(tf.nn.sigmoid_cross_entropy_with_logits(seg_gt, pred_seg))
         loss_seg = loss_seg / tf.cast(seg_shape, pred_seg.dtype) ** 2 / tf.cast(num_batch, pred_seg.dtype)
 
         return loss_seg
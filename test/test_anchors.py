@@ -37,3 +37,24 @@ target_cls, target_loc, max_id_for_anchors, match_positiveness = anchorobj.match
                                                                                     gt_labels=test_labels)
 
 print(max_id_for_anchors)
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Test the vectorized anchors are the same as looping over every cell
+from itertools import product
+from math import sqrt
+
+anchor_params = model_params['anchor_params']
+prior_boxes = []
+for idx, f_size in enumerate(anchor_params['feature_map_size']):
+    for j, i in product(range(f_size), range(f_size)):
+        x = (i + 0.5) / f_size
+        y = (j + 0.5) / f_size
+        for ars in anchor_params['aspect_ratio']:
+            w = anchor_params['scale'][idx] * sqrt(ars) / anchor_params['img_size']
+            h = w
+            prior_boxes += [(y - (h / 2.)), (x - (w / 2.)), (y + (h / 2.)), (x + (w / 2.))]
+prior_boxes = tf.reshape(tf.convert_to_tensor(prior_boxes), [-1, 4]) * anchor_params['img_size']
+max_diff = tf.reduce_max(tf.abs(prior_boxes - anchorobj.get_anchors()))
+tf.print("max difference to looping anchors", max_diff)
+# anchors are in pixels, float32 rounding of the normalized coordinates is scaled by the image size
+assert max_diff < 1e-6 * anchor_params['img_size']
@@ -0,0 +1,121 @@
+import numpy as np
+import tensorflow as tf
+
+from eval import _match_detections, iou_thresholds
+from utils.APObject import APObject
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# reference matching, the loop over classes, thresholds, detections and gt of the original eval.py
+def reference_match_detections(iou, classes, gt_classes, indices, crowd_iou=None, crowd_classes=None):
+    num_pred, num_gt = iou.shape
+    is_true = np.zeros([len(iou_thresholds), num_pred], dtype=bool)
+    is_counted = np.zeros([len(iou_thresholds), num_pred], dtype=bool)
+    for _class in set(classes.tolist()) | set(gt_classes.tolist()):
+        for iouIdx, th in enumerate(iou_thresholds):
+            gt_used = [False] * num_gt
+            for i in indices:
+                if classes[i] != _class:
+                    continue
+                max_iou_found = th
+                max_match_idx = -1
+                for j in range(num_gt):
+                    if gt_used[j] or gt_classes[j] != _class:
+                        continue
+                    if iou[i, j] > max_iou_found:
+                        max_iou_found = iou[i, j]
+                        max_match_idx = j
+                if max_match_idx >= 0:
+                    gt_used[max_match_idx] = True
+                    is_true[iouIdx, i] = is_counted[iouIdx, i] = True
+                else:
+                    matched_crowd = False
+                    if crowd_iou is not None:
+                        for j in range(len(crowd_classes)):
+                            if crowd_classes[j] == _class and crowd_iou[i, j] > th:
+                                matched_crowd = True
+                                break
+                    # detections matching a crowd annotation are not pushed
+                    is_counted[iouIdx, i] = not matched_crowd
+    return is_true, is_counted
+
+
+def random_iou(rng, shape):
+    # values on a coarse grid give ties, some of them nan like the iou of an empty mask
+    iou = rng.choice(np.linspace(0., 1., 21), size=shape)
+    iou[rng.rand(*shape) < 0.1] = np.nan
+    return iou
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Test the vectorized matching gives the same true / counted detections as the loop
+rng = np.random.RandomState(1234)
+num_mismatch = 0
+for case in range(300):
+    num_pred, num_gt, num_crowd = rng.randint(0, 15), rng.randint(0, 8), rng.randint(0, 3)
+    classes = rng.randint(1, 4, size=num_pred)
+    gt_classes = rng.randint(1, 4, size=num_gt)
+    scores = rng.choice(np.linspace(0., 1., 11), size=num_pred)
+    indices = np.argsort(-scores, kind='stable')
+    iou = random_iou(rng, [num_pred, num_gt])
+    crowd_iou, crowd_classes = None, None
+    if num_crowd > 0:
+        crowd_iou = random_iou(rng, [num_pred, num_crowd])
+        crowd_classes = rng.randint(1, 4, size=num_crowd)
+    is_true, is_counted = _match_detections(iou, classes, gt_classes, indices, crowd_iou, crowd_classes)
+    ref_is_true, ref_is_counted = reference_match_detections(iou, classes, gt_classes, indices, crowd_iou,
+                                                             crowd_classes)
+    num_mismatch += int(not (np.array_equal(is_true, ref_is_true) and np.array_equal(is_counted, ref_is_counted)))
+tf.print("matching, cases different from the loop", num_mismatch)
+assert num_mismatch == 0
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# reference AP of the original list based APObject
+def reference_get_ap(data_points, num_gt_positives):
+    if num_gt_positives == 0:
+        return 0
+    data_points = sorted(data_points, key=lambda x: -x[0])
+    precisions = []
+    recalls = []
+    true_positive = 0
+    false_positive = 0
+    for score, is_true in data_points:
+        if is_true:
+            true_positive += 1
+        else:
+            false_positive += 1
+        precisions.append(true_positive / (true_positive + false_positive))
+        recalls.append(true_positive / num_gt_positives)
+    for i in range(len(precisions) - 1, 0, -1):
+        if precisions[i] > precisions[i - 1]:
+            precisions[i - 1] = precisions[i]
+    y_range = [0] * 101
+    x_range = np.array([x / 100 for x in range(101)])
+    indices = np.searchsorted(np.array(recalls), x_range, side='left')
+    for bar_idx, precision_idx in enumerate(indices):
+        if precision_idx < len(precisions):
+            y_range[bar_idx] = precisions[precision_idx]
+    return sum(y_range) / len(y_range)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Test the array based AP is the same as the list based AP, detections pushed one by one and in chunks
+test_cases = [
+    ([], 3),
+    ([(0.9, True)], 0),
+    ([(0.9, True), (0.8, True)], 2),
+    ([(0.9, False), (0.8, False), (0.7, False)], 4),
+    ([(0.5, True), (0.9, False), (0.5, False), (0.7, True), (0.5, True)], 5),
+    ([(float(s), bool(t)) for s, t in zip(rng.choice(np.linspace(0., 1., 11), 200), rng.rand(200) > 0.4)], 150),
+]
+for data_points, num_gt_positives in test_cases:
+    ap_obj = APObject(capacity=4)
+    ap_obj.add_gt_positive(num_gt_positives)
+    for score, is_true in data_points[:3]:
+        ap_obj.push(score, is_true)
+    ap_obj.push_many([d[0] for d in data_points[3:]], [d[1] for d in data_points[3:]])
+    ap = ap_obj.get_ap()
+    ref_ap = reference_get_ap(data_points, num_gt_positives)
+    tf.print(f"ap of {len(data_points)} detections and {num_gt_positives} gt", ap, ref_ap)
+    assert abs(ap - ref_ap) < 1e-12
@@ -0,0 +1,64 @@
+import numpy as np
+import tensorflow as tf
+
+from config import get_params
+from utils.augmentation import BatchedAugmentation
+
+# Todo Add your custom dataset
+tf.random.set_seed(1234)
+NAME_OF_DATASET = "coco"
+
+# -----------------------------------------------------------------------------------------------
+# batch of rectangle masks filling their boxes, as the parser sends them with device augmentation
+train_iter, input_size, num_cls, lrs_schedule_params, loss_params, parser_params, model_params = get_params(
+    NAME_OF_DATASET)
+augmentation_params = parser_params['augmentation_params']
+proto_size = augmentation_params['proto_output_size']
+mask_size = parser_params['device_mask_size']
+augmentor = BatchedAugmentation(**augmentation_params)
+
+rng = np.random.RandomState(1234)
+num_batch, num_max_pad = 8, 6
+num_obj = rng.randint(1, num_max_pad + 1, size=num_batch)
+ymin, xmin = rng.rand(2, num_batch, num_max_pad) * 0.6
+h, w = rng.rand(2, num_batch, num_max_pad) * 0.3 + 0.1
+boxes = np.stack([ymin, xmin, ymin + h, xmin + w], axis=-1).astype(np.float32)
+masks = np.zeros([num_batch, num_max_pad, mask_size, mask_size], np.uint8)
+for i in range(num_batch):
+    for j in range(num_obj[i]):
+        y0, x0, y1, x1 = np.round(boxes[i, j] * mask_size).astype(np.int64)
+        masks[i, j, y0:y1, x0:x1] = 1
+valid = np.arange(num_max_pad) < num_obj[:, None]
+boxes = boxes * valid[..., None]
+labels = rng.randint(1, num_cls, size=[num_batch, num_max_pad]) * valid
+image = tf.constant(rng.randint(0, 256, size=[num_batch, input_size, input_size, 3]), tf.uint8)
+aspect_ratio = tf.constant(rng.rand(num_batch) + 0.5, tf.float32)
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Test the boxes stay on their masks after expand, crop, mirror and resize
+ious = []
+for _ in range(10):
+    out_image, out_masks, out_boxes, out_labels, out_is_crowds, out_num_obj = augmentor(
+        image, tf.constant(masks), tf.constant(boxes), tf.constant(labels), tf.zeros_like(valid), tf.constant(num_obj),
+        aspect_ratio)
+    assert out_image.shape == (num_batch, input_size, input_size, 3)
+    assert out_masks.shape == (num_batch, num_max_pad, proto_size, proto_size)
+    out_masks, out_boxes, out_labels = out_masks.numpy(), out_boxes.numpy() * proto_size, out_labels.numpy()
+    for i in range(num_batch):
+        # kept annotations are moved to the front with their labels, the rest is zero
+        assert set(out_labels[i, :out_num_obj[i]]) <= set(labels[i])
+        assert not out_labels[i, out_num_obj[i]:].any() and not out_masks[i, out_num_obj[i]:].any()
+        for j in range(out_num_obj[i]):
+            ys, xs = np.nonzero(out_masks[i, j])
+            box = out_boxes[i, j]
+            # masks of a few pixels are dominated by the rounding
+            if (box[2] - box[0]) < 8 or (box[3] - box[1]) < 8:
+                continue
+            mask_box = np.array([ys.min(), xs.min(), ys.max() + 1, xs.max() + 1]) if len(ys) else np.zeros(4)
+            inter = np.prod(np.maximum(0, np.minimum(mask_box[2:], box[2:]) - np.maximum(mask_box[:2], box[:2])))
+            union = np.prod(mask_box[2:] - mask_box[:2]) + np.prod(box[2:] - box[:2]) - inter
+            ious.append(inter / union)
+
+tf.print("number of augmented masks", len(ious))
+tf.print("box / mask iou, min and mean", float(np.min(ious)), float(np.mean(ious)))
+assert np.min(ious) > 0.8
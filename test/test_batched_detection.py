@@ -0,0 +1,110 @@
+import numpy as np
+import tensorflow as tf
+
+from config import get_params
+from data.anchor import Anchor
+from layers.detection import Detect
+from utils import utils
+
+# Todo Add your custom dataset
+NAME_OF_DATASET = "coco"
+
+# -----------------------------------------------------------------------------------------------
+# random predictions of a batch, the second image has fewer candidates than max_num_detection and the last image
+# has no score above the confidence threshold
+train_iter, input_size, num_cls, lrs_schedule_params, loss_params, parser_params, model_params = get_params(
+    NAME_OF_DATASET)
+anchorobj = Anchor(**model_params['anchor_params'])
+detect_params = model_params['detect_params']
+num_anchors = anchorobj.get_anchors().shape[0]
+
+rng = np.random.RandomState(1234)
+num_batch, num_mask, proto_size = 3, 32, 138
+pred_offset = rng.randn(num_batch, num_anchors, 4).astype(np.float32) * 0.5
+pred_cls = rng.randn(num_batch, num_anchors, num_cls).astype(np.float32) * 3
+pred_cls[1, 5:, 0] += 100.
+pred_cls[-1, :, 0] += 100.
+prediction = {
+    'pred_offset': tf.constant(pred_offset),
+    'pred_cls': tf.constant(pred_cls),
+    'pred_mask_coef': tf.constant(np.tanh(rng.randn(num_batch, num_anchors, num_mask)).astype(np.float32)),
+    'proto_out': tf.constant(rng.randn(num_batch, proto_size, proto_size, num_mask).astype(np.float32))
+}
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Test the batched detection gives the detections of the per image detection, padded to max_num_detection
+for nms_type in ('fast_nms', 'cc_fast_nms', 'nms'):
+    params = dict(detect_params, nms_type=nms_type)
+    per_image = Detect(anchorobj, **dict(params, batched=False))(prediction)
+    batched = Detect(anchorobj, **dict(params, batched=True))(prediction)
+    assert batched['box'].shape == (num_batch, detect_params['max_num_detection'], 4)
+    for batch_idx in range(num_batch):
+        num_detections = int(batched['num_detections'][batch_idx])
+        result = per_image[batch_idx]['detection']
+        tf.print(f"{nms_type}, image {batch_idx}, detections", num_detections)
+        # padding has score 0
+        assert not np.any(batched['score'][batch_idx, num_detections:])
+        if result is None:
+            assert num_detections == 0
+            continue
+        assert num_detections == result['score'].shape[0]
+        assert np.array_equal(batched['class'][batch_idx, :num_detections], result['class'])
+        for key in ('box', 'score', 'mask'):
+            assert np.allclose(batched[key][batch_idx, :num_detections], result[key], atol=1e-5)
+        assert np.array_equal(batched['proto'][batch_idx], result['proto'])
+    assert int(batched['num_detections'][-1]) == 0 and per_image[-1]['detection'] is None
+
+# ----------------------------------------------------------------------------------------------------------------------
+# candidates with exact duplicate boxes, the same box predicted for several classes and by several anchors
+num_candidates, num_classes = 40, 5
+base_boxes = np.sort(rng.rand(10, 2, 2), axis=1).reshape([10, 4]).astype(np.float32)
+test_boxes = base_boxes[rng.randint(0, 10, size=num_candidates)]
+test_masks = rng.randn(num_candidates, num_mask).astype(np.float32)
+# distinct scores, every (class, box, score) is one candidate
+test_scores = rng.permutation(num_classes * num_candidates).reshape([num_classes, num_candidates]).astype(np.float32)
+test_scores = test_scores / test_scores.size * (rng.rand(num_classes, num_candidates) > 0.5)
+top_k = min(detect_params['top_k'], num_candidates)
+iou_threshold = detect_params['nms_threshold']
+conf_threshold = detect_params['conf_threshold']
+detect = Detect(anchorobj, **detect_params)
+
+
+def kept_candidates(boxes, masks, classes, scores):
+    """candidate of every valid output, found by its box and class score, and checks the output mask is its mask"""
+    kept = set()
+    for box, mask, cls, score in zip(boxes, masks, classes, scores):
+        if score <= 0:
+            continue
+        candidate = np.nonzero(np.all(test_boxes == box, axis=-1) & (test_scores[cls] == score))[0]
+        assert len(candidate) == 1
+        assert np.array_equal(mask, test_masks[candidate[0]])
+        kept.add((int(cls), int(candidate[0])))
+    return kept
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Test greedy NMS keeps the detections of tf.image.non_max_suppression on every class, with the mask coef of the kept
+# candidate
+outputs = [x[0].numpy() for x in detect._batched_nms(
+    tf.constant(test_boxes[None]), tf.constant(test_masks[None]), tf.constant(test_scores[None]), iou_threshold, top_k)]
+reference = set()
+for cls in range(num_classes):
+    keep = tf.image.non_max_suppression(test_boxes, test_scores[cls], top_k, iou_threshold, conf_threshold)
+    reference |= {(cls, int(i)) for i in keep}
+nms_kept = kept_candidates(*outputs)
+tf.print("nms, detections", len(nms_kept), "reference", len(reference))
+assert nms_kept == reference
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Test cross class Fast NMS keeps the best class of every candidate unless a higher score candidate of any class
+# overlaps it, with the mask coef of the kept candidate
+outputs = [x[0].numpy() for x in detect._batched_cc_fast_nms(
+    tf.constant(test_boxes[None]), tf.constant(test_masks[None]), tf.constant(test_scores[None]), iou_threshold, top_k)]
+best_class, best_score = test_scores.argmax(axis=0), test_scores.max(axis=0)
+order = np.argsort(-best_score)
+iou = utils.jaccard(test_boxes[order], test_boxes[order]).numpy()
+reference = {(int(best_class[i]), int(i)) for rank, i in enumerate(order)
+             if best_score[i] > conf_threshold and not np.any(iou[:rank, rank] > iou_threshold)}
+cc_kept = kept_candidates(*outputs)
+tf.print("cc fast nms, detections", len(cc_kept), "reference", len(reference))
+assert cc_kept == reference
@@ -19,6 +19,8 @@ LABEL_REMAP = None
 # create model and dataloader
 train_iter, input_size, num_cls, lrs_schedule_params, loss_params, parser_params, model_params = get_params(
     NAME_OF_DATASET)
+# need the original image for visualization
+parser_params['debug'] = True
 model = Yolact(**model_params)
 dateset = ObjectDetectionDataset(dataset_name=NAME_OF_DATASET,
                                  tfrecord_dir=os.path.join(ROOT_DIR, "data", NAME_OF_DATASET),
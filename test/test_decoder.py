@@ -0,0 +1,58 @@
+import numpy as np
+import tensorflow as tf
+
+from data.coco_tfrecord_decoder import TfExampleDecoder
+from data.coco_tfrecord_utils import binary_mask_to_rle_counts, bytes_feature, bytes_list_feature, \
+    float_list_feature, int64_feature, int64_list_feature
+
+# ----------------------------------------------------------------------------------------------------------------------
+# the same instance masks stored as PNG and as uncompressed RLE
+rng = np.random.RandomState(1234)
+height, width, num_masks = 37, 53, 4
+test_masks = (rng.rand(num_masks, height, width) > 0.5).astype(np.uint8)
+# runs starting with a 1 and a mask of one run
+test_masks[0, 0, 0] = 1
+test_masks[1] = 0
+test_masks[2, :, :20] = 1
+test_masks[2, :, 20:] = 0
+
+
+def make_example(use_rle):
+    feature_dict = {
+        'image/height': int64_feature(height),
+        'image/width': int64_feature(width),
+        'image/encoded': bytes_feature(tf.io.encode_jpeg(tf.zeros([height, width, 3], tf.uint8))),
+        'image/object/bbox/xmin': float_list_feature([0.] * num_masks),
+        'image/object/bbox/xmax': float_list_feature([1.] * num_masks),
+        'image/object/bbox/ymin': float_list_feature([0.] * num_masks),
+        'image/object/bbox/ymax': float_list_feature([1.] * num_masks),
+        'image/object/class/label_id': int64_list_feature([1] * num_masks),
+        'image/object/is_crowd': int64_list_feature([0] * num_masks),
+    }
+    if use_rle:
+        counts = [binary_mask_to_rle_counts(m) for m in test_masks]
+        feature_dict['image/object/mask/rle'] = int64_list_feature(sum(counts, []))
+        feature_dict['image/object/mask/rle_length'] = int64_list_feature([len(c) for c in counts])
+    else:
+        feature_dict['image/object/mask'] = bytes_list_feature(
+            [tf.io.encode_png(m[..., None]).numpy() for m in test_masks])
+    return tf.train.Example(features=tf.train.Features(feature=feature_dict)).SerializeToString()
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Test RLE masks decode to the same masks as PNG masks
+png_masks = TfExampleDecoder().decode(make_example(False))['gt_masks']
+rle_masks = TfExampleDecoder().decode(make_example(True))['gt_masks']
+tf.print("png masks", tf.shape(png_masks), png_masks.dtype)
+tf.print("rle masks", tf.shape(rle_masks), rle_masks.dtype)
+tf.print("png vs rle masks, different pixels", tf.reduce_sum(tf.cast(png_masks != rle_masks, tf.int32)))
+assert np.array_equal(png_masks.numpy(), test_masks) and np.array_equal(rle_masks.numpy(), test_masks)
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Test RLE masks decoded directly at mask_size sample the pixel centers of the full size masks
+mask_size = 24
+sampled_masks = TfExampleDecoder(mask_size=mask_size).decode(make_example(True))['gt_masks']
+ys = ((np.arange(mask_size) + 0.5) * height / mask_size).astype(np.int64)
+xs = ((np.arange(mask_size) + 0.5) * width / mask_size).astype(np.int64)
+tf.print("rle masks at mask size", tf.shape(sampled_masks))
+assert np.array_equal(sampled_masks.numpy(), test_masks[:, ys][:, :, xs])
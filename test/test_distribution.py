@@ -0,0 +1,97 @@
+import numpy as np
+import tensorflow as tf
+
+from config import get_params
+from data.anchor import Anchor
+from loss import loss_yolact
+from train import get_strategy, train_step
+from yolact import Yolact
+
+# Todo Add your custom dataset
+NAME_OF_DATASET = "coco"
+
+# split the CPU into 2 devices, importing the modules above must not have started the tensorflow runtime
+two_replicas_strategy = get_strategy('mirrored', num_cpu_replicas=2)
+one_replica_strategy = tf.distribute.MirroredStrategy(two_replicas_strategy.extended.worker_devices[:1])
+
+# -----------------------------------------------------------------------------------------------
+# one example, one replica trains on it and each of 2 replicas trains on a copy of it, the loss is normalized by the
+# positives of the batch so every replica computes the loss of the single example with the same batch size
+train_iter, input_size, num_cls, lrs_schedule_params, loss_params, parser_params, model_params = get_params(
+    NAME_OF_DATASET)
+# no random subset of the positive anchors in the mask loss
+criterion = loss_yolact.YOLACTLoss(**dict(loss_params, max_masks_for_train=100000))
+proto_size = parser_params['proto_out_size']
+num_max_pad = 8
+
+rng = np.random.RandomState(1234)
+num_obj = 3
+ymin, xmin = rng.rand(2, num_obj) * 0.6
+h, w = rng.rand(2, num_obj) * 0.3 + 0.1
+norm_boxes = np.stack([ymin, xmin, ymin + h, xmin + w], axis=-1).astype(np.float32)
+classes = rng.randint(1, num_cls, size=num_obj)
+masks = np.zeros([num_obj, proto_size, proto_size], np.float32)
+for j, (y0, x0, y1, x1) in enumerate(np.round(norm_boxes * proto_size).astype(np.int64)):
+    masks[j, y0:y1, x0:x1] = 1.
+
+anchorobj = Anchor(**model_params['anchor_params'])
+cls_targets, box_targets, max_id_for_anchors, positiveness = anchorobj.matching(
+    tf.constant(norm_boxes * input_size), tf.constant(classes, tf.int64), 0, **parser_params['matching_params'])
+
+
+def pad(x):
+    return np.pad(x, [[0, num_max_pad - num_obj]] + [[0, 0]] * (np.ndim(x) - 1))
+
+
+example_labels = {
+    'bbox_for_norm': pad(norm_boxes * proto_size),
+    'classes': pad(classes),
+    'num_obj': num_obj,
+    'mask_target': pad(masks),
+    'cls_targets': cls_targets,
+    'box_targets': box_targets,
+    'positiveness': positiveness,
+    'max_id_for_anchors': max_id_for_anchors
+}
+image = tf.constant(rng.rand(1, input_size, input_size, 3).astype(np.float32))
+labels = {k: tf.convert_to_tensor(v)[None] for k, v in example_labels.items()}
+
+
+def train_one_step(strategy, initial_weights=None):
+    """:return: the initial weights of the model and the update of its trainable variables"""
+    with strategy.scope():
+        model = Yolact(**model_params)
+        model(image, training=False)
+        if initial_weights is not None:
+            model.set_weights(initial_weights)
+        initial_weights = model.get_weights()
+        optimizer = tf.keras.optimizers.SGD(learning_rate=1e-3, momentum=0.9)
+        # keras >= 2.11 optimizers can not create their variables in the replica context of the first step
+        if hasattr(optimizer, 'build'):
+            optimizer.build(model.trainable_variables)
+        train_loss = tf.keras.metrics.Mean('train_loss', dtype=tf.float32)
+
+    @tf.function
+    def distributed_train_step(image, labels):
+        return strategy.run(train_step, args=(model, criterion, train_loss, optimizer, image, labels, num_cls))
+
+    initial_variables = [v.numpy() for v in model.trainable_variables]
+    # as train.py, every replica gets its share of the global batch, one copy of the example per replica
+    num_replicas = strategy.num_replicas_in_sync
+    dataset = strategy.distribute_datasets_from_function(
+        lambda input_context: tf.data.Dataset.from_tensor_slices((image, labels)).repeat(num_replicas).batch(
+            input_context.get_per_replica_batch_size(num_replicas)))
+    for batch_image, batch_labels in dataset:
+        distributed_train_step(batch_image, batch_labels)
+    return initial_weights, [v.numpy() - w for v, w in zip(model.trainable_variables, initial_variables)]
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Test the update of 1 replica on the example is the same as the all-reduced update of 2 replicas on its copies
+initial_weights, one_replica = train_one_step(one_replica_strategy)
+_, two_replicas = train_one_step(two_replicas_strategy, initial_weights)
+scale = max(np.max(np.abs(u)) for u in one_replica)
+max_diff = max(np.max(np.abs(u - v)) for u, v in zip(one_replica, two_replicas))
+tf.print("largest update", scale)
+tf.print("1 vs 2 replicas, max difference of the update", max_diff)
+assert max_diff < 1e-4 * scale
@@ -0,0 +1,131 @@
+import numpy as np
+import tensorflow as tf
+
+from loss.loss_yolact import YOLACTLoss
+from utils import utils
+
+# ----------------------------------------------------------------------------------------------------------------------
+# random predictions and targets of a batch, image 2 has no positive anchor
+rng = np.random.RandomState(1234)
+num_batch, num_anchors, num_max_pad, proto_size, num_mask, num_cls = 4, 300, 8, 138, 32, 81
+num_obj = np.array([3, 8, 0, 5], np.int32)
+
+positiveness = rng.choice([-1., 0., 1.], size=[num_batch, num_anchors], p=[0.1, 0.8, 0.1]).astype(np.float32)
+positiveness[2] = np.minimum(positiveness[2], 0.)
+max_id_for_anchors = rng.randint(0, num_max_pad, size=[num_batch, num_anchors])
+max_id_for_anchors = np.minimum(max_id_for_anchors, np.maximum(num_obj[:, None] - 1, 0)).astype(np.int64)
+classes = rng.randint(1, num_cls, size=[num_batch, num_max_pad]) * (np.arange(num_max_pad) < num_obj[:, None])
+cls_targets = np.take_along_axis(classes, max_id_for_anchors, axis=1) * positiveness
+
+gt_masks = (rng.rand(num_batch, num_max_pad, proto_size, proto_size) > 0.6).astype(np.float32)
+gt_masks *= (np.arange(num_max_pad) < num_obj[:, None])[..., None, None]
+ymin, xmin = rng.rand(2, num_batch, num_max_pad) * proto_size * 0.6
+h, w = (rng.rand(2, num_batch, num_max_pad) * 0.3 + 0.1) * proto_size
+bbox_norm = np.stack([ymin, xmin, ymin + h, xmin + w], axis=-1).astype(np.float32)
+
+proto_out = tf.constant(rng.randn(num_batch, proto_size, proto_size, num_mask).astype(np.float32))
+pred_mask_coef = tf.constant(np.tanh(rng.randn(num_batch, num_anchors, num_mask)).astype(np.float32))
+positiveness = tf.constant(positiveness)
+max_id_for_anchors = tf.constant(max_id_for_anchors)
+gt_masks = tf.constant(gt_masks)
+bbox_norm = tf.constant(bbox_norm)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# reference loss of every image separately, as before the losses were batched
+def reference_loss_mask(proto_output, pred_mask_coef, gt_bbox_norm, gt_masks, positiveness, max_id_for_anchors):
+    loss_mask = 0.
+    total_pos = 0
+    for idx in range(proto_output.shape[0]):
+        pos_indices = tf.where(positiveness[idx] == 1)[:, 0]
+        if tf.size(pos_indices) == 0:
+            continue
+        pos_mask_coef = tf.gather(pred_mask_coef[idx], pos_indices)
+        pos_max_id = tf.gather(max_id_for_anchors[idx], pos_indices)
+        gt = tf.gather(gt_masks[idx], pos_max_id)
+        bbox = tf.gather(gt_bbox_norm[idx], pos_max_id)
+        total_pos += tf.size(pos_indices)
+
+        pred_mask = tf.transpose(tf.linalg.matmul(proto_output[idx], pos_mask_coef, transpose_b=True), perm=(2, 0, 1))
+        s = utils.crop(tf.nn.sigmoid_cross_entropy_with_logits(gt, pred_mask), bbox)
+        bbox_center = utils.map_to_center_form(bbox)
+        loss_mask += tf.reduce_sum(tf.reduce_sum(s, axis=[1, 2]) / (bbox_center[:, -1] * bbox_center[:, -2]))
+    return loss_mask / tf.cast(total_pos, tf.float32)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Test the batched mask loss is the same as the loss of every image, without subsampling the positive anchors
+loss_mask = reference_loss_mask(proto_out, pred_mask_coef, bbox_norm, gt_masks, positiveness, max_id_for_anchors)
+tf.print("reference mask loss", loss_mask)
+for static_shapes in (False, True):
+    batched_loss_mask = YOLACTLoss(static_shapes=static_shapes)._loss_mask(
+        proto_out, pred_mask_coef, bbox_norm, gt_masks, positiveness, max_id_for_anchors,
+        max_masks_for_train=num_anchors)
+    tf.print(f"batched mask loss (static shapes: {static_shapes})", batched_loss_mask)
+    assert abs(float(batched_loss_mask) - float(loss_mask)) < 1e-4 * abs(float(loss_mask))
+
+# ----------------------------------------------------------------------------------------------------------------------
+# reference semantic segmentation loss of every image separately, class c predicted by channel c - 1 and the
+# overlapping masks of a class merged, as the original YOLACT
+pred_seg = tf.constant(rng.randn(num_batch, 69, 69, num_cls - 1).astype(np.float32))
+# repeated classes to overlap the masks of the same class
+seg_classes = tf.constant(np.minimum(classes, 5))
+
+
+def reference_loss_semantic_segmentation(pred_seg, mask_gt, classes, num_obj):
+    seg_shape = pred_seg.shape[1]
+    loss_seg = 0.
+    for idx in range(pred_seg.shape[0]):
+        masks = tf.image.resize(tf.expand_dims(mask_gt[idx, :num_obj[idx]], axis=-1), [seg_shape, seg_shape])
+        masks = tf.cast(masks[..., 0] > 0.5, tf.float32).numpy()
+        seg_gt = np.zeros(pred_seg.shape[1:], np.float32)
+        for obj_mask, cls in zip(masks, classes[idx, :num_obj[idx]].numpy()):
+            seg_gt[..., cls - 1] = np.maximum(seg_gt[..., cls - 1], obj_mask)
+        loss_seg += tf.reduce_sum(tf.nn.sigmoid_cross_entropy_with_logits(seg_gt, pred_seg[idx]))
+    return loss_seg / seg_shape ** 2 / pred_seg.shape[0]
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Test the batched semantic segmentation loss is the same as the loss of every image
+loss_seg = reference_loss_semantic_segmentation(pred_seg, gt_masks, seg_classes, num_obj)
+batched_loss_seg = YOLACTLoss()._loss_semantic_segmentation(pred_seg, gt_masks, seg_classes, tf.constant(num_obj))
+tf.print("reference semantic segmentation loss", loss_seg)
+tf.print("batched semantic segmentation loss", batched_loss_seg)
+assert abs(float(batched_loss_seg) - float(loss_seg)) < 1e-4 * abs(float(loss_seg))
+
+# ----------------------------------------------------------------------------------------------------------------------
+# reference classification loss, hard negatives mined by sorting all the anchors of every image twice
+pred_cls = tf.constant(rng.randn(num_batch, num_anchors, num_cls).astype(np.float32) * 3)
+cls_targets = tf.constant(cls_targets.astype(np.float32))
+
+
+def reference_loss_class(pred_cls, gt_cls, num_cls, positiveness, neg_pos_ratio=3):
+    pred_cls = tf.reshape(pred_cls, [-1, num_cls])
+    pred_cls_max = tf.reduce_max(pred_cls)
+    logsumexp_pred_cls = tf.math.log(
+        tf.reduce_sum(tf.math.exp(pred_cls - pred_cls_max), -1)) + pred_cls_max - pred_cls[:, 0]
+    logsumexp_pred_cls = tf.reshape(logsumexp_pred_cls, [tf.shape(gt_cls)[0], -1])
+    non_neg_mask = tf.cast(gt_cls == 0, tf.float32)
+    logsumexp_pred_cls = logsumexp_pred_cls * non_neg_mask
+
+    idx = tf.argsort(logsumexp_pred_cls, axis=1, direction="DESCENDING")
+    idx_rank = tf.argsort(idx, axis=1)
+    num_pos = tf.reduce_sum(tf.cast((positiveness == 1), tf.int32), axis=-1, keepdims=True)
+    num_neg = tf.clip_by_value(num_pos * neg_pos_ratio, 0, tf.shape(positiveness)[-1] - 1)
+    negative_bool = tf.cast(idx_rank < num_neg, tf.float32) * non_neg_mask
+
+    idxes = tf.concat([tf.where(positiveness == 1), tf.where(negative_bool == 1)], axis=0)
+    pred_selected = tf.gather_nd(tf.reshape(pred_cls, [-1, tf.shape(positiveness)[-1], num_cls]), idxes)
+    gt_selected = tf.one_hot(tf.cast(tf.gather_nd(gt_cls, idxes), tf.int32), depth=num_cls)
+    loss_conf = tf.nn.softmax_cross_entropy_with_logits(gt_selected, pred_selected)
+    return tf.reduce_sum(loss_conf) / tf.cast(tf.reduce_sum(num_pos), tf.float32)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Test the hard negatives mined with top_k (or a threshold with static shapes) give the same loss as sorting
+loss_class = reference_loss_class(pred_cls, cls_targets, num_cls, positiveness)
+tf.print("reference class loss", loss_class)
+for static_shapes in (False, True):
+    topk_loss_class = YOLACTLoss(static_shapes=static_shapes)._loss_class(pred_cls, cls_targets, num_cls, positiveness)
+    tf.print(f"class loss (static shapes: {static_shapes})", topk_loss_class)
+    assert abs(float(topk_loss_class) - float(loss_class)) < 1e-4 * abs(float(loss_class))
@@ -0,0 +1,27 @@
+import numpy as np
+import tensorflow as tf
+
+from utils.utils import mask_iou, packed_mask_iou
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Test the bit packed mask iou is the same as the float32 mask iou for binary masks
+rng = np.random.RandomState(1234)
+test_pred_masks = (rng.rand(7, 138, 138) > 0.6).astype(np.float32)
+test_gt_masks = (rng.rand(3, 138, 138) > 0.4).astype(np.float32)
+# empty mask, iou is nan on both paths
+test_gt_masks[2] = 0
+
+for is_crowd in (False, True):
+    m_iou = mask_iou(test_pred_masks, test_gt_masks, is_crowd).numpy()
+    packed_iou = packed_mask_iou(test_pred_masks, test_gt_masks, is_crowd)
+    tf.print(f"test packed mask iou shape (crowd: {is_crowd})", packed_iou.shape)
+    tf.print(f"max difference to mask iou (crowd: {is_crowd})", float(np.nanmax(np.abs(packed_iou - m_iou))))
+    assert np.allclose(packed_iou, m_iou, equal_nan=True)
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Test no mask on one side, e.g. a val image with crowd annotations only
+for num_pred, num_gt in ((3, 0), (0, 3), (0, 0)):
+    m_iou = mask_iou(np.ones([num_pred, 138, 138], np.float32), np.ones([num_gt, 138, 138], np.float32)).numpy()
+    packed_iou = packed_mask_iou(np.ones([num_pred, 138, 138]), np.ones([num_gt, 138, 138]))
+    tf.print(f"test empty masks ({num_pred}, {num_gt})", packed_iou.shape, m_iou.shape)
+    assert packed_iou.shape == m_iou.shape == (num_pred, num_gt)
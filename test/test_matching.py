@@ -0,0 +1,56 @@
+import numpy as np
+import tensorflow as tf
+
+from config import get_params
+from data.anchor import Anchor
+
+# Todo Add your custom dataset
+NAME_OF_DATASET = "coco"
+
+# -----------------------------------------------------------------------------------------------
+# random annotations in pixels of the input image, crowd annotations are put after non-crowd annotations
+train_iter, input_size, num_cls, lrs_schedule_params, loss_params, parser_params, model_params = get_params(
+    NAME_OF_DATASET)
+anchorobj = Anchor(**model_params['anchor_params'])
+matching_params = parser_params['matching_params']
+
+rng = np.random.RandomState(1234)
+test_samples = []
+for num_obj, num_crowd in ((1, 0), (5, 0), (7, 2), (4, 3), (20, 1)):
+    ymin, xmin = rng.rand(2, num_obj) * input_size * 0.8
+    h, w = (rng.rand(2, num_obj) * 0.5 + 0.02) * input_size
+    bbox = np.stack([ymin, xmin, np.minimum(ymin + h, input_size), np.minimum(xmin + w, input_size)], axis=-1)
+    labels = rng.randint(1, num_cls, size=num_obj)
+    test_samples.append((tf.constant(bbox, tf.float32), tf.constant(labels, tf.int64), num_crowd))
+
+
+def max_difference(a, b):
+    return tf.reduce_max(tf.abs(tf.cast(a, tf.float32) - tf.cast(b, tf.float32)))
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Test the sparse matching gives the same targets as the dense matching
+for bbox, labels, num_crowd in test_samples:
+    dense = anchorobj.matching(bbox, labels, num_crowd, **dict(matching_params, sparse_matching=False))
+    sparse = anchorobj.matching(bbox, labels, num_crowd, **dict(matching_params, sparse_matching=True))
+    diffs = [max_difference(x, y) for x, y in zip(dense, sparse)]
+    tf.print(f"dense vs sparse matching ({bbox.shape[0]} gt, {num_crowd} crowd), max difference", diffs)
+    for diff in diffs:
+        assert diff < 1e-5
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Test the batched matching of padded annotations gives the same targets as matching every image
+batched_params = {k: v for k, v in matching_params.items() if k != 'sparse_matching'}
+num_max_pad = max(bbox.shape[0] for bbox, _, _ in test_samples)
+batch_bbox = tf.stack([tf.pad(bbox, [[0, num_max_pad - bbox.shape[0]], [0, 0]]) for bbox, _, _ in test_samples])
+batch_labels = tf.stack([tf.pad(labels, [[0, num_max_pad - labels.shape[0]]]) for _, labels, _ in test_samples])
+batch_num_obj = tf.constant([bbox.shape[0] for bbox, _, _ in test_samples])
+batch_num_crowd = tf.constant([num_crowd for _, _, num_crowd in test_samples])
+batched = anchorobj.batched_matching(batch_bbox, batch_labels, batch_num_obj, batch_num_crowd, **batched_params)
+
+for i, (bbox, labels, num_crowd) in enumerate(test_samples):
+    dense = anchorobj.matching(bbox, labels, num_crowd, **dict(matching_params, sparse_matching=False))
+    diffs = [max_difference(x, y[i]) for x, y in zip(dense, batched)]
+    tf.print(f"dense vs batched matching ({bbox.shape[0]} gt, {num_crowd} crowd), max difference", diffs)
+    for diff in diffs:
+        assert diff < 1e-4
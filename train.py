@@ -1,6 +1,7 @@
 import contextlib
 import datetime
 import os
+import tempfile
 
 import tensorflow as tf
 # it s recommanded to use absl for tf 2.0
@@ -25,7 +26,15 @@ flags.DEFINE_string('tfrecord_dir', 'data',
 flags.DEFINE_string('weights', 'weights',
                     'path to store weights')
 flags.DEFINE_integer('batch_size', 3,
-                     'batch size')
+                     'batch size per replica')
+flags.DEFINE_integer('eval_batch_size', 1,
+                     'batch size for validation')
+flags.DEFINE_enum('distribution', 'default', ['default', 'mirrored', 'multi_worker'],
+                  'default: one device, mirrored: all the local GPUs, multi_worker: the workers of TF_CONFIG')
+flags.DEFINE_integer('num_cpu_replicas', 0,
+                     'split the CPU into this many devices for the mirrored strategy, to try distribution without GPUs')
+flags.DEFINE_boolean('jit_compile', False,
+                     'compile train_step with XLA, the loss then uses static shapes only')
 flags.DEFINE_float('momentum', 0.9,
                    'momentum')
 flags.DEFINE_float('weight_decay', 5 * 1e-4,
@@ -34,27 +43,75 @@ flags.DEFINE_float('print_interval', 10,
                    'number of iteration between printing loss')
 flags.DEFINE_float('save_interval', 100,
                    'number of iteration between saving model(checkpoint)')
+flags.DEFINE_string('checkpoint_dir', './checkpoints',
+                    'directory of the checkpoints')
+flags.DEFINE_boolean('inline_eval', True,
+                     'evaluate after saving every checkpoint, disable it when eval_worker.py evaluates the checkpoints')
 
 
-@tf.function
 def train_step(model,
                loss_fn,
                metrics,
                optimizer,
                image,
                labels,
-               num_cls):
+               num_cls,
+               matching_params=None,
+               device_augmentation=None):
+    if device_augmentation is not None:
+        # augment the batch on the device, the parser only decoded and resized it
+        image, labels = device_augmentation(image, labels)
+    if matching_params is not None:
+        # match anchors for the whole batch on the device instead of per sample in the parser
+        cls_targets, box_targets, max_id_for_anchors, positiveness = model.anchor_instance.batched_matching(
+            labels['match_bbox'], labels['match_classes'], labels['match_num_obj'], labels['num_crowd'],
+            **matching_params)
+        labels = dict(labels,
+                      cls_targets=cls_targets,
+                      box_targets=box_targets,
+                      max_id_for_anchors=max_id_for_anchors,
+                      positiveness=positiveness)
     # training using tensorflow gradient tape
     with tf.GradientTape() as tape:
         output = model(image, training=True)
         loc_loss, conf_loss, mask_loss, seg_loss, total_loss = loss_fn(output, labels, num_cls)
-    grads = tape.gradient(total_loss, model.trainable_variables)
+        # gradients are summed over the replicas, scale the loss of each replica so they are averaged
+        scaled_loss = total_loss / tf.distribute.get_strategy().num_replicas_in_sync
+    grads = tape.gradient(scaled_loss, model.trainable_variables)
     optimizer.apply_gradients(zip(grads, model.trainable_variables))
     metrics.update_state(total_loss)
     return loc_loss, conf_loss, mask_loss, seg_loss
 
 
+def get_strategy(distribution, num_cpu_replicas=0):
+    if num_cpu_replicas:
+        # must run before tensorflow initializes the devices
+        cpu = tf.config.list_physical_devices('CPU')[0]
+        tf.config.set_logical_device_configuration(cpu, [tf.config.LogicalDeviceConfiguration()] * num_cpu_replicas)
+    if distribution == 'mirrored':
+        devices = [d.name for d in tf.config.list_logical_devices('CPU')] if num_cpu_replicas else None
+        return tf.distribute.MirroredStrategy(devices)
+    if distribution == 'multi_worker':
+        # cluster and task of this worker come from the TF_CONFIG environment variable
+        return tf.distribute.MultiWorkerMirroredStrategy()
+    return tf.distribute.get_strategy()
+
+
+def is_chief(strategy):
+    # the worker writing checkpoints, summaries and running the evaluation
+    resolver = strategy.cluster_resolver
+    if resolver is None or not resolver.task_type:
+        return True
+    if resolver.task_type == 'chief':
+        return True
+    return resolver.task_type == 'worker' and resolver.task_id == 0 and 'chief' not in resolver.cluster_spec().jobs
+
+
 def main(argv):
+    strategy = get_strategy(FLAGS.distribution, FLAGS.num_cpu_replicas)
+    chief = is_chief(strategy)
+    logging.info("Number of replicas: %d" % strategy.num_replicas_in_sync)
+
     # set fixed random seed, load config files
     tf.random.set_seed(RANDOM_SEED)
 
@@ -82,14 +139,15 @@ def main(argv):
     # -----------------------------------------------------------------
     # Creating the instance of the model specified.
     logging.info("Creating the model instance of YOLACT")
-    model = Yolact(**model_params)
+    with strategy.scope():
+        model = Yolact(**model_params)
 
-    # add weight decay
-    for layer in model.layers:
-        if isinstance(layer, tf.keras.layers.Conv2D) or isinstance(layer, tf.keras.layers.Dense):
-            layer.add_loss(lambda: tf.keras.regularizers.l2(FLAGS.weight_decay)(layer.kernel))
-        if hasattr(layer, 'bias_regularizer') and layer.use_bias:
-            layer.add_loss(lambda: tf.keras.regularizers.l2(FLAGS.weight_decay)(layer.bias))
+        # add weight decay
+        for layer in model.layers:
+            if isinstance(layer, tf.keras.layers.Conv2D) or isinstance(layer, tf.keras.layers.Dense):
+                layer.add_loss(lambda: tf.keras.regularizers.l2(FLAGS.weight_decay)(layer.kernel))
+            if hasattr(layer, 'bias_regularizer') and layer.use_bias:
+                layer.add_loss(lambda: tf.keras.regularizers.l2(FLAGS.weight_decay)(layer.bias))
 
     # -----------------------------------------------------------------
     # Creating dataloaders for training and validation
@@ -98,24 +156,56 @@ def main(argv):
                                      tfrecord_dir=os.path.join(FLAGS.tfrecord_dir, FLAGS.name),
                                      anchor_instance=model.anchor_instance,
                                      **parser_params)
-    train_dataset = dateset.get_dataloader(subset='train', batch_size=FLAGS.batch_size)
-    valid_dataset = dateset.get_dataloader(subset='val', batch_size=1)
-    # count number of valid data for progress bar
-    # Todo any better way to do it?
-    num_val = 0
-    for _ in valid_dataset:
-        num_val += 1
+    # every replica gets batch_size examples, every worker reads its own tfrecord files
+    global_batch_size = FLAGS.batch_size * strategy.num_replicas_in_sync
+    train_dataset = strategy.distribute_datasets_from_function(
+        lambda input_context: dateset.get_dataloader(
+            subset='train', batch_size=input_context.get_per_replica_batch_size(global_batch_size),
+            input_context=input_context))
+    if FLAGS.inline_eval:
+        valid_dataset = dateset.get_eval_dataloader(subset='val', batch_size=FLAGS.eval_batch_size)
+        # number of valid data for progress bar, from the index written with the tfrecords
+        num_val = dateset.num_examples('val')
+    # anchors matched inside train_step when the parser only pads the annotations
+    # the batch is always matched with the dense IoU, sparse matching is only for the parser
+    device_matching_params = dict(parser_params['matching_params'])
+    if device_matching_params.pop('sparse_matching', False) and (
+            parser_params['matching_on_device'] or parser_params['device_augmentation']):
+        logging.info("SPARSE_MATCHING has no effect when the anchors are matched on the device")
+    matching_params = device_matching_params if parser_params['matching_on_device'] else None
+    # augmentation inside train_step, anchors can only be matched after it
+    device_augmentation = None
+    if parser_params['device_augmentation']:
+        device_augmentation = dateset.get_device_augmentation()
+        matching_params = device_matching_params
+    # CropAndResize has no XLA kernel, with jit_compile the batch is augmented outside of the compiled train_step
+    batch_augmentation = None
+    if FLAGS.jit_compile and device_augmentation is not None:
+        batch_augmentation = device_augmentation
+        device_augmentation = None
     # -----------------------------------------------------------------
     # Choose the Optimizor, Loss Function, and Metrics, learning rate schedule
     lr_schedule = learning_rate_schedule.Yolact_LearningRateSchedule(**lrs_schedule_params)
     logging.info("Initiate the Optimizer and Loss function...")
-    optimizer = tf.keras.optimizers.SGD(learning_rate=lr_schedule, momentum=FLAGS.momentum)
-    criterion = loss_yolact.YOLACTLoss(**loss_params)
-    train_loss = tf.keras.metrics.Mean('train_loss', dtype=tf.float32)
+    criterion = loss_yolact.YOLACTLoss(static_shapes=FLAGS.jit_compile, **loss_params)
+    with strategy.scope():
+        optimizer = tf.keras.optimizers.SGD(learning_rate=lr_schedule, momentum=FLAGS.momentum)
+        train_loss = tf.keras.metrics.Mean('train_loss', dtype=tf.float32)
     loc = tf.keras.metrics.Mean('loc_loss', dtype=tf.float32)
     conf = tf.keras.metrics.Mean('conf_loss', dtype=tf.float32)
     mask = tf.keras.metrics.Mean('mask_loss', dtype=tf.float32)
     seg = tf.keras.metrics.Mean('seg_loss', dtype=tf.float32)
+
+    # one trace (and XLA compilation) per batch shape, see PADDING_BUCKETS
+    train_step_fn = tf.function(train_step, jit_compile=FLAGS.jit_compile)
+
+    @tf.function
+    def distributed_train_step(image, labels):
+        if batch_augmentation is not None:
+            image, labels = strategy.run(batch_augmentation, args=(image, labels))
+        losses = strategy.run(train_step_fn, args=(model, criterion, train_loss, optimizer, image, labels, num_cls,
+                                                   matching_params, device_augmentation))
+        return [strategy.reduce(tf.distribute.ReduceOp.MEAN, loss, axis=None) for loss in losses]
     # -----------------------------------------------------------------
 
     # Setup the TensorBoard for better visualization
@@ -131,15 +221,18 @@ def main(argv):
     # Start the Training and Validation Process
     logging.info("Start the training process...")
 
-    # setup checkpoints manager
-    checkpoint = tf.train.Checkpoint(step=tf.Variable(1), optimizer=optimizer, model=model)
+    # setup checkpoints manager, every worker has to save but only the chief keeps the checkpoints
+    with strategy.scope():
+        checkpoint = tf.train.Checkpoint(step=tf.Variable(1), optimizer=optimizer, model=model)
+    checkpoint_dir = FLAGS.checkpoint_dir
     manager = tf.train.CheckpointManager(
-        checkpoint, directory="./checkpoints", max_to_keep=5
+        checkpoint, directory=checkpoint_dir if chief else tempfile.mkdtemp(), max_to_keep=5
     )
     # restore from latest checkpoint and iteration
-    status = checkpoint.restore(manager.latest_checkpoint)
-    if manager.latest_checkpoint:
-        logging.info("Restored from {}".format(manager.latest_checkpoint))
+    latest_checkpoint = tf.train.latest_checkpoint(checkpoint_dir)
+    status = checkpoint.restore(latest_checkpoint)
+    if latest_checkpoint:
+        logging.info("Restored from {}".format(latest_checkpoint))
     else:
         logging.info("Initializing from scratch.")
 
@@ -158,20 +251,20 @@ def main(argv):
                       'loop_optimization': True,
                       'arithmetic_optimization': True,
                       'remapping': True}):
-            loc_loss, conf_loss, mask_loss, seg_loss = train_step(model, criterion, train_loss, optimizer, image,
-                                                                  labels, num_cls)
+            loc_loss, conf_loss, mask_loss, seg_loss = distributed_train_step(image, labels)
         loc.update_state(loc_loss)
         conf.update_state(conf_loss)
         mask.update_state(mask_loss)
         seg.update_state(seg_loss)
-        with train_summary_writer.as_default():
-            tf.summary.scalar('Total loss', train_loss.result(), step=iterations)
-            tf.summary.scalar('Loc loss', loc.result(), step=iterations)
-            tf.summary.scalar('Conf loss', conf.result(), step=iterations)
-            tf.summary.scalar('Mask loss', mask.result(), step=iterations)
-            tf.summary.scalar('Seg loss', seg.result(), step=iterations)
 
         if iterations and iterations % FLAGS.print_interval == 0:
+            if chief:
+                with train_summary_writer.as_default():
+                    tf.summary.scalar('Total loss', train_loss.result(), step=iterations)
+                    tf.summary.scalar('Loc loss', loc.result(), step=iterations)
+                    tf.summary.scalar('Conf loss', conf.result(), step=iterations)
+                    tf.summary.scalar('Mask loss', mask.result(), step=iterations)
+                    tf.summary.scalar('Seg loss', seg.result(), step=iterations)
             tf.print("Iteration {}, LR: {}, Total Loss: {}, B: {},  C: {}, M: {}, S:{} ".format(
                 iterations,
                 optimizer._decayed_lr(var_dtype=tf.float32),
@@ -187,19 +280,20 @@ def main(argv):
             save_path = manager.save()
             logging.info("Saved checkpoint for step {}: {}".format(int(checkpoint.step), save_path))
 
-            # validation and print mAP table
-            all_map = evaluate(model, valid_dataset, num_val, num_cls)
-            box_map, mask_map = all_map['box']['all'], all_map['mask']['all']
-            tf.print(f"box mAP:{box_map}, mask mAP:{mask_map}")
+            # validation and print mAP table, the other workers wait for the chief at the next step
+            if chief and FLAGS.inline_eval:
+                all_map = evaluate(model, valid_dataset, num_val, num_cls)
+                box_map, mask_map = all_map['box']['all'], all_map['mask']['all']
+                tf.print(f"box mAP:{box_map}, mask mAP:{mask_map}")
 
-            with test_summary_writer.as_default():
-                tf.summary.scalar('Box mAP', box_map, step=iterations)
-                tf.summary.scalar('Mask mAP', mask_map, step=iterations)
+                with test_summary_writer.as_default():
+                    tf.summary.scalar('Box mAP', box_map, step=iterations)
+                    tf.summary.scalar('Mask mAP', mask_map, step=iterations)
 
-            # Saving the weights:
-            if mask_map > best_masks_map:
-                best_masks_map = mask_map
-                model.save_weights(f'{FLAGS.weights}/weights_{FLAGS.name}_{str(best_masks_map)}.h5')
+                # Saving the weights:
+                if mask_map > best_masks_map:
+                    best_masks_map = mask_map
+                    model.save_weights(f'{FLAGS.weights}/weights_{FLAGS.name}_{str(best_masks_map)}.h5')
 
             # reset the metrics
             train_loss.reset_states()
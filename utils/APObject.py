@@ -1,98 +1,159 @@
 """
 Adapted from https://github.com/dbolya/yolact/blob/master/eval.py
 """
+import json
+
 import numpy as np
+import tensorflow as tf
 
 
 class Detections:
     """
     Collection of detected information (include bbox and mask)
+    Detections are written to COCO results json files every chunk_size detections instead of kept until the end
     """
 
-    def __init__(self):
+    def __init__(self, bbox_path, mask_path, label_map=None, chunk_size=1000):
+        """
+        :param bbox_path: results json of the boxes
+        :param mask_path: results json of the masks
+        :param label_map: dataset category id to class label, as in config.LABEL_MAP, None if they are the same
+        :param chunk_size: number of boxes / masks kept in memory before writing them
+        """
         self.bbox_data = []
         self.mask_data = []
-
-    def add_box(self):
-        ...
-
-    def add_mask(self):
-        ...
+        self.chunk_size = chunk_size
+        self.category_ids = None if label_map is None else {v: k for k, v in label_map.items()}
+        # results are one json list per file, opened now and closed by to_json or close
+        self._files = {'bbox': tf.io.gfile.GFile(bbox_path, 'w'), 'mask': tf.io.gfile.GFile(mask_path, 'w')}
+        self._num_written = {'bbox': 0, 'mask': 0}
+        for f in self._files.values():
+            f.write('[')
+
+    def _category_id(self, class_label):
+        class_label = int(class_label)
+        return class_label if self.category_ids is None else self.category_ids[class_label]
+
+    def add_box(self, image_id, class_label, box, score):
+        """
+        :param box: (ymin, xmin, ymax, xmax) in pixels of the original image
+        """
+        ymin, xmin, ymax, xmax = [float(x) for x in box]
+        self.bbox_data.append({
+            'image_id': image_id,
+            'category_id': self._category_id(class_label),
+            'bbox': [round(x, 2) for x in (xmin, ymin, xmax - xmin, ymax - ymin)],
+            'score': float(score)
+        })
+        if len(self.bbox_data) >= self.chunk_size:
+            self._write('bbox', self.bbox_data)
+
+    def add_mask(self, image_id, class_label, mask, score):
+        """
+        :param mask: [height, width] binary mask of the original image
+        """
+        # only needed to write the results
+        from pycocotools import mask as mask_util
+
+        rle = mask_util.encode(np.asfortranarray(mask, dtype=np.uint8))
+        rle['counts'] = rle['counts'].decode('ascii')
+        self.mask_data.append({
+            'image_id': image_id,
+            'category_id': self._category_id(class_label),
+            'segmentation': rle,
+            'score': float(score)
+        })
+        if len(self.mask_data) >= self.chunk_size:
+            self._write('mask', self.mask_data)
+
+    def _write(self, iou_type, data):
+        for d in data:
+            self._files[iou_type].write((',' if self._num_written[iou_type] else '') + json.dumps(d))
+            self._num_written[iou_type] += 1
+        data.clear()
 
     def to_json(self):
         """
         dump to json file for benchmark use, for coco-test dev benchmark
+        writes the remaining detections and closes the files
         """
-        ...
+        self.close()
 
+    def close(self):
+        """
+        writes the remaining detections and ends the json lists, so the files are valid json with the detections
+        added so far, does nothing if the files are already closed
+        """
+        for iou_type, data in (('bbox', self.bbox_data), ('mask', self.mask_data)):
+            if iou_type in self._files:
+                self._write(iou_type, data)
+                f = self._files.pop(iou_type)
+                f.write(']')
+                f.close()
 
 class APObject:
     """
     Object to store mAP related information for 1 IOU threshhold (0.5 ~ 0.95) and 1 class (80)
     Ex: class "cat" 's mAP at threshold 0.5 is stored into a APObject
+    Scores and true / false positive of the detections are kept in preallocated arrays, grown by doubling
     """
 
-    def __init__(self):
-        self.data_points = []
+    def __init__(self, capacity=64):
+        self.scores = np.zeros(capacity, dtype=np.float64)
+        self.is_true = np.zeros(capacity, dtype=bool)
+        self.num_data_points = 0
         self.num_gt_positives = 0
 
     def push(self, score, is_true):
-        self.data_points.append((score, is_true))
+        self.push_many([score], [is_true])
+
+    def push_many(self, scores, is_true):
+        num_new = len(scores)
+        end = self.num_data_points + num_new
+        if end > len(self.scores):
+            capacity = max(2 * len(self.scores), end)
+            self.scores = np.resize(self.scores, capacity)
+            self.is_true = np.resize(self.is_true, capacity)
+        self.scores[self.num_data_points:end] = scores
+        self.is_true[self.num_data_points:end] = is_true
+        self.num_data_points = end
 
     def add_gt_positive(self, num_positives):
         self.num_gt_positives += num_positives
 
     def is_empty(self):
-        return len(self.data_points) == 0 and self.num_gt_positives == 0
+        return self.num_data_points == 0 and self.num_gt_positives == 0
 
     def get_ap(self):
-        if self.num_gt_positives == 0:
+        if self.num_gt_positives == 0 or self.num_data_points == 0:
             return 0
 
         # Sort by score in descending order
-        self.data_points.sort(key=lambda x: -x[0])
-
-        precisions = []
-        recalls = []
-        true_positive = 0
-        false_positive = 0
+        order = np.argsort(-self.scores[:self.num_data_points], kind='stable')
+        is_true = self.is_true[:self.num_data_points][order]
 
         # compute points in precision-recall curve
         # X-axis: recalls Y-axis: precisions
-        for datapoint in self.data_points:
-            # check if the detection is true or false positive
-            if datapoint[1]:
-                true_positive += 1
-            else:
-                false_positive += 1
-
-            # calculate precision and recall
-            precision = true_positive / (true_positive + false_positive)
-            recall = true_positive / self.num_gt_positives
-
-            precisions.append(precision)
-            recalls.append(recall)
+        true_positive = np.cumsum(is_true)
+        false_positive = np.cumsum(~is_true)
+        precisions = true_positive / (true_positive + false_positive)
+        recalls = true_positive / self.num_gt_positives
 
         # compute AP, some details needed
-        # smooth the curve
-        for i in range(len(precisions) - 1, 0, -1):
-            if precisions[i] > precisions[i - 1]:
-                precisions[i - 1] = precisions[i]
+        # smooth the curve, every precision becomes the max of the precisions after it
+        precisions = np.maximum.accumulate(precisions[::-1])[::-1]
 
         # Compute the integral of precision(recall) d_recall from recall=0->1 using fixed-length riemann summation
         # with 101 bars.
-        y_range = [0] * 101  # idx 0 is recall == 0.0 and idx 100 is recall == 1.00
+        # idx 0 is recall == 0.0 and idx 100 is recall == 1.00
         x_range = np.array([x / 100 for x in range(101)])
-        recalls = np.array(recalls)
 
         # I realize this is weird, but all it does is find the nearest precision(x) for a given x in x_range.
         # Basically, if the closest recall we have to 0.01 is 0.009 this sets precision(0.01) = precision(0.009).
         # I approximate the integral this way, because that's how COCOEval does it.
         indices = np.searchsorted(recalls, x_range, side='left')
-        for bar_idx, precision_idx in enumerate(indices):
-            if precision_idx < len(precisions):
-                y_range[bar_idx] = precisions[precision_idx]
+        y_range = np.where(indices < len(precisions), precisions[np.minimum(indices, len(precisions) - 1)], 0.)
 
         # Finally compute the riemann sum to get our integral.
         # avg([precision(x) for x in 0:0.01:1])
-        return sum(y_range) / len(y_range)
+        return float(np.mean(y_range))
@@ -191,6 +191,13 @@ class RandomSampleCrop(object):
         cropped_masks.set_shape([None, None, None, 1])
         cropped_masks = tf.squeeze(cropped_masks, -1)
 
+        cropped_masks, bboxes, classes, is_crowds = self.crop_boxes(cropped_masks, boxes, labels, is_crowds,
+                                                                    distort_bbox)
+        return cropped_image, cropped_masks, bboxes, classes, is_crowds
+
+    @staticmethod
+    def crop_boxes(cropped_masks, boxes, labels, is_crowds, distort_bbox):
+        """Move the boxes into the crop window, drop the annotations mostly outside of it"""
         # resize the scale of bboxes for cropped image
         v = tf.stack([distort_bbox[0], distort_bbox[1], distort_bbox[0], distort_bbox[1]])
         boxes = boxes - v
@@ -214,6 +221,79 @@ class RandomSampleCrop(object):
         # get new masks
         cropped_masks = tf.boolean_mask(cropped_masks, bool_mask)
 
+        return cropped_masks, bboxes, classes, is_crowds
+
+
+class RandomExpandCrop(object):
+    """Expand followed by RandomSampleCrop in one step.
+    The expand and crop window are sampled the same way, but only the part of the canvas inside the crop window
+    is built, from the original image and masks."""
+
+    def __init__(self, mean):
+        self.mean = mean
+
+    def __call__(self, image, masks, boxes, labels, is_crowds):
+        height = tf.shape(image)[0]
+        width = tf.shape(image)[1]
+
+        # exapnd the image with probability 0.5, same random draws as Expand
+        expand = tf.random.uniform([1]) <= 0.5
+        if expand:
+            ratio = tf.squeeze(tf.random.uniform([1], minval=1, maxval=4))
+            left = tf.squeeze(tf.random.uniform([1], minval=0, maxval=(tf.cast(width, tf.float32) * ratio -
+                                                                       tf.cast(width, tf.float32))))
+            top = tf.squeeze(tf.random.uniform([1], minval=0, maxval=(tf.cast(height, tf.float32) * ratio -
+                                                                      tf.cast(height, tf.float32))))
+            left_padding = tf.cast(left, tf.int32)
+            top_padding = tf.cast(top, tf.int32)
+            expand_width = tf.cast(tf.cast(width, tf.float32) * ratio, tf.int32)
+            expand_height = tf.cast(tf.cast(height, tf.float32) * ratio, tf.int32)
+
+            # boxes on the canvas [ymin, xmin, ymax, xmax]
+            scale = tf.stack([tf.cast(height, tf.float32), tf.cast(width, tf.float32)] * 2)
+            offset = tf.stack([top, left] * 2)
+            canvas_size = tf.stack([tf.cast(expand_height, tf.float32), tf.cast(expand_width, tf.float32)] * 2)
+            boxes = (boxes * scale + offset) / canvas_size
+        else:
+            top_padding = tf.constant(0)
+            left_padding = tf.constant(0)
+            expand_height = height
+            expand_width = width
+
+        # sample the crop window on the canvas without building it
+        boxes = tf.clip_by_value(boxes, clip_value_min=0, clip_value_max=1)  # just in case
+        bbox_begin, bbox_size, distort_bbox = tf.image.sample_distorted_bounding_box(
+            tf.stack([expand_height, expand_width, 3]),
+            bounding_boxes=tf.expand_dims(boxes, 0),
+            min_object_covered=1,
+            aspect_ratio_range=(0.5, 2),
+            area_range=(0.1, 1.0),
+            max_attempts=50)
+        distort_bbox = distort_bbox[0, 0]
+
+        # part of the original image inside the crop window
+        ymin = tf.clip_by_value(bbox_begin[0] - top_padding, 0, height)
+        xmin = tf.clip_by_value(bbox_begin[1] - left_padding, 0, width)
+        ymax = tf.clip_by_value(bbox_begin[0] + bbox_size[0] - top_padding, ymin, height)
+        xmax = tf.clip_by_value(bbox_begin[1] + bbox_size[1] - left_padding, xmin, width)
+        offset_height = ymin + top_padding - bbox_begin[0]
+        offset_width = xmin + left_padding - bbox_begin[1]
+
+        # crop it and pad the rest of the window, as if it was cut from the canvas
+        cropped_image = tf.image.pad_to_bounding_box(image[ymin:ymax, xmin:xmax], offset_height, offset_width,
+                                                     bbox_size[0], bbox_size[1])
+        cropped_image.set_shape([None, None, 3])
+        cropped_masks = tf.image.pad_to_bounding_box(tf.expand_dims(masks[:, ymin:ymax, xmin:xmax], -1),
+                                                     offset_height, offset_width, bbox_size[0], bbox_size[1])
+        cropped_masks = tf.squeeze(cropped_masks, -1)
+
+        if expand:
+            # fill mean value of image
+            mean = tf.constant(self.mean, shape=[1, 1, 3])
+            cropped_image = cropped_image + tf.cast((cropped_image == 0), cropped_image.dtype) * mean
+
+        cropped_masks, bboxes, classes, is_crowds = RandomSampleCrop.crop_boxes(cropped_masks, boxes, labels,
+                                                                                is_crowds, distort_bbox)
         return cropped_image, cropped_masks, bboxes, classes, is_crowds
 
 
@@ -248,7 +328,7 @@ class Resize(object):
         image = tf.image.resize(image, [self.output_size, self.output_size],
                                 method=tf.image.ResizeMethod.BILINEAR)
 
-        # resize the mask to proto_out_size
+        # resize the mask to proto_out_size, uint8 masks are only converted to float32 at proto size here
         masks = tf.image.resize(tf.expand_dims(masks, -1), [self.proto_output_size, self.proto_output_size],
                                 method=tf.image.ResizeMethod.BILINEAR)
         masks = tf.cast(masks + 0.5, tf.int64)
@@ -295,14 +375,174 @@ class BackboneTransform(object):
         return image, masks, boxes, labels, is_crowds
 
 
+class BatchedAugmentation(object):
+    """Training augmentation of SSDAugmentation for a whole batch, meant to run on device at the start of train_step.
+    The parser only decodes and resizes images and masks to a common size. Photometric distortion, expand, crop,
+    mirror, resize and normalization are applied here with one crop_and_resize per batch."""
+
+    def __init__(self, mean, std, output_size, proto_output_size, discard_box_width, discard_box_height,
+                 max_attempts=50, **kwargs):
+        self.mean = mean
+        self.std = std
+        self.output_size = output_size
+        self.proto_output_size = proto_output_size
+        self.discard_w = discard_box_width
+        self.discard_h = discard_box_height
+        self.max_attempts = max_attempts
+
+    def _photometric_distort(self, image):
+        # same as PhotometricDistort, but every image draws its own factors, factor 1 / delta 0 leave it unchanged
+        num_batch = tf.shape(image)[0]
+        coin = lambda: tf.random.uniform([num_batch]) > 0.5
+        per_image = lambda x: x[:, None, None, None]
+
+        delta = tf.where(coin(), tf.random.uniform([num_batch], -0.01, 0.01), 0.)
+        image = image + per_image(delta)
+
+        # contrast goes first or last
+        contrast_first = coin()
+        factor = tf.where(tf.logical_and(contrast_first, coin()), tf.random.uniform([num_batch], 0.5, 0.6), 1.)
+        mean = tf.reduce_mean(image, axis=[1, 2], keepdims=True)
+        image = (image - mean) * per_image(factor) + mean
+
+        # saturation and hue both work in hsv space
+        saturation = tf.where(coin(), tf.random.uniform([num_batch], 0.5, 0.6), 1.)
+        hue = tf.where(coin(), tf.random.uniform([num_batch], -0.5, 0.5), 0.)
+        h, s, v = tf.unstack(tf.image.rgb_to_hsv(image), axis=-1)
+        h = tf.math.floormod(h + hue[:, None, None], 1.)
+        s = tf.clip_by_value(s * saturation[:, None, None], 0., 1.)
+        image = tf.image.hsv_to_rgb(tf.stack([h, s, v], axis=-1))
+
+        factor = tf.where(tf.logical_and(tf.logical_not(contrast_first), coin()),
+                          tf.random.uniform([num_batch], 0.5, 0.6), 1.)
+        mean = tf.reduce_mean(image, axis=[1, 2], keepdims=True)
+        image = (image - mean) * per_image(factor) + mean
+        return image
+
+    def _sample_crop_windows(self, boxes, valid, aspect_ratio):
+        """
+        Sample a crop window for each image the way sample_distorted_bounding_box does with min_object_covered=1:
+        the first of max_attempts random windows that fully covers any of the boxes, or the whole image
+        :param boxes: [batch, num_max_pad, 4] normalized
+        :param valid: [batch, num_max_pad]
+        :param aspect_ratio: [batch], height / width of the image in pixels
+        :return: [batch, 4] window, normalized
+        """
+        num_batch = tf.shape(boxes)[0]
+        shape = [num_batch, self.max_attempts]
+        min_area, max_area = 0.1, 1.0
+
+        # crop width / height in pixels is crop_aspect_ratio, so normalized width = height * width_per_height.
+        # like sample_distorted_bounding_box, height is uniform between the heights of min and max area,
+        # capped so the crop fits in the image
+        crop_aspect_ratio = tf.random.uniform(shape, 0.5, 2.0)
+        width_per_height = crop_aspect_ratio * aspect_ratio[:, None]
+        max_height = tf.minimum(tf.sqrt(max_area / width_per_height), tf.minimum(1., 1. / width_per_height))
+        min_height = tf.minimum(tf.sqrt(min_area / width_per_height), max_height)
+        height = min_height + tf.random.uniform(shape) * (max_height - min_height)
+        width = height * width_per_height
+        area = height * width
+        ymin = tf.random.uniform(shape) * (1. - height)
+        xmin = tf.random.uniform(shape) * (1. - width)
+        windows = tf.stack([ymin, xmin, ymin + height, xmin + width], axis=-1)
+
+        # [batch, attempts, num_max_pad]
+        covered = tf.logical_and(
+            tf.reduce_all(boxes[:, None, :, :2] >= windows[:, :, None, :2], axis=-1),
+            tf.reduce_all(boxes[:, None, :, 2:] <= windows[:, :, None, 2:], axis=-1))
+        covered = tf.logical_and(covered, valid[:, None, :])
+        accepted = tf.logical_and(tf.reduce_any(covered, axis=-1), area >= min_area * (1. - 1e-6))
+
+        first = tf.argmax(tf.cast(accepted, tf.int32), axis=-1, output_type=tf.int32)
+        window = tf.gather(windows, first, batch_dims=1)
+        return tf.where(tf.reduce_any(accepted, axis=-1)[:, None], window, tf.constant([0., 0., 1., 1.]))
+
+    def __call__(self, image, masks, boxes, labels, is_crowds, num_obj, aspect_ratio):
+        """
+        :param image: [batch, height, width, 3] uint8, resized from the original image
+        :param masks: [batch, num_max_pad, mask_height, mask_width] uint8
+        :param boxes: [batch, num_max_pad, 4] normalized
+        :param labels: [batch, num_max_pad]
+        :param is_crowds: [batch, num_max_pad]
+        :param num_obj: [batch], including crowd
+        :param aspect_ratio: [batch], height / width of the original image, crop windows are sampled on it
+        :return: same as the input, image normalized at output size, masks float at proto output size, dropped
+            annotations are removed and the rest is moved to the front
+        """
+        num_batch = tf.shape(image)[0]
+        num_max_pad = tf.shape(boxes)[1]
+        valid = tf.range(num_max_pad)[None, :] < tf.cast(num_obj, tf.int32)[:, None]
+
+        image = tf.image.convert_image_dtype(image, dtype=tf.float32)
+        image = self._photometric_distort(image)
+
+        # expand, same draws as Expand, in normalized coordinates of the original image
+        expand = tf.random.uniform([num_batch]) <= 0.5
+        ratio = tf.where(expand, tf.random.uniform([num_batch], 1., 4.), 1.)
+        left = tf.random.uniform([num_batch]) * (ratio - 1.)
+        top = tf.random.uniform([num_batch]) * (ratio - 1.)
+        offset = tf.stack([top, left, top, left], axis=-1)[:, None, :]
+        boxes = (boxes + offset) / ratio[:, None, None]
+
+        # crop window on the canvas, then boxes in the window, same as RandomSampleCrop.crop_boxes
+        boxes = tf.clip_by_value(boxes, 0., 1.)
+        window = self._sample_crop_windows(boxes, valid, tf.cast(aspect_ratio, tf.float32))
+        window_size = tf.tile(window[:, 2:] - window[:, :2], [1, 2])
+        boxes = (boxes - tf.tile(window[:, None, :2], [1, 1, 2])) / window_size[:, None, :]
+        keep = utils.bboxes_intersection(tf.constant([0., 0., 1., 1.]), tf.reshape(boxes, [-1, 4])) > 0.5
+        keep = tf.logical_and(valid, tf.reshape(keep, [num_batch, num_max_pad]))
+        boxes = tf.clip_by_value(boxes, 0., 1.)
+
+        # mirror
+        mirror = tf.random.uniform([num_batch]) > 0.5
+        boxes = tf.where(mirror[:, None, None],
+                         tf.stack([boxes[..., 0], 1 - boxes[..., 3], boxes[..., 2], 1 - boxes[..., 1]], axis=-1),
+                         boxes)
+
+        # window of crop_and_resize in the original image, x is swapped for mirrored images
+        window = window * ratio[:, None] - offset[:, 0]
+        window = tf.where(mirror[:, None], tf.gather(window, [0, 3, 2, 1], axis=-1), window)
+        box_indices = tf.range(num_batch)
+
+        # area outside of the original image is filled with mean
+        fill = tf.constant(self.mean, shape=[1, 1, 1, 3])
+        image = tf.image.crop_and_resize(image - fill, window, box_indices,
+                                         [self.output_size, self.output_size]) + fill
+
+        # masks as channels, [batch, proto_output_size, proto_output_size, num_max_pad]
+        masks = tf.image.crop_and_resize(tf.transpose(masks, [0, 2, 3, 1]), window, box_indices,
+                                         [self.proto_output_size, self.proto_output_size])
+        masks = tf.cast(tf.cast(tf.transpose(masks, [0, 3, 1, 2]) + 0.5, tf.int64), tf.float32)
+
+        # discard the boxes that are too small, same as Resize
+        w = self.output_size * (boxes[..., 3] - boxes[..., 1])
+        h = self.output_size * (boxes[..., 2] - boxes[..., 0])
+        keep = tf.logical_and(keep, tf.logical_and(w > self.discard_w, h > self.discard_h))
+
+        # move kept annotations to the front in the same order, zero the rest
+        order = tf.argsort(tf.cast(tf.logical_not(keep), tf.int32), axis=-1, stable=True)
+        keep = tf.gather(keep, order, batch_dims=1)
+        boxes = tf.gather(boxes, order, batch_dims=1) * tf.cast(keep[..., None], tf.float32)
+        masks = tf.gather(masks, order, batch_dims=1) * tf.cast(keep[..., None, None], tf.float32)
+        labels = tf.gather(labels, order, batch_dims=1) * tf.cast(keep, labels.dtype)
+        is_crowds = tf.logical_and(tf.gather(is_crowds, order, batch_dims=1), keep)
+        num_obj = tf.reduce_sum(tf.cast(keep, tf.int32), axis=-1)
+
+        # normalization, same as BackboneTransform
+        image = (image - tf.constant(self.mean)) / tf.constant(self.std)
+        return image, masks, boxes, labels, is_crowds, num_obj
+
+
 class SSDAugmentation(object):
-    def __init__(self, mode, mean, std, output_size, proto_output_size, discard_box_width, discard_box_height):
+    def __init__(self, mode, mean, std, output_size, proto_output_size, discard_box_width, discard_box_height,
+                 fused_expand_crop=False):
         if mode == 'train':
+            # fused version never builds the expanded canvas
+            geometric = [RandomExpandCrop(mean)] if fused_expand_crop else [Expand(mean), RandomSampleCrop()]
             self.augmentations = Compose([
                 ConvertFromInts(),
                 PhotometricDistort(),
-                Expand(mean),
-                RandomSampleCrop(),
+                *geometric,
                 RandomMirror(),
                 Resize(output_size, proto_output_size, discard_box_width, discard_box_height),
                 BackboneTransform(mean, std)
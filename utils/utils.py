@@ -4,6 +4,7 @@ https://github.com/tensorflow/models/blob/831281cedfc8a4a0ad7c0c37173963fafb99da
 https://github.com/tensorflow/models/blob/3462436c91897f885e3593f0955d24cbe805333d/official/vision/detection/utils/input_utils.py
 https://github.com/dbolya/yolact/blob/master/layers/box_utils.py
 """
+import numpy as np
 import tensorflow as tf
 
 
@@ -93,72 +94,36 @@ def map_to_offset(x):
 
 # crop the prediction of mask so as to calculate the linear combination mask loss
 def crop(pred, boxes):
+    """
+    Zero the masks outside of their box, works on any leading dims
+    :param pred: [..., h, w]
+    :param boxes: [..., 4] (ymin, xmin, ymax, xmax) in pixels of pred
+    """
     pred_shape = tf.shape(pred)
-    w = tf.cast(tf.range(pred_shape[1]), tf.float32)
-    h = tf.expand_dims(tf.cast(tf.range(pred_shape[2]), tf.float32), axis=-1)
-
-    cols = tf.broadcast_to(w, pred_shape)
-    rows = tf.broadcast_to(h, pred_shape)
-
-    ymin = tf.broadcast_to(tf.reshape(boxes[:, 0], [-1, 1, 1]), pred_shape)
-    xmin = tf.broadcast_to(tf.reshape(boxes[:, 1], [-1, 1, 1]), pred_shape)
-    ymax = tf.broadcast_to(tf.reshape(boxes[:, 2], [-1, 1, 1]), pred_shape)
-    xmax = tf.broadcast_to(tf.reshape(boxes[:, 3], [-1, 1, 1]), pred_shape)
+    rows = tf.cast(tf.range(pred_shape[-2]), tf.float32)
+    cols = tf.cast(tf.range(pred_shape[-1]), tf.float32)
+    boxes = tf.cast(boxes, tf.float32)
+    ymin, xmin, ymax, xmax = [boxes[..., i, None] for i in range(4)]
 
-    mask_left = (cols >= tf.cast(xmin, cols.dtype))
-    mask_right = (cols <= tf.cast(xmax, cols.dtype))
-    mask_bottom = (rows >= tf.cast(ymin, rows.dtype))
-    mask_top = (rows <= tf.cast(ymax, rows.dtype))
-
-    crop_mask = tf.math.logical_and(tf.math.logical_and(mask_left, mask_right),
-                                    tf.math.logical_and(mask_bottom, mask_top))
-    crop_mask = tf.cast(crop_mask, tf.float32)
+    # broadcast [..., h, 1] and [..., 1, w] instead of building the coordinates of every pixel
+    mask_rows = tf.math.logical_and(rows >= ymin, rows <= ymax)
+    mask_cols = tf.math.logical_and(cols >= xmin, cols <= xmax)
+    crop_mask = tf.math.logical_and(mask_rows[..., :, None], mask_cols[..., None, :])
+    crop_mask = tf.cast(crop_mask, pred.dtype)
 
     return pred * crop_mask
 
 
-# decode the offset back to center form bounding box when evaluation and prediction
-def map_to_bbox(anchors, loc_pred):
-    # we use this variance also when we encode the offset
-    variances = [0.1, 0.2]
-
-    # convert anchor to center_form
-    anchor_h = anchors[:, 2] - anchors[:, 0]
-    anchor_w = anchors[:, 3] - anchors[:, 1]
-    anchor_cx = anchors[:, 1] + (anchor_w / 2)
-    anchor_cy = anchors[:, 0] + (anchor_h / 2)
-    # tf.print("cx", tf.shape(anchor_cx))
-
-    pred_cx, pred_cy, pred_w, pred_h = tf.unstack(loc_pred, axis=-1)
-
-    new_cx = pred_cx * (anchor_w * variances[0]) + anchor_cx
-    new_cy = pred_cy * (anchor_h * variances[0]) + anchor_cy
-    new_w = tf.math.exp(pred_w * variances[1]) * anchor_w
-    new_h = tf.math.exp(pred_h * variances[1]) * anchor_h
-
-    ymin = new_cy - (new_h / 2)
-    xmin = new_cx - (new_w / 2)
-    ymax = new_cy + (new_h / 2)
-    xmax = new_cx + (new_w / 2)
-
-    decoded_boxes = tf.stack([ymin, xmin, ymax, xmax], axis=-1)
-    # tf.print(tf.shape(decoded_boxes))
-
-    # tf.print("anchor", tf.shape(anchors))
-    # tf.print("pred", tf.shape(loc_pred))
-    return decoded_boxes
-
-
 def intersection(box_a, box_b):
     # unstack the ymin, xmin, ymax, xmax
     ymin_anchor, xmin_anchor, ymax_anchor, xmax_anchor = tf.unstack(box_a, axis=-1)
     ymin_gt, xmin_gt, ymax_gt, xmax_gt = tf.unstack(box_b, axis=-1)
 
     # calculate intersection
-    all_pairs_max_xmin = tf.math.maximum(tf.expand_dims(xmin_anchor, axis=-1), tf.expand_dims(xmin_gt, axis=1))
-    all_pairs_min_xmax = tf.math.minimum(tf.expand_dims(xmax_anchor, axis=-1), tf.expand_dims(xmax_gt, axis=1))
-    all_pairs_max_ymin = tf.math.maximum(tf.expand_dims(ymin_anchor, axis=-1), tf.expand_dims(ymin_gt, axis=1))
-    all_pairs_min_ymax = tf.math.minimum(tf.expand_dims(ymax_anchor, axis=-1), tf.expand_dims(ymax_gt, axis=1))
+    all_pairs_max_xmin = tf.math.maximum(tf.expand_dims(xmin_anchor, axis=-1), tf.expand_dims(xmin_gt, axis=-2))
+    all_pairs_min_xmax = tf.math.minimum(tf.expand_dims(xmax_anchor, axis=-1), tf.expand_dims(xmax_gt, axis=-2))
+    all_pairs_max_ymin = tf.math.maximum(tf.expand_dims(ymin_anchor, axis=-1), tf.expand_dims(ymin_gt, axis=-2))
+    all_pairs_min_ymax = tf.math.minimum(tf.expand_dims(ymax_anchor, axis=-1), tf.expand_dims(ymax_gt, axis=-2))
 
     intersect_heights = tf.math.maximum(0.0, all_pairs_min_ymax - all_pairs_max_ymin)
     intersect_widths = tf.math.maximum(0.0, all_pairs_min_xmax - all_pairs_max_xmin)
@@ -183,7 +148,7 @@ def jaccard(box_a, box_b, is_crowd=False):
     # tf.print("area b", area_b)
 
     # create same shape of matrix as intersection
-    pairwise_area = tf.expand_dims(area_a, axis=-1) + tf.expand_dims(area_b, axis=1)
+    pairwise_area = tf.expand_dims(area_a, axis=-1) + tf.expand_dims(area_b, axis=-2)
 
     # calculate A ∪ B
     pairwise_union = tf.expand_dims(area_a, axis=-1) if is_crowd else (pairwise_area - pairwise_inter)
@@ -219,8 +184,54 @@ def mask_iou(masks_a, masks_b, is_crowd=False):
     return inter / union
 
 
-def postprocess(detection, w, h, batch_idx, intepolation_mode="bilinear", crop_mask=True, score_threshold=0):
-    """post process after detection layer"""
+# number of set bits of every byte, for numpy without bitwise_count
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def _pack_masks(masks):
+    # [n, h, w] binary masks to [n, ceil(h * w / 64)] words of 64 pixels, the explicit h * w allows n = 0
+    num, height, width = np.shape(masks)
+    bits = np.packbits(np.reshape(masks, (num, height * width)) > 0.5, axis=-1)
+    bits = np.pad(bits, [[0, 0], [0, -bits.shape[1] % 8]])
+    return np.ascontiguousarray(bits).view(np.uint64)
+
+
+def _popcount(x):
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(x).sum(axis=-1, dtype=np.int64)
+    return _POPCOUNT[x.view(np.uint8)].sum(axis=-1, dtype=np.int64)
+
+
+def packed_mask_iou(masks_a, masks_b, is_crowd=False):
+    """
+    Same as mask_iou for binary masks, on bit packed numpy masks instead of float32 matmul, a mask of 550x550 takes
+    38KB instead of 1.2MB. Soft masks are binarized at 0.5.
+    :param masks_a: [num_a, h, w]
+    :param masks_b: [num_b, h, w]
+    :return: numpy iou [num_a, num_b]
+    """
+    bits_a = _pack_masks(masks_a)
+    bits_b = _pack_masks(masks_b)
+
+    # one row of a at a time keeps the temporary at [num_b, words]
+    inter = np.zeros([bits_a.shape[0], bits_b.shape[0]], dtype=np.int64)
+    for i in range(bits_a.shape[0]):
+        inter[i] = _popcount(bits_a[i] & bits_b)
+
+    area_a = _popcount(bits_a)[:, None]
+    area_b = _popcount(bits_b)[None, :]
+    union = area_a if is_crowd else (area_a + area_b - inter)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return inter / union
+
+
+def postprocess(detection, w, h, batch_idx, intepolation_mode="bilinear", crop_mask=True, score_threshold=0,
+                mask_size=None):
+    """
+    post process after detection layer
+    :param mask_size: (height, width) of the output masks, default to the image size [w, h]
+    """
     # Todo: If scorethreshold is not zero
     """
     if score_threshold > 0:
@@ -230,8 +241,16 @@ def postprocess(detection, w, h, batch_idx, intepolation_mode="bilinear", crop_m
             if k != 'proto':
                 detection[k] = detection[k][keep]
     """
-    dets = detection[batch_idx]
-    dets = dets['detection']
+    if isinstance(detection, dict):
+        # padded output of batched detection, slice out the valid detection of this image
+        num_detections = detection['num_detections'][batch_idx]
+        if num_detections == 0:
+            return None, None, None, None
+        dets = {k: detection[k][batch_idx, :num_detections] for k in ('class', 'box', 'score', 'mask')}
+        dets['proto'] = detection['proto'][batch_idx]
+    else:
+        dets = detection[batch_idx]
+        dets = dets['detection']
 
     if dets is None:
         return None, None, None, None  # Warning, this is 4 copies of the same thing
@@ -252,7 +271,7 @@ def postprocess(detection, w, h, batch_idx, intepolation_mode="bilinear", crop_m
         masks = crop(pred_mask, boxes * float(tf.shape(pred_mask)[-1] / w))
 
     # intepolate to original size
-    masks = tf.image.resize(tf.expand_dims(masks, axis=-1), [w, h],
+    masks = tf.image.resize(tf.expand_dims(masks, axis=-1), [w, h] if mask_size is None else mask_size,
                             method=intepolation_mode)
     # binarized the mask
     masks = tf.cast(masks + 0.5, tf.int64)
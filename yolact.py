@@ -35,9 +35,10 @@ class Yolact(tf.keras.Model):
         # choose the backbone network
         try:
             out = backbones_extracted[backbone]
-            base_model = backbones_objects[backbone]
+            build_base_model = backbones_objects[backbone]
         except:
             raise Exception(f'Backbone option of {backbone} is not supported yet!!!')
+        base_model = build_base_model()
 
         # extract certain feature maps for FPN
         self.backbone = tf.keras.Model(inputs=base_model.input,
@@ -53,15 +54,12 @@ class Yolact(tf.keras.Model):
 
         # instance of anchor object
         self.anchor_instance = Anchor(**anchor_params)
-        priors = self.anchor_instance.get_anchors()
-        # print("prior shape:", priors.shape)
-        # print("num anchor per feature map: ", tf.shape(priors)[0])
 
         # shared prediction head
         self.predictionHead = PredictionModule(256, len(anchor_params["aspect_ratio"]), num_class, num_mask)
 
         # detection layer
-        self.detect = Detect(anchors=priors, **detect_params)
+        self.detect = Detect(anchor_instance=self.anchor_instance, **detect_params)
 
     # Todo need to clarified
     def set_bn(self, mode='train'):